@@ -0,0 +1,144 @@
+"""
+Measure / and SSE latency of the app while a large blueprint json is exported, with the conversion in the CPU
+worker processes and in the apstra threads (APSTRA_CPU_WORKERS=0). The app and the mock Apstra run as processes
+
+    python benchmarks/export_latency.py --dump-nodes 1000000 --node-bytes 300            # about 300 MB
+    python benchmarks/export_latency.py --dump-nodes 1000000 --node-bytes 300 --gzip
+
+The SSE latency is from GET /get-env-example to its 'downloaded' event on /sse
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARK_DIR)
+
+from suite import free_port, login, start_app, summary  # noqa: E402
+
+
+def start_mock(port: int, args) -> subprocess.Popen:
+    mock = subprocess.Popen([sys.executable, os.path.join(BENCHMARK_DIR, 'fake_apstra.py'), '--port', str(port), '--blueprints', '1',
+                             '--switches', '4', '--dump-nodes', str(args.dump_nodes), '--node-bytes', str(args.node_bytes)])
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return mock
+        except OSError:
+            time.sleep(0.1)
+    mock.kill()
+    raise RuntimeError('the mock did not start')
+
+
+async def probe_index(client: httpx.AsyncClient, stop: asyncio.Event, interval: float) -> list:
+    latencies = []
+    while not stop.is_set():
+        begin = time.perf_counter()
+        (await client.get('/')).raise_for_status()
+        latencies.append(time.perf_counter() - begin)
+        await asyncio.sleep(interval)
+    return latencies
+
+
+async def probe_sse(client: httpx.AsyncClient, stop: asyncio.Event, interval: float) -> list:
+    """
+    The seconds from GET /get-env-example to its event on /sse
+    """
+    latencies = []
+    arrived = asyncio.Event()
+
+    async def watch():
+        async with client.stream('GET', '/sse') as response:
+            async for line in response.aiter_lines():
+                if line.startswith('data:') and 'env-example.json downloaded' in line:
+                    arrived.set()
+
+    watcher = asyncio.create_task(watch())
+    try:
+        await asyncio.sleep(0.5)
+        while not stop.is_set():
+            arrived.clear()
+            begin = time.perf_counter()
+            (await client.get('/get-env-example')).raise_for_status()
+            await arrived.wait()
+            latencies.append(time.perf_counter() - begin)
+            await asyncio.sleep(interval)
+    finally:
+        watcher.cancel()
+    return latencies
+
+
+async def measure(client: httpx.AsyncClient, args, export: bool) -> dict:
+    """
+    The latencies while the export runs, or for --idle seconds without
+    """
+    stop = asyncio.Event()
+    probes = asyncio.gather(probe_index(client, stop, args.interval), probe_sse(client, stop, args.sse_interval))
+    result = {}
+    if export:
+        size = 0
+        begin = time.perf_counter()
+        async with client.stream('GET', '/pull-bp-json', params={'gzip': str(args.gzip).lower()}) as response:
+            async for chunk in response.aiter_raw():
+                size += len(chunk)
+        result.update({'seconds': round(time.perf_counter() - begin, 2), 'bytes': size})
+    else:
+        await asyncio.sleep(args.idle)
+    stop.set()
+    index_latencies, sse_latencies = await probes
+    result.update({'index_latency': summary(index_latencies), 'sse_latency': summary(sse_latencies)})
+    return result
+
+
+async def run_mode(args, cpu_workers: int, apstra_port: int, work_dir: str) -> dict:
+    os.environ['APSTRA_CPU_WORKERS'] = str(cpu_workers)
+    port = free_port()
+    app = start_app(port, work_dir)
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=httpx.Timeout(args.timeout)) as client:
+            await login(client, apstra_port, 'bp-0')
+            return {'idle': await measure(client, args, export=False), 'export': await measure(client, args, export=True)}
+    finally:
+        app.terminate()
+        app.wait()
+
+
+async def run(args) -> dict:
+    apstra_port = free_port()
+    mock = start_mock(apstra_port, args)
+    results = {}
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            for cpu_workers in (args.cpu_workers, 0):
+                results[f"cpu_workers_{cpu_workers}"] = await run_mode(args, cpu_workers, apstra_port, work_dir)
+    finally:
+        mock.terminate()
+        mock.wait()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dump-nodes', type=int, default=1000000, help='nodes in the blueprint dump')
+    parser.add_argument('--node-bytes', type=int, default=300, help='approximate size of a dump node')
+    parser.add_argument('--gzip', action='store_true', help='export the json gzip compressed')
+    parser.add_argument('--cpu-workers', type=int, default=4, help='the CPU worker processes, compared with 0')
+    parser.add_argument('--interval', type=float, default=0.1, help='seconds between / probes')
+    parser.add_argument('--sse-interval', type=float, default=0.25, help='seconds between SSE probes')
+    parser.add_argument('--idle', type=float, default=3.0, help='seconds of the probes before the export')
+    parser.add_argument('--timeout', type=float, default=600.0, help='seconds for a request')
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+
+
+if __name__ == '__main__':
+    main()
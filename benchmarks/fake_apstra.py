@@ -0,0 +1,384 @@
+"""
+Stand-ins of Apstra for the benchmarks, with configurable fabric size, payload size and latency
+FakeFabric makes the payloads. They are answered in-process by FakeApstraSession and FakeBlueprint, stand-ins of
+CkApstraSession and CkApstraBlueprint with blocking, injected latency, or over HTTPS by make_server().
+CkApstraSession always uses https, so a self-signed certificate is made with the openssl command
+
+    python benchmarks/fake_apstra.py --port 8443 --blueprints 3 --switches 200 --latency 0.02
+
+Served:
+    GET  /api/versions/server
+    POST /api/user/login
+    GET  /api/blueprints                                         blueprint list
+    GET  /api/blueprints/{id}                                    blueprint dump, streamed
+    POST /api/blueprints                                         blueprint create, the body is counted and dropped
+    PATCH /api/blueprints/{created id}                           batch of the created blueprint, the body is counted and dropped
+    DELETE /api/blueprints/{created id}                          the created blueprint of a failed batched push
+    POST /api/blueprints/{id}/qe                                 the switches for any query
+    GET  /api/blueprints/{id}/nodes/{node_id}/config-rendering
+    GET  /api/systems/{serial}/pristine-config
+"""
+import argparse
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import shutil
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+from typing import Any, Iterator, List
+
+DESIGN = 'two_stage_l3clos'
+BEGIN_CONFIGLET = '------BEGIN SECTION CONFIGLETS------'
+BEGIN_SET = '------BEGIN SECTION SET AND DELETE BASED CONFIGLETS------'
+
+
+@dataclass
+class FakeFabric:
+    blueprints: int = 3
+    switches: int = 40  # per blueprint
+    config_bytes: int = 8 * 1024  # the size of the rendered config of a switch
+    dump_nodes: int = 10000  # the nodes of the blueprint dump, at least the switches
+    node_bytes: int = 300  # the approximate size of a filler node in the dump
+    latency: float = 0.0  # seconds added to every call
+    version: str = '4.2.0'
+    created: List[int] = field(default_factory=list)  # the body sizes of the created blueprints
+    patched: List[int] = field(default_factory=list)  # the body sizes of the batches to the created blueprints
+    deleted: List[str] = field(default_factory=list)  # the created blueprints deleted
+    patch_failures: int = 0  # the batches answered with 503 before the others, for the retries
+    get_failures: int = 0  # the GET calls after the login answered with 503 before the others, for the retries
+
+    def blueprint_list(self) -> dict:
+        return {'items': [{'id': f"bp-id-{i}", 'label': f"bp-{i}", 'design': DESIGN, 'version': 1} for i in range(self.blueprints)]}
+
+    def switch(self, i: int) -> dict:
+        # every fourth switch is not assigned to a device, without the pristine config
+        return {'id': f"switch-node-{i}", 'type': 'system', 'system_type': 'switch', 'role': 'leaf',
+                'label': f"leaf-{i:04}", 'system_id': f"SERIAL{i:05}" if i % 4 else None}
+
+    def query(self) -> dict:
+        return {'items': [{'switch': self.switch(i)} for i in range(self.switches)]}
+
+    def rendering(self, node_id: str) -> dict:
+        line = f"set interfaces et-0/0/0 description {node_id}\n"
+        intended = line * max(1, self.config_bytes * 8 // 10 // len(line))
+        configlet = f"configlet {node_id}\n" * 20
+        return {'config': f"{intended}{BEGIN_CONFIGLET}{configlet}{BEGIN_SET}set system {node_id}\n"}
+
+    def pristine(self, serial: str) -> dict:
+        return {'pristine_data': [{'content': f"system host-name {serial}\n" * 40}]}
+
+    def iter_dump(self, bp_index: int) -> Iterator[bytes]:
+        """
+        The blueprint json in the layout of CkApstraBlueprint.dump(), one node at a time
+        """
+        filler = max(0, self.dump_nodes - self.switches)
+        padding = 'x' * max(0, self.node_bytes - 200)
+        yield b'{"nodes": {'
+        for i in range(self.switches):
+            node = dict(self.switch(i), tags=None, property_set=None)
+            yield f'{"," if i else ""}"{node["id"]}": {json.dumps(node)}'.encode()
+        for i in range(filler):
+            node = {'id': f"intf-{i}", 'type': 'interface', 'if_name': f"et-0/0/{i % 48}", 'if_type': 'ethernet',
+                    'label': None, 'description': padding, 'tags': None, 'property_set': None}
+            yield f',"intf-{i}": {json.dumps(node)}'.encode()
+        yield b'}, "relationships": {'
+        for i in range(filler):
+            rel = {'id': f"rel-{i}", 'type': 'hosted_interfaces', 'source_id': f"switch-node-{i % max(1, self.switches)}", 'target_id': f"intf-{i}", 'tags': None}
+            yield f'{"," if i else ""}"rel-{i}": {json.dumps(rel)}'.encode()
+        yield f'}}, "label": "bp-{bp_index}", "version": 1, "design": "{DESIGN}", "id": "bp-id-{bp_index}"}}'.encode()
+
+
+@dataclass
+class FakeResponse:
+    content: bytes = b'{"id": "fake-blueprint"}'
+    status_code: int = 201
+
+    @property
+    def ok(self) -> bool:
+        return self.status_code < 400
+
+    @property
+    def text(self) -> str:
+        return self.content.decode('utf-8', 'replace')
+
+    def json(self) -> Any:
+        return json.loads(self.content)
+
+
+@dataclass
+class FakeStreamResponse:
+    raw: Any  # file object of the response body
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.raw.close()
+
+
+@dataclass
+class FakeHttpSession:
+    """
+    requests.Session stand-in which consumes the posted body, keeping only its size and optionally the body
+    get() returns the content of dump_file, the blueprint json. patch() keeps the sizes of the batches
+    """
+    keep_body: bool = False
+    body_bytes: int = 0
+    body: bytes = b''
+    dump_file: str = None
+    patched: List[int] = field(default_factory=list)
+
+    def get(self, url: str, stream: bool = False) -> FakeStreamResponse:
+        return FakeStreamResponse(open(self.dump_file, 'rb'))
+
+    def post(self, url: str, data=None, params: dict = None, **kwargs) -> FakeResponse:
+        if 'json' in kwargs:
+            # the empty blueprint of the batched push
+            data = json.dumps(kwargs['json']).encode('utf-8')
+        chunks = [data] if isinstance(data, bytes) else data
+        self.body_bytes = 0
+        self.patched = []
+        kept = []
+        for chunk in chunks:
+            self.body_bytes += len(chunk)
+            if self.keep_body:
+                kept.append(chunk)
+        self.body = b''.join(kept)
+        return FakeResponse()
+
+    def patch(self, url: str, data: bytes = None) -> FakeResponse:
+        self.patched.append(len(data))
+        return FakeResponse(b'{}', 202)
+
+    def delete(self, url: str) -> FakeResponse:
+        return FakeResponse(b'', 202)
+
+
+@dataclass
+class FakeApstraSession:
+    delay: float = 0.0  # seconds per call
+    fabric: FakeFabric = field(default_factory=FakeFabric)  # the payloads
+    url_prefix: str = 'https://fake-apstra/api'
+    version: str = '4.2.0'
+    last_error: str = None
+    session: FakeHttpSession = field(default_factory=FakeHttpSession)
+
+    def get_items(self, url: str) -> dict:
+        time.sleep(self.delay)
+        if url == 'blueprints':
+            return self.fabric.blueprint_list()
+        return self.fabric.pristine(url.split('/')[1])
+
+    def post(self, url: str, data: dict, params: dict = None) -> FakeResponse:
+        time.sleep(self.delay)
+        # requests serializes json= into one body
+        return self.session.post(url, data=json.dumps(data).encode('utf-8'))
+
+
+@dataclass
+class FakeBlueprint:
+    session: FakeApstraSession
+    label: str = 'bp-0'
+    switch_count: int = 40
+    query_delay: float = 0.0
+    design: str = DESIGN
+    id: str = 'bp-id-0'
+
+    def query(self, query_string: str) -> list:
+        time.sleep(self.query_delay)
+        return [{'switch': self.session.fabric.switch(i)} for i in range(self.switch_count)]
+
+    def get_item(self, item: str) -> dict:
+        time.sleep(self.session.delay)
+        return self.session.fabric.rendering(item.split('/')[1])
+
+    def dump(self) -> dict:
+        time.sleep(self.query_delay)
+        return {'nodes': {}, 'relationships': {}, 'label': self.label, 'design': self.design, 'id': self.id, 'version': 1}
+
+
+def install(global_store, duration: float = 30.0, switch_count: int = 40, concurrency: int = 8):
+    """
+    Make global_store use the fake Apstra so that a pull_config takes about duration seconds
+    Half of the duration is the switch query, the other half is the per switch fetches
+    """
+    rounds = max(1, switch_count // concurrency)
+    session = FakeApstraSession(delay=duration / 2 / rounds / 2)
+    blueprint = FakeBlueprint(session, switch_count=switch_count, query_delay=duration / 2)
+    global_store.apstra = type('FakeApstraServer', (), {'apstra_server': session, 'host': 'fake-apstra', 'server_key': 'fake-apstra:443'})()
+    global_store.main_blueprint = blueprint.label
+    global_store.blueprints[blueprint.label] = blueprint
+    global_store.fetch_concurrency = concurrency
+    return session, blueprint
+
+
+class FakeApstraHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive like Apstra
+    fabric: FakeFabric = None  # set by make_server
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, data: dict, status: int = 200) -> None:
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_chunks(self, chunks: Iterator[bytes], chunk_size: int = 64 * 1024) -> None:
+        """
+        Send the body with the chunked transfer encoding, coalescing the small pieces
+        """
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        pending, size = [], 0
+        for chunk in chunks:
+            pending.append(chunk)
+            size += len(chunk)
+            if size >= chunk_size:
+                self.wfile.write(b'%x\r\n%s\r\n' % (size, b''.join(pending)))
+                pending, size = [], 0
+        if size:
+            self.wfile.write(b'%x\r\n%s\r\n' % (size, b''.join(pending)))
+        self.wfile.write(b'0\r\n\r\n')
+
+    def read_body(self) -> int:
+        """
+        Consume the request body, Content-Length or chunked, and return its size
+        """
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            total = 0
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return total
+                remaining = size
+                while remaining:
+                    remaining -= len(self.rfile.read(min(remaining, 1024 * 1024)))
+                self.rfile.readline()
+                total += size
+        length = int(self.headers.get('Content-Length', 0))
+        remaining = length
+        while remaining:
+            remaining -= len(self.rfile.read(min(remaining, 1024 * 1024)))
+        return length
+
+    def route(self, method: str) -> None:
+        fabric = self.fabric
+        time.sleep(fabric.latency)
+        path = self.path.split('?')[0].rstrip('/').split('/')[2:]  # after /api
+        if method in ('POST', 'PATCH'):
+            body_size = self.read_body()
+        if method == 'GET' and fabric.get_failures > 0 and path != ['versions', 'server']:
+            fabric.get_failures -= 1
+            return self.send_json({'errors': 'busy'}, 503)
+        if method == 'GET' and path == ['versions', 'server']:
+            return self.send_json({'version': fabric.version})
+        if method == 'POST' and path == ['user', 'login']:
+            return self.send_json({'token': 'fake-token', 'id': 'fake-user'}, 201)
+        if path[:1] == ['blueprints']:
+            if method == 'GET' and len(path) == 1:
+                return self.send_json(fabric.blueprint_list())
+            if method == 'POST' and len(path) == 1:
+                fabric.created.append(body_size)
+                return self.send_json({'id': f"created-{len(fabric.created)}"}, 201)
+            if method == 'DELETE' and len(path) == 2 and path[1].startswith('created-'):
+                fabric.deleted.append(path[1])
+                return self.send_json({}, 202)
+            if method == 'PATCH' and len(path) == 2 and path[1].startswith('created-'):
+                if fabric.patch_failures > 0:
+                    fabric.patch_failures -= 1
+                    return self.send_json({'errors': 'busy'}, 503)
+                fabric.patched.append(body_size)
+                return self.send_json({}, 202)
+            bp_index = int(path[1].rsplit('-', 1)[-1]) if path[1].startswith('bp-id-') else -1
+            if not 0 <= bp_index < fabric.blueprints:
+                return self.send_json({'errors': f"blueprint {path[1]} not found"}, 404)
+            if method == 'GET' and len(path) == 2:
+                return self.send_chunks(fabric.iter_dump(bp_index))
+            if method == 'POST' and path[2:] == ['qe']:
+                return self.send_json(fabric.query())
+            if method == 'GET' and len(path) == 5 and path[2] == 'nodes' and path[4] == 'config-rendering':
+                return self.send_json(fabric.rendering(path[3]))
+        if method == 'GET' and len(path) == 3 and path[0] == 'systems' and path[2] == 'pristine-config':
+            return self.send_json(fabric.pristine(path[1]))
+        self.send_json({'errors': f"{method} {self.path} not faked"}, 404)
+
+    def do_GET(self):
+        self.route('GET')
+
+    def do_POST(self):
+        self.route('POST')
+
+    def do_PATCH(self):
+        self.route('PATCH')
+
+    def do_DELETE(self):
+        self.route('DELETE')
+
+
+def make_certificate(cert_dir: str) -> tuple:
+    """
+    Make a self-signed certificate with the openssl command. Return (cert_file, key_file)
+    """
+    openssl = os.getenv('OPENSSL', shutil.which('openssl') or 'openssl')
+    cert_file, key_file = os.path.join(cert_dir, 'cert.pem'), os.path.join(cert_dir, 'key.pem')
+    subprocess.run([openssl, 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1', '-subj', '/CN=localhost',
+                    '-keyout', key_file, '-out', cert_file], check=True, capture_output=True)
+    return cert_file, key_file
+
+
+def make_server(fabric: FakeFabric, port: int = 0, host: str = '127.0.0.1') -> ThreadingHTTPServer:
+    """
+    The HTTPS server of the fabric. port 0 for a free port, in server.server_address
+    """
+    handler = type('Handler', (FakeApstraHandler,), {'fabric': fabric})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    with tempfile.TemporaryDirectory() as cert_dir:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(*make_certificate(cert_dir))
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    return server
+
+
+def start_server(fabric: FakeFabric, port: int = 0) -> ThreadingHTTPServer:
+    server = make_server(fabric, port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def add_fabric_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument('--blueprints', type=int, default=3)
+    parser.add_argument('--switches', type=int, default=40, help='switches per blueprint')
+    parser.add_argument('--config-bytes', type=int, default=8 * 1024, help='rendered config size per switch')
+    parser.add_argument('--dump-nodes', type=int, default=10000, help='nodes in the blueprint dump')
+    parser.add_argument('--node-bytes', type=int, default=300, help='approximate size of a dump node')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every Apstra call')
+
+
+def fabric_from_args(args) -> FakeFabric:
+    return FakeFabric(args.blueprints, args.switches, args.config_bytes, args.dump_nodes, args.node_bytes, args.latency)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8443)
+    add_fabric_arguments(parser)
+    args = parser.parse_args()
+    server = make_server(fabric_from_args(args), args.port)
+    print(f"fake Apstra on https://127.0.0.1:{server.server_address[1]}/api")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
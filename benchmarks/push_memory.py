@@ -0,0 +1,106 @@
+"""
+Compare the peak memory of /push-bp-json: json.loads + push_bp_json against push_bp_json_stream,
+in one call and batched, on a generated blueprint json
+
+    python benchmarks/push_memory.py --nodes 100000
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'src'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from app.lib import common  # noqa: E402
+import fake_apstra  # noqa: E402
+
+
+def write_blueprint(fp, node_count: int) -> None:
+    """
+    Write a blueprint json in the layout of CkApstraBlueprint.dump(), one node at a time
+    """
+    fp.write(b'{"relationships": {')
+    for i in range(node_count * 3 // 2):
+        rel = {'id': f"rel-{i}", 'type': 'hosted_interfaces', 'source_id': f"node-{i % node_count}", 'target_id': f"node-{(i * 7) % node_count}", 'tags': None}
+        fp.write(f'{"," if i else ""}"rel-{i}": {json.dumps(rel)}'.encode())
+    fp.write(b'}, "nodes": {')
+    for i in range(node_count):
+        if i == 0:
+            node = {'id': 'node-0', 'type': 'metadata', 'label': 'source-bp', 'tags': None, 'property_set': None}
+        elif i % 10 == 0:
+            node = {'id': f"node-{i}", 'type': 'system', 'system_type': 'switch', 'role': 'leaf', 'label': f"leaf-{i}", 'system_id': f"SERIAL{i}", 'tags': "['null']", 'property_set': None}
+        else:
+            node = {'id': f"node-{i}", 'type': 'interface', 'if_name': f"et-0/0/{i % 48}", 'if_type': 'ethernet', 'label': None, 'description': f"interface {i} " * 4, 'tags': None, 'property_set': None}
+        fp.write(f'{"," if i else ""}"node-{i}": {json.dumps(node)}'.encode())
+    fp.write(b'}, "label": "source-bp", "version": 42, "design": "two_stage_l3clos", "id": "source-bp-id"}')
+
+
+async def push_legacy(store, path: str) -> None:
+    with open(path, 'rb') as fp:
+        file_dict = json.loads(fp.read())
+    await store.push_bp_json(file_dict, 'new-bp')
+
+
+async def push_stream(store, path: str) -> None:
+    with open(path, 'rb') as fp:
+        await store.push_bp_json_stream(fp, 'new-bp')
+
+
+async def push_batched(store, path: str) -> None:
+    with open(path, 'rb') as fp:
+        await store.push_bp_json_stream(fp, 'new-bp', batched=True)
+
+
+async def measure(store, push, path: str) -> dict:
+    """
+    Time a run, then trace the peak memory of another run as tracemalloc slows it down
+    """
+    begin = time.perf_counter()
+    await push(store, path)
+    elapsed = time.perf_counter() - begin
+    tracemalloc.start()
+    await push(store, path)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    session = store.apstra_server.session
+    return {'seconds': round(elapsed, 2), 'peak_mib': round(peak / 1024 / 1024, 1),
+            'body_mib': round((session.body_bytes + sum(session.patched)) / 1024 / 1024, 1), 'batches': len(session.patched)}
+
+
+async def run(args) -> dict:
+    session = fake_apstra.FakeApstraSession()
+    store = common.global_store
+    store.apstra = type('FakeApstraServer', (), {'apstra_server': session})()
+    with tempfile.NamedTemporaryFile(suffix='.json') as fp:
+        write_blueprint(fp, args.nodes)
+        fp.flush()
+        result = {'nodes': args.nodes, 'file_mib': round(os.path.getsize(fp.name) / 1024 / 1024, 1)}
+        result['legacy'] = await measure(store, push_legacy, fp.name)
+        result['stream'] = await measure(store, push_stream, fp.name)
+        result['batched'] = await measure(store, push_batched, fp.name)
+        if args.verify:
+            session.session.keep_body = True
+            await push_legacy(store, fp.name)
+            legacy_body = json.loads(session.session.body)
+            await push_stream(store, fp.name)
+            result['same_body'] = json.loads(session.session.body) == legacy_body
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--nodes', type=int, default=100000)
+    parser.add_argument('--verify', action='store_true', help='check the streamed body is the same as the legacy body')
+    args = parser.parse_args()
+    common.SseEvent.send = lambda self: asyncio.sleep(0)  # no /sse client
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+"""
+Measure /sse and / responsiveness while a simulated pull_config runs
+
+    python benchmarks/sse_latency.py --duration 30
+    python benchmarks/sse_latency.py --duration 30 --inline   # Apstra calls on the event loop, as before the offload layer
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+import httpx
+import uvicorn
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'src'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT_DIR)  # the static directories are relative
+
+from app import main as app_main  # noqa: E402
+from app.lib import common  # noqa: E402
+from app.lib.session_store import SESSION_COOKIE  # noqa: E402
+from app.lib.sse_hub import current_sse_hub  # noqa: E402
+import fake_apstra  # noqa: E402
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(port: int) -> uvicorn.Server:
+    server = uvicorn.Server(uvicorn.Config(app_main.app, host='127.0.0.1', port=port, log_level='warning'))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return server
+
+
+def summary(samples: list) -> dict:
+    if not samples:
+        return {}
+    samples = sorted(samples)
+    return {
+        'count': len(samples),
+        'p50_ms': round(statistics.median(samples) * 1000, 1),
+        'p95_ms': round(samples[int(len(samples) * 0.95) - 1] * 1000, 1),
+        'max_ms': round(samples[-1] * 1000, 1),
+    }
+
+
+async def probe_index(client: httpx.AsyncClient, stop: asyncio.Event, interval: float) -> list:
+    latencies = []
+    while not stop.is_set():
+        begin = time.perf_counter()
+        await client.get('/')
+        latencies.append(time.perf_counter() - begin)
+        await asyncio.sleep(interval)
+    return latencies
+
+
+async def probe_sse(server_loop: asyncio.AbstractEventLoop, hub, stop: asyncio.Event, interval: float) -> None:
+    """
+    Send a probe event stamped with the send time to the hub from the server event loop
+    """
+    async def send(event):
+        current_sse_hub.set(hub)
+        await event.send()
+
+    while not stop.is_set():
+        event = common.SseEvent(data=common.SseEventData(id='sse-probe', value=str(time.perf_counter())))
+        asyncio.run_coroutine_threadsafe(send(event), server_loop)
+        await asyncio.sleep(interval)
+
+
+async def watch_sse(client: httpx.AsyncClient, latencies: list) -> None:
+    """
+    Collect the delivery latencies of the probe events into latencies until cancelled
+    """
+    async with client.stream('GET', '/sse') as response:
+        async for line in response.aiter_lines():
+            if not line.startswith('data:') or 'sse-probe' not in line:
+                continue
+            now = time.perf_counter()
+            data = json.loads(line[len('data:'):])
+            # the batch event carries a list of { event: , data: }
+            for item in [x['data'] for x in data] if isinstance(data, list) else [data]:
+                if item['id'] == 'sse-probe':
+                    latencies.append(now - float(item['value']))
+
+
+async def run(args) -> dict:
+    session_id, store, _ = common.session_registry.get(None)
+    fake_apstra.install(store, args.duration, args.switches, args.concurrency)
+    if args.inline:
+        async def run_inline(func, *a, **kw):
+            return func(*a, **kw)
+        common.run_blocking = run_inline
+
+    port = free_port()
+    server = start_server(port)
+    server_loop = server.servers[0].get_loop()
+    stop = asyncio.Event()
+    timeout = httpx.Timeout(args.duration * 4)
+    cookies = {SESSION_COOKIE: session_id}
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=timeout, cookies=cookies) as client:
+        sse_latencies = []
+        sse_task = asyncio.create_task(watch_sse(client, sse_latencies))
+        probe_task = asyncio.create_task(probe_index(client, stop, args.interval))
+        sse_probe_task = asyncio.create_task(probe_sse(server_loop, store.sse_hub, stop, args.sse_interval))
+        begin = time.perf_counter()
+        response = await client.get('/pull-config')
+        elapsed = time.perf_counter() - begin
+        stop.set()
+        probe_latencies = await probe_task
+        await sse_probe_task
+        sse_task.cancel()
+    return {
+        'mode': 'inline' if args.inline else 'offload',
+        'pull_config_seconds': round(elapsed, 2),
+        'pull_config_bytes': len(response.content),
+        'index_latency': summary(probe_latencies),
+        'sse_latency': summary(sse_latencies),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--duration', type=float, default=30.0, help='simulated pull_config seconds')
+    parser.add_argument('--switches', type=int, default=40)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--interval', type=float, default=0.1, help='seconds between / probes')
+    parser.add_argument('--sse-interval', type=float, default=0.5, help='seconds between /sse probe events')
+    parser.add_argument('--inline', action='store_true', help='call Apstra on the event loop')
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory(prefix='sse-latency-') as work_dir:
+        # the pulls are recorded in the history, not in the one of the developer
+        common.config_history.history_dir = os.path.join(work_dir, 'history')
+        print(json.dumps(asyncio.run(run(args)), indent=2))
+
+
+if __name__ == '__main__':
+    main()
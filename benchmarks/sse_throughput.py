@@ -0,0 +1,83 @@
+"""
+Measure the SSE pipeline throughput in events per second, from SseEvent.send() to the frames handed to EventSourceResponse
+
+    python benchmarks/sse_throughput.py --events 300 --legacy   # the fixed 50 ms sleeps of the previous pipeline
+    python benchmarks/sse_throughput.py --events 100000
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'src'))
+
+from app.lib import common  # noqa: E402
+from app.lib.sse_hub import SseHub  # noqa: E402
+
+
+legacy_queue = asyncio.Queue()
+
+
+async def legacy_send(event: common.SseEvent):
+    await asyncio.sleep(0.05)
+    await legacy_queue.put({'event': event.event, 'data': json.dumps(common.asdict(event.data))})
+
+
+async def legacy_frames(is_disconnected):
+    while not await is_disconnected():
+        item = await legacy_queue.get()
+        yield item
+        legacy_queue.task_done()
+        await asyncio.sleep(0.05)
+
+
+def event_count(frame: dict) -> int:
+    return len(json.loads(frame['data'])) if frame['event'] == 'batch' else 1
+
+
+async def run(args) -> dict:
+    frames = legacy_frames if args.legacy else common.sse_frames
+    send = legacy_send if args.legacy else common.SseEvent.send
+
+    async def produce():
+        for i in range(args.events):
+            await send(common.SseEvent(data=common.SseEventData(id='event-box-text', add_text=f"line {i}\n")))
+
+    async def never_disconnected():
+        return False
+
+    # big enough for all the events, to measure the pipeline instead of the slow client drop policy
+    common.sse_hub = SseHub(subscriber_buffer=args.events)
+    begin = time.perf_counter()
+    producer = asyncio.create_task(produce())
+    received = 0
+    frame_count = 0
+    async for frame in frames(never_disconnected):
+        received += event_count(frame)
+        frame_count += 1
+        if received >= args.events:
+            break
+    elapsed = time.perf_counter() - begin
+    await producer
+    return {
+        'mode': 'legacy' if args.legacy else 'batched',
+        'events': received,
+        'frames': frame_count,
+        'seconds': round(elapsed, 3),
+        'events_per_second': round(received / elapsed, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--events', type=int, default=300)
+    parser.add_argument('--legacy', action='store_true', help='sleep 50 ms in send() and after every yielded event')
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,313 @@
+"""
+End to end benchmarks of the app, run as a uvicorn process, against the mock Apstra HTTPS server
+The results are written as JSON to compare between commits
+
+    python benchmarks/suite.py --switches 200 --latency 0.02 --output before.json
+    python benchmarks/suite.py --switches 200 --latency 0.02 --output after.json --compare before.json
+
+    pull_config        wall time of /pull-config: streamed cold, streamed from the config cache, and the temporary directory way
+    pull_bp_json       wall time and peak RSS growth of the app during /pull-bp-json
+    push_bp_json       throughput of /push-bp-json with the downloaded blueprint, in one call and batched
+    sse                events per second delivered on /sse during the cold pull
+    concurrent_users   pull time of each user and / latency while --users pull at the same time
+    apstra_connections the connections to the mock opened and reused from the pool, from /metrics
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import math
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import httpx
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fake_apstra  # noqa: E402
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def summary(samples: list) -> dict:
+    if not samples:
+        return {}
+    samples = sorted(samples)
+    return {
+        'count': len(samples),
+        'p50_ms': round(statistics.median(samples) * 1000, 1),
+        'p95_ms': round(samples[math.ceil(len(samples) * 0.95) - 1] * 1000, 1),
+        'max_ms': round(samples[-1] * 1000, 1),
+    }
+
+
+def start_app(port: int, work_dir: str) -> subprocess.Popen:
+    env = dict(os.environ)
+    # requests lets these override session.verify=False of CkApstraSession, which the self-signed mock needs
+    env.pop('REQUESTS_CA_BUNDLE', None)
+    env.pop('CURL_CA_BUNDLE', None)
+    env['APSTRA_CONFIG_CACHE_DIR'] = os.path.join(work_dir, 'config-cache')
+    env['APSTRA_JOB_DIR'] = os.path.join(work_dir, 'jobs')
+    env['APSTRA_CONFIG_HISTORY_DIR'] = os.path.join(work_dir, 'history')
+    app = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'app.main:app', '--app-dir', 'src', '--host', '127.0.0.1', '--port', str(port), '--log-level', 'warning'],
+                           cwd=ROOT_DIR, env=env)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/metrics")
+            return app
+        except httpx.TransportError:
+            time.sleep(0.1)
+    app.kill()
+    raise RuntimeError('the app did not start')
+
+
+def rss_bytes(pid: int) -> int:
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+class RssSampler:
+    """
+    Sample the RSS of the process in a thread, for the peak during a run
+    """
+    def __init__(self, pid: int, interval: float = 0.005):
+        self.pid = pid
+        self.interval = interval
+        self.baseline = rss_bytes(pid)
+        self.peak = self.baseline
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stop.is_set():
+            self.peak = max(self.peak, rss_bytes(self.pid))
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop.set()
+        self.thread.join()
+
+
+async def login(client: httpx.AsyncClient, apstra_port: int, bp_label: str) -> None:
+    form = {'host': '127.0.0.1', 'port': str(apstra_port), 'username': 'admin', 'password': 'admin'}
+    (await client.post('/login', data=form)).raise_for_status()
+    (await client.get('/login-main-bp', params={'main-bp': bp_label})).raise_for_status()
+
+
+async def count_sse(client: httpx.AsyncClient, counter: dict) -> None:
+    """
+    Count the events delivered on /sse until cancelled. A batch frame counts its events
+    """
+    async with client.stream('GET', '/sse') as response:
+        event = None
+        async for line in response.aiter_lines():
+            if line.startswith('event:'):
+                event = line[len('event:'):].strip()
+            elif line.startswith('data:'):
+                counter['events'] += len(json.loads(line[len('data:'):])) if event == 'batch' else 1
+
+
+async def timed_get(client: httpx.AsyncClient, url: str, **params) -> tuple:
+    begin = time.perf_counter()
+    response = await client.get(url, params=params)
+    response.raise_for_status()
+    return time.perf_counter() - begin, len(response.content)
+
+
+async def bench_pull_config(client: httpx.AsyncClient) -> dict:
+    counter = {'events': 0}
+    sse_task = asyncio.create_task(count_sse(client, counter))
+    await asyncio.sleep(0.2)
+    counter['events'] = 0
+    cold_seconds, size = await timed_get(client, '/pull-config', stream='true', refresh='true')
+    events = counter['events']
+    sse_task.cancel()
+    cached_seconds, _ = await timed_get(client, '/pull-config', stream='true')
+    tempdir_seconds, _ = await timed_get(client, '/pull-config', refresh='true')
+    return {
+        'pull_config': {
+            'stream_cold_seconds': round(cold_seconds, 3),
+            'stream_cached_seconds': round(cached_seconds, 3),
+            'tempdir_seconds': round(tempdir_seconds, 3),
+            'archive_bytes': size,
+        },
+        'sse': {'events': events, 'events_per_second': round(events / cold_seconds, 1)},
+    }
+
+
+async def bench_pull_bp_json(client: httpx.AsyncClient, app_pid: int, json_file: str) -> dict:
+    size = 0
+    with RssSampler(app_pid) as sampler:
+        begin = time.perf_counter()
+        async with client.stream('GET', '/pull-bp-json') as response:
+            with open(json_file, 'wb') as f:
+                async for chunk in response.aiter_bytes():
+                    f.write(chunk)
+                    size += len(chunk)
+        seconds = time.perf_counter() - begin
+    return {
+        'seconds': round(seconds, 3),
+        'bytes': size,
+        'mb_per_second': round(size / seconds / 1e6, 2),
+        'peak_rss_growth_mb': round((sampler.peak - sampler.baseline) / 1e6, 2),
+    }
+
+
+async def bench_push_bp_json(client: httpx.AsyncClient, app_pid: int, json_file: str, fabric: fake_apstra.FakeFabric, batched: bool = False) -> dict:
+    size = os.path.getsize(json_file)
+    patched = len(fabric.patched)
+    with RssSampler(app_pid) as sampler, open(json_file, 'rb') as f:
+        begin = time.perf_counter()
+        (await client.post('/push-bp-json', params={'batched': str(batched).lower()}, files={'file': ('pushed-bp.json', f, 'application/json')})).raise_for_status()
+        seconds = time.perf_counter() - begin
+    return {
+        'seconds': round(seconds, 3),
+        'bytes': size,
+        'mb_per_second': round(size / seconds / 1e6, 2),
+        'sent_to_apstra_bytes': (fabric.created[-1] if fabric.created else 0) + sum(fabric.patched[patched:]),
+        'batches': len(fabric.patched) - patched,
+        'peak_rss_growth_mb': round((sampler.peak - sampler.baseline) / 1e6, 2),
+    }
+
+
+async def bench_concurrent_users(base_url: str, apstra_port: int, users: int, blueprints: int, timeout: httpx.Timeout) -> dict:
+    clients = [httpx.AsyncClient(base_url=base_url, timeout=timeout) for _ in range(users)]
+    try:
+        await asyncio.gather(*[login(client, apstra_port, f"bp-{i % blueprints}") for i, client in enumerate(clients)])
+        stop = asyncio.Event()
+        index_latencies = []
+
+        async def probe_index():
+            async with httpx.AsyncClient(base_url=base_url, timeout=timeout) as probe:
+                while not stop.is_set():
+                    begin = time.perf_counter()
+                    await probe.get('/')
+                    index_latencies.append(time.perf_counter() - begin)
+                    await asyncio.sleep(0.05)
+
+        probe_task = asyncio.create_task(probe_index())
+        begin = time.perf_counter()
+        pulls = await asyncio.gather(*[timed_get(client, '/pull-config', stream='true', refresh='true') for client in clients])
+        seconds = time.perf_counter() - begin
+        stop.set()
+        await probe_task
+    finally:
+        for client in clients:
+            await client.aclose()
+    return {
+        'users': users,
+        'seconds': round(seconds, 3),
+        'pull_latency': summary([x[0] for x in pulls]),
+        'index_latency': summary(index_latencies),
+    }
+
+
+async def scrape_connections(client: httpx.AsyncClient) -> dict:
+    counts = {}
+    for line in (await client.get('/metrics')).text.splitlines():
+        if line.startswith('apstra_web_apstra_connections_total{'):
+            counts[line.split('"')[1]] = int(float(line.split()[-1]))
+    return counts
+
+
+async def run(args) -> dict:
+    fabric = fake_apstra.fabric_from_args(args)
+    apstra = fake_apstra.start_server(fabric)
+    apstra_port = apstra.server_address[1]
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    timeout = httpx.Timeout(args.timeout)
+    with tempfile.TemporaryDirectory() as work_dir:
+        app = start_app(port, work_dir)
+        try:
+            results = {}
+            async with httpx.AsyncClient(base_url=base_url, timeout=timeout) as client:
+                await login(client, apstra_port, 'bp-0')
+                results.update(await bench_pull_config(client))
+                json_file = os.path.join(work_dir, 'bp-0.json')
+                results['pull_bp_json'] = await bench_pull_bp_json(client, app.pid, json_file)
+                results['push_bp_json'] = await bench_push_bp_json(client, app.pid, json_file, fabric)
+                results['push_bp_json_batched'] = await bench_push_bp_json(client, app.pid, json_file, fabric, batched=True)
+            results['concurrent_users'] = await bench_concurrent_users(base_url, apstra_port, args.users, args.blueprints, timeout)
+            async with httpx.AsyncClient(base_url=base_url, timeout=timeout) as client:
+                results['apstra_connections'] = await scrape_connections(client)
+        finally:
+            app.terminate()
+            app.wait()
+            apstra.shutdown()
+    return results
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ''
+
+
+def flatten(results: dict, prefix: str = '') -> dict:
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)):
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+def compare(previous: dict, current: dict) -> None:
+    """
+    Print the change of each number from the previous results
+    """
+    before, after = flatten(previous['results']), flatten(current['results'])
+    print(f"{'metric':50} {previous.get('commit', ''):>12} {current.get('commit', ''):>12} {'change':>8}")
+    for key, value in after.items():
+        if key in before:
+            change = f"{(value - before[key]) / before[key] * 100:+.1f}%" if before[key] else ''
+            print(f"{key:50} {before[key]:>12} {value:>12} {change:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    fake_apstra.add_fabric_arguments(parser)
+    parser.add_argument('--users', type=int, default=4, help='users pulling at the same time')
+    parser.add_argument('--timeout', type=float, default=600.0, help='seconds for a request')
+    parser.add_argument('--output', default='benchmark-results.json')
+    parser.add_argument('--compare', help='results json of a previous run')
+    args = parser.parse_args()
+
+    current = {
+        'commit': git_commit(),
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'args': vars(args),
+        'results': asyncio.run(run(args)),
+    }
+    with open(args.output, 'w') as f:
+        json.dump(current, f, indent=2)
+    print(json.dumps(current['results'], indent=2))
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), current)
+
+
+if __name__ == '__main__':
+    main()
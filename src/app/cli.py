@@ -0,0 +1,120 @@
+"""
+Pull the device configurations or the blueprint json of the blueprints to the files, without the web server
+The Apstra server comes from the env json of /upload-env-json
+
+    run-pull --env env.json config bp-1 bp-2 --output-dir backups --concurrency 16
+    run-pull --env env.json bp-json all --gzip
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+from typing import List, Optional
+
+from app.lib.common import GlobalStore, new_global_store
+from app.lib.metrics import Timings, current_timings
+from app.lib.sse_hub import current_sse_hub
+
+logger = logging.getLogger('run-pull')
+
+
+async def write_file(path: str, chunks) -> int:
+    """
+    Write the chunks to the path through a temporary file, so that a failed pull leaves the previous file. Return the size
+    """
+    size = 0
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(temp_path, 'wb') as f:
+            async for chunk in chunks:
+                f.write(chunk)
+                size += len(chunk)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return size
+
+
+async def pull_blueprint(store: GlobalStore, args, bp_label: str) -> None:
+    begin = time.perf_counter()
+    await store.login_blueprint(bp_label)
+    if args.what == 'config':
+        file_name = f"{bp_label}-delta.tgz" if args.delta else f"{bp_label}.tgz"
+        chunks = store.pull_config_stream(args.concurrency, args.refresh, bp_label, args.delta)
+    else:
+        file_name, chunks = await store.pull_bp_json(args.gzip, bp_label)
+    path = os.path.join(args.output_dir, file_name)
+    size = await write_file(path, chunks)
+    print(f"{path} {size} bytes in {time.perf_counter() - begin:.3f}s")
+
+
+async def run(args) -> int:
+    # no SSE events without the web sessions
+    current_sse_hub.set(None)
+    timings = Timings()
+    current_timings.set(timings)
+
+    with open(args.env) as f:
+        file_dict = json.load(f)
+    store = new_global_store()
+    await store.post_init(file_dict)
+    if args.concurrency:
+        store.fetch_concurrency = args.concurrency
+    apstra = store.apstra
+    version, error = await store.login_server(apstra.host, apstra.port, apstra.username, apstra.password)
+    if error:
+        print(f"login to {apstra.host} failed: {error}", file=sys.stderr)
+        return 1
+
+    bp_labels: List[str] = args.blueprints
+    if bp_labels == ['all']:
+        bp_labels = list(await store.apstra.bp_catalog.get())
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    semaphore = asyncio.Semaphore(max(1, args.parallel))
+    failed = 0
+
+    async def pull(bp_label: str):
+        nonlocal failed
+        async with semaphore:
+            try:
+                await pull_blueprint(store, args, bp_label)
+            except Exception as e:
+                failed += 1
+                logger.info(f"pull {bp_label} failed", exc_info=True)
+                print(f"{bp_label} failed: {e!r}", file=sys.stderr)
+
+    await asyncio.gather(*[pull(x) for x in bp_labels])
+    if args.timings:
+        print(timings.summary())
+    return 1 if failed else 0
+
+
+def parse_args(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(prog='run-pull', description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('what', choices=['config', 'bp-json'], help='the device configurations as <bp_label>.tgz, or the blueprint json')
+    parser.add_argument('blueprints', nargs='+', help="the blueprint labels, or all")
+    parser.add_argument('--env', required=True, help='the env json file, as /upload-env-json')
+    parser.add_argument('--output-dir', default='.', help='the directory of the files')
+    parser.add_argument('--concurrency', type=int, help='the switches fetched at the same time. fetch_concurrency of the env json by default')
+    parser.add_argument('--parallel', type=int, default=1, help='the blueprints pulled at the same time')
+    parser.add_argument('--refresh', action='store_true', help='fetch all the switches instead of taking the unchanged ones from the config cache')
+    parser.add_argument('--delta', action='store_true', help='only the switches changed from the last pull, as <bp_label>-delta.tgz')
+    parser.add_argument('--gzip', action='store_true', help='compress the blueprint json')
+    parser.add_argument('--timings', action='store_true', help='print the time of the stages and the Apstra calls')
+    parser.add_argument('--verbose', action='store_true', help='log the progress')
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.ERROR)
+    sys.exit(asyncio.run(run(args)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+from dataclasses import dataclass, field
+import asyncio
+import logging
+import os
+import time
+from typing import Any, Dict, List, Optional
+
+from ck_apstra_api.apstra_blueprint import CkApstraBlueprint
+
+from app.lib.metrics import span
+from app.lib.offload import run_blocking
+
+# the seconds the blueprint list of a login is served before it is refreshed in the background. 0 to fetch it every time
+BP_CATALOG_TTL = float(os.getenv('APSTRA_BP_CATALOG_TTL', '60'))
+# the blueprints whose switches are counted at the same time
+BP_CATALOG_CONCURRENCY = int(os.getenv('APSTRA_BP_CATALOG_CONCURRENCY', '8'))
+# the switch counts in the blueprint list of Apstra. the switches are queried when the list has none of them
+SWITCH_COUNT_KEYS = ('superspine_count', 'spine_count', 'leaf_count', 'access_count')
+SWITCH_COUNT_QUERY = "node('system', system_type='switch', name='switch')"
+
+
+def blueprint_handle(session: Any, item: dict) -> CkApstraBlueprint:
+    """
+    The CkApstraBlueprint of an item of the blueprint list, without the lookup calls of its constructor
+    """
+    the_bp = CkApstraBlueprint.__new__(CkApstraBlueprint)
+    the_bp.session = session
+    the_bp.label = item['label']
+    the_bp.id = item['id']
+    the_bp.design = item.get('design')
+    the_bp.logger = logging.getLogger(f"CkApstraBlueprint({the_bp.label})")
+    the_bp.url_prefix = f"{session.url_prefix}/blueprints/{the_bp.id}"
+    the_bp.system_label_2_id_cache = {}
+    the_bp.system_id_2_label_cache = {}
+    return the_bp
+
+
+def listed_switch_count(item: dict) -> Optional[int]:
+    """
+    The switches of the blueprint from its item of the list, None when the list doesn't count them
+    """
+    counts = [item[x] for x in SWITCH_COUNT_KEYS if isinstance(item.get(x), int)]
+    return sum(counts) if counts else None
+
+
+@dataclass
+class CatalogEntry:
+    handle: Any  # CkApstraBlueprint
+    version: Any
+    switch_count: Optional[int] = None  # None until counted
+
+    def summary(self) -> dict:
+        return {'label': self.handle.label, 'id': self.handle.id, 'design': self.handle.design,
+                'version': self.version, 'switch_count': self.switch_count}
+
+
+@dataclass
+class BlueprintCatalog:
+    """
+    The blueprints of a login by label, each with a CkApstraBlueprint built from the list, its design and switch count
+    The list is fetched in the background after the login and served for ttl seconds. After that, the stale list is
+    served while it is fetched again in the background. The switches are counted after the list, not waited for
+    """
+    session: Any  # CkApstraSession
+    ttl: float = BP_CATALOG_TTL
+    concurrency: int = BP_CATALOG_CONCURRENCY
+    entries: Dict[str, CatalogEntry] = field(default_factory=dict)
+    fetched: float = 0.0  # time.monotonic() of the list. 0 before the first
+    refreshing: Optional[asyncio.Task] = field(default=None, repr=False)
+    counting: Optional[asyncio.Task] = field(default=None, repr=False)
+    logger: Any = logging.getLogger('BlueprintCatalog')
+
+    @property
+    def fresh(self) -> bool:
+        return self.fetched > 0 and time.monotonic() - self.fetched < self.ttl
+
+    def warm_up(self) -> Optional[asyncio.Task]:
+        """
+        Fetch the list in the background unless it is fresh or being fetched. Return the task of the fetch
+        """
+        if self.refreshing is None and not self.fresh:
+            self.refreshing = asyncio.create_task(self.refresh())
+            self.refreshing.add_done_callback(self.refreshed)
+        return self.refreshing
+
+    def refreshed(self, task: asyncio.Task) -> None:
+        self.refreshing = None
+        if not task.cancelled() and task.exception():
+            self.logger.warning(f"refreshed(): {task.exception()=}")
+
+    async def get(self) -> Dict[str, CatalogEntry]:
+        """
+        The entries by label. Wait for the list only when there is none yet, or with the ttl 0
+        Raise the error of the list call then
+        """
+        task = self.warm_up()
+        if task is not None and (self.fetched == 0 or self.ttl <= 0):
+            await asyncio.shield(task)
+        return self.entries
+
+    async def refresh(self) -> None:
+        with span('blueprint-list'):
+            blueprints = await run_blocking(self.session.get_items, 'blueprints')
+        self.update(blueprints.get('items', []))
+
+    def update(self, items: List[dict]) -> None:
+        """
+        Take the blueprint list. The handles of the same blueprints are kept, and the switches of the new or changed
+        ones are counted in the background
+        """
+        entries = {}
+        for item in items:
+            entry = self.entries.get(item['label'])
+            if entry is None or entry.handle.id != item['id']:
+                entry = CatalogEntry(blueprint_handle(self.session, item), item.get('version'))
+            elif entry.version != item.get('version'):
+                entry = CatalogEntry(entry.handle, item.get('version'))
+            entry.handle.design = item.get('design', entry.handle.design)
+            entry.switch_count = listed_switch_count(item) if entry.switch_count is None else entry.switch_count
+            entries[item['label']] = entry
+        self.entries, self.fetched = entries, time.monotonic()
+        uncounted = [x for x in entries.values() if x.switch_count is None]
+        self.logger.info(f"update() {len(entries)=} {len(uncounted)=}")
+        if uncounted and self.counting is None:
+            self.counting = asyncio.create_task(self.count_switches(uncounted))
+            self.counting.add_done_callback(self.counted)
+
+    def counted(self, task: asyncio.Task) -> None:
+        self.counting = None
+
+    async def count_switches(self, entries: List[CatalogEntry]) -> None:
+        """
+        Query the switches of the blueprints, concurrency at a time. A failed count stays None, to count at the next update
+        """
+        semaphore = asyncio.Semaphore(max(1, self.concurrency))
+
+        async def count(entry: CatalogEntry):
+            async with semaphore:
+                try:
+                    with span('bp-switch-count'):
+                        entry.switch_count = len(await run_blocking(entry.handle.query, SWITCH_COUNT_QUERY))
+                except Exception as e:
+                    self.logger.warning(f"count_switches(): {entry.handle.label=} {e=}")
+
+        await asyncio.gather(*[count(x) for x in entries])
@@ -0,0 +1,156 @@
+from hashlib import blake2b
+import json
+from typing import Any, Callable, Collection, Dict, Iterator, List, Optional, Tuple
+
+from app.lib.bp_graph import BlueprintGraph
+from app.lib.json_stream import iter_json_entries
+
+# the size of the chunks of the ndjson lines
+DIFF_CHUNK_SIZE = 64 * 1024
+
+_MAPS = ('nodes', 'relationships')
+_KINDS = {'nodes': 'node', 'relationships': 'relationship'}
+
+# sorted keys, for the same text of the same properties
+_CANONICAL = json.JSONEncoder(sort_keys=True, separators=(',', ':'), default=str)
+
+Entries = Iterator[Tuple[str, Optional[str], Any]]  # the entries of iter_json_entries
+
+
+def file_entries(fp: Any) -> Callable[[], Entries]:
+    """
+    The entries of the blueprint json file, from the beginning on each call
+    """
+    def entries() -> Entries:
+        fp.seek(0)
+        return iter_json_entries(fp)
+    return entries
+
+
+def graph_entries(graph: BlueprintGraph) -> Callable[[], Entries]:
+    """
+    The entries of the graph snapshot, in the same form as the file
+    """
+    def entries() -> Entries:
+        yield 'version', None, graph.version
+        for key, items in (('nodes', graph.nodes), ('relationships', graph.relationships)):
+            yield from ((key, item_id, value) for item_id, value in items.items())
+    return entries
+
+
+def _without(value: Any, ignore: Collection[str]) -> Any:
+    if ignore and isinstance(value, dict):
+        return {k: v for k, v in value.items() if k not in ignore}
+    return value
+
+
+def entry_digest(value: Any, ignore: Collection[str] = ()) -> bytes:
+    """
+    The hash of the properties of a node or a relationship, independent of the key order
+    """
+    return blake2b(_CANONICAL.encode(_without(value, ignore)).encode('utf-8'), digest_size=8).digest()
+
+
+def changed_fields(old: Any, new: Any, ignore: Collection[str] = ()) -> Dict[str, Dict[str, Any]]:
+    """
+    { field: { 'old': value, 'new': value } } of the fields that differ. A missing field is None
+    """
+    old, new = _without(old, ignore), _without(new, ignore)
+    if not isinstance(old, dict) or not isinstance(new, dict):
+        return {'': {'old': old, 'new': new}}
+    return {k: {'old': old.get(k), 'new': new.get(k)} for k in sorted(old.keys() | new.keys()) if old.get(k) != new.get(k)}
+
+
+def index_entries(entries: Entries, ignore: Collection[str] = ()) -> Tuple[Dict[str, Dict[str, bytes]], Dict[str, Any]]:
+    """
+    ({ 'nodes': { id: digest }, 'relationships': { id: digest } }, { top level key: value }) of the document
+    Only the digests are kept of the nodes and the relationships
+    """
+    digests = {key: {} for key in _MAPS}
+    top = {}
+    for key, sub_key, value in entries:
+        if key in _MAPS:
+            if sub_key is not None:
+                digests[key][sub_key] = entry_digest(value, ignore)
+        else:
+            top[key] = value
+    return digests, top
+
+
+def _line(record: dict) -> str:
+    return json.dumps(record, default=str) + '\n'
+
+
+def iter_bp_diff(base: Callable[[], Entries], target: Callable[[], Entries], ignore: Collection[str] = (), chunk_size: int = DIFF_CHUNK_SIZE) -> Iterator[bytes]:
+    """
+    Yield the differences from the base to the target blueprint as ndjson lines, in chunks. Blocking
+        { "op": "added", "kind": "node", "id": ..., "value": {...} }
+        { "op": "removed", "kind": "relationship", "id": ..., "type": ..., "label": ... }
+        { "op": "changed", "kind": "node", "id": ..., "type": ..., "fields": { field: { "old": ..., "new": ... } } }
+        { "op": "changed", "kind": "blueprint", "fields": ... } for the top level values of both like the version
+        { "op": "summary", "nodes": { "added": n, "removed": n, "changed": n }, "relationships": ... } at the end
+    The base is indexed by the hashes of the entries, the target is compared as it is read, and the base is read again
+    for the old values of the changed and the removed entries. Only the target values of the changed entries are kept
+    """
+    base_digests, base_top = index_entries(base(), ignore)
+    counts = {key: {'added': 0, 'removed': 0, 'changed': 0} for key in _MAPS}
+    changed: Dict[str, Dict[str, Any]] = {key: {} for key in _MAPS}  # the target values
+    target_top = {}
+    parts: List[str] = []
+    size = 0
+
+    def emit(record: dict) -> Optional[bytes]:
+        nonlocal parts, size
+        line = _line(record)
+        parts.append(line)
+        size += len(line)
+        if size < chunk_size:
+            return None
+        chunk = ''.join(parts).encode('utf-8')
+        parts, size = [], 0
+        return chunk
+
+    for key, sub_key, value in target():
+        if key not in _MAPS:
+            target_top[key] = value
+            continue
+        if sub_key is None:
+            continue
+        digest = base_digests[key].pop(sub_key, None)
+        if digest is None:
+            counts[key]['added'] += 1
+            chunk = emit({'op': 'added', 'kind': _KINDS[key], 'id': sub_key, 'value': value})
+        elif digest != entry_digest(value, ignore):
+            changed[key][sub_key] = value
+            chunk = None
+        else:
+            chunk = None
+        if chunk:
+            yield chunk
+
+    # the base digests left are the removed entries
+    if any(base_digests.values()) or any(changed.values()):
+        for key, sub_key, value in base():
+            if key not in _MAPS or sub_key is None:
+                continue
+            if sub_key in base_digests[key]:
+                counts[key]['removed'] += 1
+                value = value if isinstance(value, dict) else {}
+                chunk = emit({'op': 'removed', 'kind': _KINDS[key], 'id': sub_key, 'type': value.get('type'), 'label': value.get('label')})
+            elif sub_key in changed[key]:
+                new = changed[key].pop(sub_key)
+                counts[key]['changed'] += 1
+                chunk = emit({'op': 'changed', 'kind': _KINDS[key], 'id': sub_key, 'type': (new if isinstance(new, dict) else {}).get('type'),
+                              'fields': changed_fields(value, new, ignore)})
+            else:
+                chunk = None
+            if chunk:
+                yield chunk
+
+    # a graph snapshot has only the version of the top level values
+    common_keys = base_top.keys() & target_top.keys()
+    top_fields = changed_fields({k: base_top[k] for k in common_keys}, {k: target_top[k] for k in common_keys}, ignore)
+    if top_fields:
+        emit({'op': 'changed', 'kind': 'blueprint', 'fields': top_fields})
+    emit({'op': 'summary', **counts})
+    yield ''.join(parts).encode('utf-8')
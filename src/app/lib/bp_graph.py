@@ -0,0 +1,158 @@
+from collections import OrderedDict
+from dataclasses import dataclass, field
+import asyncio
+import logging
+import os
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from app.lib.json_stream import iter_json_entries
+
+# the blueprint graphs kept in memory, the least recently used is dropped. 0 to query Apstra every time
+GRAPH_SNAPSHOTS = int(os.getenv('APSTRA_GRAPH_SNAPSHOTS', '4'))
+
+# the system_type of the switches of SWITCH_QUERY. switch for reference architecture, internal for freeform
+SWITCH_SYSTEM_TYPES = ('switch', 'internal')
+
+_Edges = Dict[str, Dict[str, List[Tuple[str, str]]]]  # { rel_type: { node_id: [ (peer_id, rel_id) ] } }
+
+
+@dataclass
+class BlueprintGraph:
+    """
+    In-memory copy of the blueprint graph from the dump, with the indexes for the local traversals
+    """
+    version: Any
+    nodes: Dict[str, dict] = field(default_factory=dict)
+    relationships: Dict[str, dict] = field(default_factory=dict)
+    by_type: Dict[str, List[str]] = field(default_factory=dict)
+    by_role: Dict[str, List[str]] = field(default_factory=dict)
+    by_label: Dict[str, List[str]] = field(default_factory=dict)
+    out_edges: _Edges = field(default_factory=dict)  # from source_id
+    in_edges: _Edges = field(default_factory=dict)  # from target_id
+
+    @classmethod
+    def from_entries(cls, entries: Iterable[Tuple[str, Optional[str], Any]], version: Any) -> 'BlueprintGraph':
+        """
+        Build from the entries of iter_json_entries over the blueprint dump
+        """
+        graph = cls(version)
+        for key, sub_key, value in entries:
+            if sub_key is None:
+                continue
+            if key == 'nodes':
+                graph.add_node(value)
+            elif key == 'relationships':
+                graph.add_relationship(value)
+        return graph
+
+    def add_node(self, node: dict) -> None:
+        node_id = node['id']
+        self.nodes[node_id] = node
+        self.by_type.setdefault(node.get('type'), []).append(node_id)
+        if node.get('role') is not None:
+            self.by_role.setdefault(node['role'], []).append(node_id)
+        if node.get('label') is not None:
+            self.by_label.setdefault(node['label'], []).append(node_id)
+
+    def add_relationship(self, rel: dict) -> None:
+        rel_id, rel_type = rel['id'], rel.get('type')
+        self.relationships[rel_id] = rel
+        self.out_edges.setdefault(rel_type, {}).setdefault(rel['source_id'], []).append((rel['target_id'], rel_id))
+        self.in_edges.setdefault(rel_type, {}).setdefault(rel['target_id'], []).append((rel['source_id'], rel_id))
+
+    def node(self, node_id: str) -> Optional[dict]:
+        return self.nodes.get(node_id)
+
+    def find(self, type: Optional[str] = None, role: Optional[str] = None, label: Optional[str] = None, **properties) -> Iterator[dict]:
+        """
+        Yield the nodes matching all the given values, starting from the smallest index
+        """
+        candidates = [index[value] for index, value in ((self.by_type, type), (self.by_role, role), (self.by_label, label)) if value is not None]
+        node_ids = min(candidates, key=len) if candidates else self.nodes.keys()
+        for node_id in node_ids:
+            node = self.nodes[node_id]
+            if ((type is None or node.get('type') == type) and (role is None or node.get('role') == role)
+                    and (label is None or node.get('label') == label)
+                    and all(node.get(k) == v for k, v in properties.items())):
+                yield node
+
+    def out_nodes(self, node_id: str, rel_type: str, type: Optional[str] = None) -> List[dict]:
+        """
+        The targets of the rel_type relationships from the node, of the type if given
+        """
+        return [self.nodes[x] for x, _ in self.out_edges.get(rel_type, {}).get(node_id, ()) if x in self.nodes and (type is None or self.nodes[x].get('type') == type)]
+
+    def in_nodes(self, node_id: str, rel_type: str, type: Optional[str] = None) -> List[dict]:
+        """
+        The sources of the rel_type relationships to the node, of the type if given
+        """
+        return [self.nodes[x] for x, _ in self.in_edges.get(rel_type, {}).get(node_id, ()) if x in self.nodes and (type is None or self.nodes[x].get('type') == type)]
+
+    def switches(self) -> List[dict]:
+        """
+        The switch nodes, the same as the items of SWITCH_QUERY: [ { 'switch': node } ]
+        """
+        return [{'switch': x} for x in self.find(type='system') if x.get('system_type') in SWITCH_SYSTEM_TYPES]
+
+
+def load_graph(apstra_server: Any, bp_id: str, version: Any) -> BlueprintGraph:
+    """
+    Fetch the blueprint dump from Apstra and build the graph, parsing the response as it comes. Blocking
+    """
+    # the same url as CkApstraBlueprint.dump()
+    with apstra_server.session.get(f"{apstra_server.url_prefix}/blueprints/{bp_id}", stream=True) as response:
+        response.raw.decode_content = True
+        return BlueprintGraph.from_entries(iter_json_entries(response.raw), version)
+
+
+@dataclass
+class GraphSnapshots:
+    """
+    The blueprint graphs by (server url, blueprint id), valid while the blueprint version is the same
+    """
+    max_snapshots: int = GRAPH_SNAPSHOTS
+    graphs: 'OrderedDict[Tuple[str, str], BlueprintGraph]' = field(default_factory=OrderedDict)
+    locks: Dict[Tuple[str, str], asyncio.Lock] = field(default_factory=dict)
+    hits: int = 0
+    misses: int = 0
+    logger: Any = logging.getLogger('GraphSnapshots')
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_snapshots > 0
+
+    def cached(self, apstra_server: Any, bp_id: str, version: Any) -> Optional[BlueprintGraph]:
+        """
+        Return the graph of the blueprint version if it is loaded, without loading it
+        """
+        key = (apstra_server.url_prefix, bp_id)
+        graph = self.graphs.get(key)
+        if graph is None or graph.version != version:
+            return None
+        self.graphs.move_to_end(key)
+        self.hits += 1
+        return graph
+
+    async def get(self, apstra_server: Any, bp_id: str, version: Any, run_blocking) -> BlueprintGraph:
+        """
+        Return the graph of the blueprint version, loading it with run_blocking(load_graph, ...) when missing or stale
+        The pulls of the same blueprint wait for one load
+        """
+        key = (apstra_server.url_prefix, bp_id)
+        async with self.locks.setdefault(key, asyncio.Lock()):
+            graph = self.graphs.get(key)
+            if graph is not None and graph.version == version:
+                self.graphs.move_to_end(key)
+                self.hits += 1
+                return graph
+            self.misses += 1
+            self.graphs.pop(key, None)
+            graph = await run_blocking(load_graph, apstra_server, bp_id, version)
+            self.graphs[key] = graph
+            while len(self.graphs) > self.max_snapshots:
+                self.graphs.popitem(last=False)
+            self.logger.info(f"get() loaded {bp_id=} {version=} {len(graph.nodes)=} {len(graph.relationships)=}")
+            return graph
+
+
+graph_snapshots = GraphSnapshots()
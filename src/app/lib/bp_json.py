@@ -0,0 +1,109 @@
+import json
+import zlib
+from typing import Any, BinaryIO, Dict, Iterable, Iterator
+
+from app.lib.json_stream import iter_json_entries
+
+# the size of the request body chunks sent to Apstra
+BP_BODY_CHUNK_SIZE = 256 * 1024
+
+
+def rewrite_node(node_dict: Dict[str, Any], new_bp_name: str) -> Dict[str, Any]:
+    """
+    Prepare a node of the blueprint json to create a new blueprint
+    """
+    if node_dict['type'] == 'system' and node_dict['system_type'] == 'switch' and node_dict['role'] != 'external_router':
+        node_dict['system_id'] = None
+        # node_dict['deploy_mode'] = 'undeploy'
+    if node_dict['type'] == 'metadata':
+        node_dict['label'] = new_bp_name
+    for k, v in node_dict.items():
+        if k == 'tags':
+            if v is None or v == "['null']":
+                node_dict[k] = []
+        elif k == 'property_set' and v is None:
+            node_dict.update({
+                k: {}
+            })
+    return node_dict
+
+
+def iter_bp_spec(fp: BinaryIO, new_bp_name: str, chunk_size: int = BP_BODY_CHUNK_SIZE) -> Iterator[bytes]:
+    """
+    Yield the body of post('blueprints') in chunks out of the blueprint json file, in one pass
+    The nodes and the relationships maps of the file become the lists of the body, rewriting the nodes on the way
+    The design and the label go at the end of the body, as the design comes after the nodes in the dump
+    """
+    parts = ['{']
+    size = 0
+    current_key = None
+    design = None
+    for key, sub_key, value in iter_json_entries(fp):
+        if key == 'design' and sub_key is None:
+            design = value
+        if key not in ('nodes', 'relationships'):
+            continue
+        if key != current_key:
+            parts.append(f'{"], " if current_key else ""}"{key}": [')
+            current_key = key
+            if sub_key is None:
+                # the empty map
+                continue
+        else:
+            parts.append(', ')
+        item = json.dumps(rewrite_node(value, new_bp_name) if key == 'nodes' else value)
+        parts.append(item)
+        size += len(item)
+        if size >= chunk_size:
+            yield ''.join(parts).encode('utf-8')
+            parts = []
+            size = 0
+    if current_key:
+        parts.append('], ')
+    tail = {'design': design, 'label': new_bp_name, 'init_type': 'explicit'}
+    parts.append(json.dumps(tail)[1:])
+    yield ''.join(parts).encode('utf-8')
+
+
+def iter_bp_dump(fp: BinaryIO, chunk_size: int = BP_BODY_CHUNK_SIZE) -> Iterator[bytes]:
+    """
+    Yield the blueprint json of the file in chunks, one node or relationship at a time
+    The output is the same as json.dumps() of the loaded blueprint
+    """
+    parts = ['{']
+    size = 0
+    current_key = None
+    first_key = True
+    for key, sub_key, value in iter_json_entries(fp):
+        if current_key and key != current_key:
+            parts.append('}')
+            current_key = None
+        if sub_key is None:
+            parts.append(f"{'' if first_key else ', '}{json.dumps(key)}: {json.dumps(value)}")
+        elif key != current_key:
+            parts.append(f"{'' if first_key else ', '}{json.dumps(key)}: {{{json.dumps(sub_key)}: {json.dumps(value)}")
+            current_key = key
+        else:
+            parts.append(f", {json.dumps(sub_key)}: {json.dumps(value)}")
+        first_key = False
+        size += len(parts[-1])
+        if size >= chunk_size:
+            yield ''.join(parts).encode('utf-8')
+            parts = []
+            size = 0
+    if current_key:
+        parts.append('}')
+    parts.append('}')
+    yield ''.join(parts).encode('utf-8')
+
+
+def gzip_chunks(chunks: Iterable[bytes], level: int = 6) -> Iterator[bytes]:
+    """
+    Compress the chunks into a gzip stream
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
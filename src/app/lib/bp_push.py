@@ -0,0 +1,283 @@
+from dataclasses import dataclass, field
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Awaitable, BinaryIO, Callable, Dict, Iterator, List, Optional, Tuple
+
+import requests
+
+from app.lib.bp_json import iter_bp_spec, rewrite_node
+from app.lib.json_stream import iter_json_entries
+from app.lib.metrics import count_bytes_blocking, span
+from app.lib.offload import iterate_blocking, run_blocking
+
+# the size of the json of a batch of the batched push
+PUSH_BATCH_BYTES = int(os.getenv('APSTRA_PUSH_BATCH_BYTES', str(4 * 1024 * 1024)))
+
+# the batches sent to Apstra at the same time
+PUSH_CONCURRENCY = int(os.getenv('APSTRA_PUSH_CONCURRENCY', '4'))
+
+# the retries of a failed batch, after PUSH_BACKOFF seconds doubled on each retry
+PUSH_RETRIES = int(os.getenv('APSTRA_PUSH_RETRIES', '3'))
+PUSH_BACKOFF = float(os.getenv('APSTRA_PUSH_BACKOFF', '0.5'))
+
+# the status codes of a batch worth retrying. 409: a concurrent batch changed the blueprint version first
+RETRY_STATUS_CODES = (409, 429, 500, 502, 503, 504)
+
+# the validation errors listed, the rest are counted
+MAX_VALIDATION_ERRORS = 20
+
+
+class BpPushError(Exception):
+    """
+    The push stopped: the json is not valid, or Apstra refused the blueprint or a batch
+    """
+
+
+@dataclass
+class BpJsonSummary:
+    design: Optional[str] = None
+    nodes: int = 0
+    relationships: int = 0
+    errors: List[str] = field(default_factory=list)
+    error_count: int = 0
+
+    def add_error(self, text: str) -> None:
+        self.error_count += 1
+        if len(self.errors) < MAX_VALIDATION_ERRORS:
+            self.errors.append(text)
+
+    def error_text(self) -> str:
+        more = self.error_count - len(self.errors)
+        return '\n'.join(self.errors + ([f"... and {more} more"] if more else []))
+
+
+def validate_bp_json(fp: BinaryIO) -> BpJsonSummary:
+    """
+    Check the blueprint json of the file in one pass without loading it:
+    the design, the node types, the duplicate ids and the relationships to the missing nodes. Blocking
+    """
+    summary = BpJsonSummary()
+    node_ids = set()
+    relationship_ids = set()
+    endpoints: List[Tuple[str, Any, Any]] = []  # (rel_id, source_id, target_id), checked after all the nodes
+    fp.seek(0)
+    try:
+        for key, sub_key, value in iter_json_entries(fp):
+            if key == 'design' and sub_key is None:
+                summary.design = value
+            if sub_key is None or key not in ('nodes', 'relationships'):
+                continue
+            if not isinstance(value, dict):
+                summary.add_error(f"{key} {sub_key}: not an object")
+                continue
+            item_id = value.get('id', sub_key)
+            if item_id != sub_key:
+                summary.add_error(f"{key} {sub_key}: the id is {item_id}")
+            if key == 'nodes':
+                summary.nodes += 1
+                if item_id in node_ids:
+                    summary.add_error(f"node {item_id}: duplicate id")
+                node_ids.add(item_id)
+                if not value.get('type'):
+                    summary.add_error(f"node {item_id}: no type")
+            else:
+                summary.relationships += 1
+                if item_id in relationship_ids:
+                    summary.add_error(f"relationship {item_id}: duplicate id")
+                relationship_ids.add(item_id)
+                if not value.get('type'):
+                    summary.add_error(f"relationship {item_id}: no type")
+                endpoints.append((item_id, value.get('source_id'), value.get('target_id')))
+    except ValueError as e:
+        summary.add_error(f"not a valid json: {e}")
+        return summary
+    if not summary.design:
+        summary.add_error('no design')
+    for item_id in node_ids & relationship_ids:
+        summary.add_error(f"relationship {item_id}: the id of a node")
+    for rel_id, source_id, target_id in endpoints:
+        for end, node_id in (('source', source_id), ('target', target_id)):
+            if node_id not in node_ids:
+                summary.add_error(f"relationship {rel_id}: the {end} {node_id} is not a node")
+    return summary
+
+
+def iter_patch_batches(fp: BinaryIO, key: str, new_bp_name: str, batch_bytes: int = PUSH_BATCH_BYTES) -> Iterator[Tuple[int, bytes]]:
+    """
+    Yield (count, body) of the PATCH blueprint calls for the nodes or the relationships of the file, about batch_bytes each
+    The nodes are rewritten like iter_bp_spec
+    """
+    parts = []
+    size = 0
+    fp.seek(0)
+    for entry_key, sub_key, value in iter_json_entries(fp):
+        if entry_key != key or sub_key is None:
+            continue
+        item = f"{json.dumps(sub_key)}: {json.dumps(rewrite_node(value, new_bp_name) if key == 'nodes' else value)}"
+        parts.append(item)
+        size += len(item)
+        if size >= batch_bytes:
+            yield len(parts), f'{{"{key}": {{{", ".join(parts)}}}}}'.encode('utf-8')
+            parts = []
+            size = 0
+    if parts:
+        yield len(parts), f'{{"{key}": {{{", ".join(parts)}}}}}'.encode('utf-8')
+
+
+@dataclass
+class BlueprintPusher:
+    """
+    Create a blueprint from the blueprint json file: validate, create, and optionally apply the nodes and
+    the relationships in concurrent batches with the retries
+    """
+    apstra_server: Any  # CkApstraSession
+    new_bp_name: str
+    concurrency: int = PUSH_CONCURRENCY
+    batch_bytes: int = PUSH_BATCH_BYTES
+    retries: int = PUSH_RETRIES
+    backoff: float = PUSH_BACKOFF
+    progress: Optional[Callable[[str], Awaitable[None]]] = None  # the sse_logging of the store
+    stopping: threading.Event = field(default_factory=threading.Event, repr=False)  # set when a batch failed, no more retries
+    logger: Any = logging.getLogger('BlueprintPusher')
+
+    async def report(self, text: str) -> None:
+        if self.progress:
+            await self.progress(text)
+        else:
+            self.logger.info(text)
+
+    async def validate(self, fp: BinaryIO) -> BpJsonSummary:
+        """
+        Raise BpPushError with the errors before anything is sent to Apstra
+        """
+        with span('push-validate'):
+            summary = await run_blocking(validate_bp_json, fp)
+        if summary.error_count:
+            raise BpPushError(f"{summary.error_count} errors in the blueprint json\n{summary.error_text()}")
+        await self.report(f"push validated {summary.design=} {summary.nodes=} {summary.relationships=}")
+        return summary
+
+    def post_blueprint(self, fp: Optional[BinaryIO], design: Optional[str]) -> requests.Response:
+        """
+        Create the blueprint with the whole file in one streamed call, or empty when fp is None. Blocking
+        The streamed body is not resent by the reauth hook: on 401 the file is sent again with the renewed token
+        """
+        apstra_server = self.apstra_server
+        url = f"{apstra_server.url_prefix}/blueprints"
+        with span('push-bp-json'):
+            if fp is None:
+                return apstra_server.session.post(url, json={'design': design, 'label': self.new_bp_name, 'init_type': 'explicit', 'nodes': [], 'relationships': []})
+            for _ in range(2):
+                fp.seek(0)
+                response = apstra_server.session.post(url, data=count_bytes_blocking(iter_bp_spec(fp, self.new_bp_name), 'push-bp-json'))
+                if response.status_code != 401:
+                    break
+            return response
+
+    def delete_blueprint(self, bp_id: str) -> bool:
+        """
+        Delete the blueprint of a failed batched push. Return whether it is deleted. Blocking
+        """
+        try:
+            with span('push-cleanup'):
+                response = self.apstra_server.session.delete(f"{self.apstra_server.url_prefix}/blueprints/{bp_id}")
+        except (requests.ConnectionError, requests.Timeout) as e:
+            self.logger.warning(f"delete_blueprint() {bp_id=} {e=}")
+            return False
+        return response.ok
+
+    def patch_batch(self, bp_id: str, body: bytes) -> int:
+        """
+        Apply a batch to the blueprint, retrying the connection errors and RETRY_STATUS_CODES. Return the retries. Blocking
+        """
+        url = f"{self.apstra_server.url_prefix}/blueprints/{bp_id}"
+        error = 'stopped'
+        for attempt in range(self.retries + 1):
+            if self.stopping.is_set():
+                break
+            try:
+                with span('push-batch'):
+                    response = self.apstra_server.session.patch(url, data=body)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = f"{e!r}"
+            else:
+                if response.ok:
+                    return attempt
+                error = f"{response.status_code} {response.text[:200]}"
+                if response.status_code not in RETRY_STATUS_CODES:
+                    break
+            if attempt < self.retries and self.stopping.wait(self.backoff * 2 ** attempt):
+                break
+        raise BpPushError(f"the batch to {bp_id} failed: {error}")
+
+    async def apply(self, fp: BinaryIO, bp_id: str, key: str, total: int) -> None:
+        """
+        Send the batches of the nodes or the relationships, at most self.concurrency at a time
+        The batches are read from the file as they are sent, so the memory is bounded by the window
+        On a failure the batches in flight are waited for, so nothing is sent to the blueprint after the return
+        """
+        pending = set()
+        sent = 0
+        batch_number = 0
+
+        async def send(number: int, count: int, body: bytes) -> Tuple[int, int, int, float]:
+            begin = time.perf_counter()
+            retries = await run_blocking(self.patch_batch, bp_id, body)
+            return number, count, retries, time.perf_counter() - begin
+
+        async def report_done(done) -> None:
+            nonlocal sent
+            for task in done:
+                number, count, retries, seconds = task.result()
+                sent += count
+                await self.report(f"push {key} batch {number} {count=} in {seconds:.2f}s {retries=}, {sent}/{total}")
+
+        try:
+            async for count, body in iterate_blocking(iter_patch_batches(fp, key, self.new_bp_name, self.batch_bytes)):
+                batch_number += 1
+                pending.add(asyncio.create_task(send(batch_number, count, body)))
+                if len(pending) >= max(1, self.concurrency):
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    await report_done(done)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                await report_done(done)
+        finally:
+            if pending:
+                # the threads can not be cancelled. stop their retries and wait for the calls on the way
+                self.stopping.set()
+                await asyncio.wait(pending)
+                for task in pending:
+                    task.exception()
+
+    async def push(self, fp: BinaryIO, batched: bool = False) -> str:
+        """
+        Validate the file and create the blueprint. Return the response text of the creation
+        In batched mode the blueprint is created empty, then the nodes and the relationships are applied in batches
+        """
+        summary = await self.validate(fp)
+        bp_created = await run_blocking(self.post_blueprint, None if batched else fp, summary.design)
+        return_text = bp_created.content.decode('utf-8', 'replace')
+        if not bp_created.ok:
+            raise BpPushError(f"the blueprint is not created: {bp_created.status_code} {return_text}")
+        if not batched:
+            return return_text
+
+        bp_id = bp_created.json()['id']
+        await self.report(f"push created {bp_id}, applying {summary.nodes} nodes and {summary.relationships} relationships")
+        try:
+            # the relationships refer to the nodes
+            await self.apply(fp, bp_id, 'nodes', summary.nodes)
+            await self.apply(fp, bp_id, 'relationships', summary.relationships)
+        except (BpPushError, asyncio.CancelledError) as e:
+            deleted = await run_blocking(self.delete_blueprint, bp_id)
+            cleanup = f"the blueprint {bp_id} is deleted" if deleted else f"the blueprint {bp_id} is left behind, delete it by hand"
+            await self.report(f"push failed: {cleanup}")
+            if isinstance(e, BpPushError):
+                raise BpPushError(f"{e}\n{cleanup}") from e
+            raise
+        return return_text
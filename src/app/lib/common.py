@@ -1,26 +1,59 @@
 
+from contextlib import ExitStack
 from datetime import datetime
 from enum import StrEnum
 from io import BytesIO
+import gzip
 import json
 import logging
 from dataclasses import dataclass, asdict, field
 import asyncio
 import os
+import shutil
 import tarfile
-from typing import Any, Dict, Optional, Tuple
+from typing import Any, AsyncIterator, Awaitable, BinaryIO, Callable, Collection, Dict, Iterator, List, Optional, Set, Tuple
 import tempfile
+import threading
+from concurrent.futures import Executor, ThreadPoolExecutor
 
 from ck_apstra_api.apstra_session import CkApstraSession
 from ck_apstra_api.apstra_blueprint import CkApstraBlueprint
 
-sse_queue = asyncio.Queue()
+from app.lib.offload import APSTRA_OFFLOAD_WORKERS, iterate_blocking, run_blocking
+from app.lib.sse_hub import SseHub, current_sse_hub
+from app.lib.session_store import SessionRegistry
+from app.lib.state_backend import EventRelay, make_state_backend
+from app.lib.tgz_stream import TarStream, TgzStream
+from app.lib.transport import ApstraSession, grow_pool
+from app.lib.bp_catalog import BlueprintCatalog
+from app.lib.bp_diff import Entries, file_entries, graph_entries, iter_bp_diff
+from app.lib.bp_graph import BlueprintGraph, graph_snapshots
+from app.lib.bp_json import rewrite_node
+from app.lib.bp_push import BlueprintPusher
+from app.lib.config_cache import config_cache
+from app.lib.config_history import config_history
+from app.lib.cpu_pool import export_bp_dump
+from app.lib.config_fetch import ConfigFetcher, DEFAULT_FETCH_CONCURRENCY, MIN_SECTION_SIZE, SWITCH_QUERY, SwitchConfig, section_diffs
+from app.lib.jobs import Job, JobManager, JobStatusEnum, current_job
+from app.lib.metrics import Gauge, apstra_metrics_hook, span
+
+sse_hub = SseHub()
+
+# the queued events are sent together in a 'batch' event, up to SSE_BATCH_MAX_EVENTS,
+# waiting at most SSE_BATCH_DEADLINE seconds after the first event to fill the batch
+SSE_BATCH_MAX_EVENTS = int(os.getenv('SSE_BATCH_MAX_EVENTS', '200'))
+SSE_BATCH_DEADLINE = float(os.getenv('SSE_BATCH_DEADLINE', '0.02'))
 
 async def sse_logging(text, logger=None):
+    job = current_job.get()
+    if job:
+        text = f"[{job.kind} {job.id[:8]}] {text}"
     if logger:
         logger.info(text)
     else:
         logging.info(text)
+    if current_sse_hub.get(sse_hub) is None:
+        return
     await SseEvent(data=SseEventData(id='event-box-text', add_text=f"{datetime.now():%H:%M:%S:%f} {text}\n")).send()
 
 class DataStateEnum(StrEnum):
@@ -40,6 +73,7 @@ class ButtonIdEnum(StrEnum):
     BUTTON_PULL_CONFIG = 'pull-config'
     BUTTON_PULL_JSON = 'pull-bp-json'
     BUTTON_PUSH_JSON = 'push-bp-json'
+    BUTTON_PULL_GS = 'pull-generic-systems'
 
 @dataclass
 class SseEventData:
@@ -56,6 +90,7 @@ class SseEventData:
     just_value: Optional[bool] = None  # to reset file upload
     innerHTML: Optional[bool] = None
     add_text: str = '' # to add text to the value
+    options: Optional[List[str]] = None  # to replace the options of a select at once
 
     def visible(self):
         self.visibility = 'visible'
@@ -116,15 +151,67 @@ class SseEvent:
     event: str = 'data-state'    # SseEventEnum.DATA_STATE, SseEventEnum.TBODY_GS, SseEventEnum.BUTTION_DISABLE
 
     async def send(self):
-        await asyncio.sleep(0.05)
+        hub = current_sse_hub.get(sse_hub)
+        if hub is None:
+            return
         try:
             sse_dict = {'event': self.event, 'data': json.dumps(asdict(self.data))}
         except Exception as e:
             logging.error(f"SseEvent.send() {e=} {self}")
             return
-        # logging.info(f"######## SseEvent put {sse_queue.qsize()=} {self=}")        
-        await sse_queue.put(sse_dict)
-
+        hub.publish(**sse_dict)
+
+
+
+def sse_frame(batch: List[dict]) -> dict:
+    """
+    Make one SSE frame out of the events. The single event is sent as is
+    The frame id is the id of the last event, which comes back as Last-Event-ID on reconnect
+    """
+    if len(batch) == 1:
+        return batch[0]
+    items = ', '.join(f'{{"event": {json.dumps(x["event"])}, "data": {x["data"]}}}' for x in batch)
+    frame = {'event': 'batch', 'data': f"[{items}]"}
+    last_id = next((x['id'] for x in reversed(batch) if 'id' in x), None)
+    if last_id:
+        frame['id'] = last_id
+    return frame
+
+
+async def sse_frames(is_disconnected: Callable[[], Awaitable[bool]], last_event_id: Optional[str] = None) -> AsyncIterator[dict]:
+    """
+    Yield the SSE frames for EventSourceResponse until the client disconnects
+    """
+    hub = current_sse_hub.get(sse_hub)
+    subscriber = await hub.relay.subscribe(hub, last_event_id) if hub.relay else hub.subscribe(last_event_id)
+    try:
+        while not await is_disconnected():
+            batch = await subscriber.next_batch(SSE_BATCH_MAX_EVENTS, SSE_BATCH_DEADLINE)
+            dropped = subscriber.take_dropped()
+            if dropped:
+                notice = SseEventData(id='event-box-text', add_text=f"{datetime.now():%H:%M:%S:%f} {dropped} events dropped for the slow client\n")
+                batch.insert(0, {'event': 'data-state', 'data': json.dumps(asdict(notice))})
+            yield sse_frame(batch)
+    finally:
+        hub.unsubscribe(subscriber)
+
+
+async def send_job_event(job: Job) -> None:
+    """
+    Send the 'job' SSE event with the summary of the job
+    """
+    hub = current_sse_hub.get(sse_hub)
+    if hub is not None:
+        hub.publish(event='job', data=json.dumps(job.summary()))
+    if job.is_finished and job.started:
+        await sse_logging(f"job {job.status} in {job.finished - job.started:.3f}s\n{job.timings.summary()}")
+
+
+# the sessions, the SSE events and the jobs shared by the web workers. APSTRA_STATE_BACKEND
+state_backend = make_state_backend()
+event_relay = EventRelay(state_backend) if state_backend.shared else None
+
+job_manager = JobManager(notify=send_job_event, backend=state_backend if state_backend.shared else None)
 
 
 @dataclass
@@ -135,16 +222,63 @@ class ApstraServer:
     password: str
     logging_level: str = 'DEBUG'
     apstra_server: Any = None  # CkApstraSession
+    bp_catalog: Any = field(default=None, repr=False)  # BlueprintCatalog of the login
+    reauth_lock: Any = field(default_factory=threading.Lock, repr=False)
 
-    def login(self) -> Tuple[Optional[CkApstraSession], Optional[Any]]:
+    def login(self, pool_size: int = DEFAULT_FETCH_CONCURRENCY) -> Tuple[Optional[CkApstraSession], Optional[Any]]:
         """
         Login to the ApstraServer and return version and the error message
+        The session keeps a connection for each switch fetched at the same time (pool_size) and each apstra thread,
+        which run the other calls: the blueprint list, the switch counts, the push batches
         """
-        self.apstra_server = CkApstraSession(self.host, int(self.port), self.username, self.password)
+        self.apstra_server = ApstraSession(self.host, int(self.port), self.username, self.password, pool_size + APSTRA_OFFLOAD_WORKERS)
         if self.apstra_server.last_error:
             return self.apstra_server.version, self.apstra_server.last_error
+        self.apstra_server.session.hooks['response'].extend([apstra_metrics_hook, self.reauth_hook])
+        self.bp_catalog = BlueprintCatalog(self.apstra_server)
         return self.apstra_server.version, None
 
+    def close(self) -> None:
+        """
+        Stop the switch counting of the catalog and close the connections of the session
+        """
+        if self.bp_catalog is not None and self.bp_catalog.counting is not None:
+            self.bp_catalog.counting.cancel()
+        if self.apstra_server is not None:
+            self.apstra_server.session.close()
+
+    @property
+    def server_key(self) -> str:
+        return f"{self.host}:{self.port}"
+
+    def is_logged_in(self, host: str, port: str, username: str, password: str) -> bool:
+        """
+        True if the session to the same server with the same credential is alive, to be reused
+        """
+        return (self.apstra_server is not None and self.apstra_server.token is not None
+                and (self.host, str(self.port), self.username, self.password) == (host, str(port), username, password))
+
+    def reauth_hook(self, response, **kwargs):
+        """
+        requests response hook. Login again when the token expired (401) and resend the request once
+        A streamed body is consumed already, so its 401 goes back to the caller with the token renewed
+        """
+        request = response.request
+        if response.status_code != 401 or request.url.endswith('/user/login') or getattr(request, 'reauth_retried', False):
+            return response
+        session = self.apstra_server
+        with self.reauth_lock:
+            # another thread might have renewed the token already
+            if request.headers.get('AuthToken') == session.token:
+                logging.getLogger('ApstraServer').info(f"reauth_hook(): token expired. login again {self.host=}")
+                session.login()
+        if request.body is not None and not isinstance(request.body, (bytes, str)):
+            return response
+        retry = request.copy()
+        retry.headers['AuthToken'] = session.token
+        retry.reauth_retried = True
+        return session.session.send(retry, **kwargs)
+
 @dataclass
 class BpTarget:
     tor_bp: str
@@ -155,7 +289,7 @@ class BpTarget:
 
 @dataclass
 class GlobalStore:
-    __slots__ = ['apstra', 'main_blueprint', 'blueprints', 'logger', 'tgz_name', 'tgz_data', 'json_data']
+    __slots__ = ['apstra', 'main_blueprint', 'blueprints', 'logger', 'tgz_name', 'tgz_data', 'json_data', 'fetch_concurrency', 'sse_hub', 'session_id']
     apstra: ApstraServer
 
     main_blueprint: str
@@ -166,14 +300,69 @@ class GlobalStore:
     tgz_name: Optional[str]
     tgz_data: Optional[Any]
     json_data: Optional[Any]  # to save bp json data
+    fetch_concurrency: int  # the number of switches to fetch the configs at the same time
+    sse_hub: SseHub  # the events of this store
+    session_id: Optional[str]  # the web session of this store. None outside of the web sessions
 
     @property
     def apstra_server(self):
         return self.apstra.apstra_server
 
+    @property
+    def logged_in(self) -> bool:
+        return self.apstra is not None and self.apstra_server is not None and self.apstra_server.token is not None
+
+    def close(self) -> None:
+        """
+        Release the Apstra session and the SSE hub of an evicted web session
+        """
+        if self.apstra is not None:
+            self.apstra.close()
+        self.sse_hub.close()
+
+    def session_state(self) -> Optional[dict]:
+        """
+        What another web worker needs to serve this session: the server, the credential and the logged in blueprints
+        """
+        if self.apstra is None:
+            return None
+        return {
+            'apstra': {x: getattr(self.apstra, x) for x in ('host', 'port', 'username', 'password', 'logging_level')},
+            'fetch_concurrency': self.fetch_concurrency,
+            'logged_in': self.apstra_server is not None and self.apstra_server.token is not None,
+            'main_blueprint': self.main_blueprint,
+            'blueprints': sorted(self.blueprints),
+        }
+
+    async def restore_state(self, state: Optional[dict]) -> None:
+        """
+        Catch up with the session_state() saved by another web worker. Login again when the server or the credential changed
+        """
+        if state is None:
+            return
+        self.fetch_concurrency = state['fetch_concurrency']
+        if self.apstra is None or self.session_state()['apstra'] != state['apstra']:
+            self.apstra = ApstraServer(**state['apstra'])
+            self.blueprints = {}
+        if state['logged_in'] and not self.session_state()['logged_in']:
+            with span('login'):
+                _, error = await run_blocking(self.apstra.login, self.fetch_concurrency)
+            if error:
+                self.logger.warning(f"restore_state(): login error {error=}")
+                return
+            self.apstra.bp_catalog.warm_up()
+        for bp_label in state['blueprints'] if self.apstra_server else []:
+            if bp_label not in self.blueprints:
+                try:
+                    self.blueprints[bp_label] = await self.blueprint_handle(bp_label)
+                except ValueError as e:
+                    self.logger.warning(f"restore_state(): {bp_label=} {e=}")
+        self.main_blueprint = state['main_blueprint']
+
     async def post_init(self, file_dict: dict):
         await self.sse_logging(f"post_init() begin")
         self.apstra = ApstraServer(**file_dict['apstra'])
+        self.fetch_concurrency = int(file_dict.get('fetch_concurrency', self.fetch_concurrency))
         self.logger.warning(f"post_init(): {file_dict=} {self.apstra=}")
         await SseEvent(data=SseEventData(id='apstra-host', just_value=self.apstra.host)).send()
         await SseEvent(data=SseEventData(id='apstra-port', just_value=self.apstra.port)).send()
@@ -187,19 +376,52 @@ class GlobalStore:
 
     async def login_server(self, host: str, port: str, username: str, password: str) -> Tuple[Optional[str], Optional[str]]:
         await self.sse_logging(f"login_server() begin")
-        self.apstra = ApstraServer(host, port, username, password)
-        apstra_version, error = self.apstra.login()
+        if self.apstra and self.apstra.is_logged_in(host, port, username, password):
+            # reuse the pooled session of this web session
+            await self.sse_logging(f"login_server(): reuse the session to {host}")
+            apstra_version, error = self.apstra_server.version, None
+        else:
+            self.apstra = ApstraServer(host, port, username, password)
+            with span('login'):
+                apstra_version, error = await run_blocking(self.apstra.login, self.fetch_concurrency)
         await SseEvent(data=SseEventData(id='apstra-version', innerHTML=apstra_version)).send()
         if error:
             await self.sse_logging(f"login_server(): login error: {error=}")
+        else:
+            # the blueprint list and handles for bp_selections() and login_blueprint()
+            self.apstra.bp_catalog.warm_up()
         return apstra_version, error
         # await SseEvent(data=SseEventData(id='main_bp_select', innerHTML='')).send()
         # await self.sse_logging(f"login_server(): {apstra_server=}")
         # return apstra_version, error
 
+    async def history_scope(self) -> Optional[Tuple[str, Set[str]]]:
+        """
+        The server and the blueprint ids of the config history the session sees, None before the login
+        The blueprints are the logged in ones and the ones in the blueprint list of the credential
+        """
+        if not self.logged_in:
+            return None
+        bp_ids = {x.id for x in self.blueprints.values()}
+        if self.apstra.bp_catalog:
+            bp_ids.update(x.handle.id for x in (await self.apstra.bp_catalog.get()).values())
+        return self.apstra.server_key, bp_ids
+
+    async def blueprint_handle(self, bp_label: str) -> CkApstraBlueprint:
+        """
+        The CkApstraBlueprint of the label from the blueprint catalog of the login, or looked up when it isn't there
+        Raise ValueError when the blueprint is not found
+        """
+        catalog = self.apstra.bp_catalog if self.apstra else None
+        entry = (await catalog.get()).get(bp_label) if catalog else None
+        if entry:
+            return entry.handle
+        with span('login-blueprint'):
+            return await run_blocking(CkApstraBlueprint, self.apstra_server, bp_label)
+
     async def login_blueprint(self, bp_label: str):
         await self.sse_logging(f"login_blueprint({bp_label=})")
-        bp = CkApstraBlueprint(self.apstra_server, bp_label)
+        bp = await self.blueprint_handle(bp_label)
         self.main_blueprint = bp_label
         self.blueprints[bp_label] = bp
 
@@ -207,83 +429,350 @@ class GlobalStore:
         return bp
 
     async def write_to_file(self, file_name, content):
-        MIN_SIZE = 2  # might have one \n
-        if len(content) > MIN_SIZE:
-            with open(file_name, 'w') as f:
+        if len(content) > MIN_SECTION_SIZE:
+            with span('write-file'), open(file_name, 'w') as f:
                 f.write(content)
             await self.sse_logging(f"write_to_file(): {os.path.basename(file_name)}")
 
-    async def pull_config(self) -> None:
+    async def blueprint_version(self, the_bp) -> Any:
+        """
+        Return the version of the blueprint from the blueprint list, None if not found
+        """
+        with span('blueprint-list'):
+            blueprints = await run_blocking(self.apstra_server.get_items, 'blueprints')
+        return next((x.get('version') for x in blueprints.get('items', []) if x['id'] == the_bp.id), None)
+
+    async def blueprint_graph(self, the_bp, bp_version: Any, load: bool = True) -> Optional[BlueprintGraph]:
+        """
+        Return the graph snapshot of the blueprint version, loading the dump when the version changed
+        None when the snapshots are disabled, the version is unknown, or the load failed. Query Apstra then
+        load False: only the snapshot already loaded, for the callers which don't need the whole graph
+        """
+        if not graph_snapshots.enabled or bp_version is None:
+            return None
+        if not load:
+            return graph_snapshots.cached(self.apstra_server, the_bp.id, bp_version)
+        try:
+            with span('graph-snapshot'):
+                graph = await graph_snapshots.get(self.apstra_server, the_bp.id, bp_version, run_blocking)
+        except Exception as e:
+            await self.sse_logging(f"blueprint_graph(): load failed, query Apstra instead {e=}")
+            return None
+        await self.sse_logging(f"blueprint_graph(): {bp_version=} nodes={len(graph.nodes)} {graph_snapshots.hits=} {graph_snapshots.misses=}")
+        return graph
+
+    async def config_fetcher(self, the_bp, concurrency: Optional[int], refresh: bool, bp_version: Any = None) -> ConfigFetcher:
+        """
+        The fetcher of the switch configs, taking the unchanged switches of the bp_version from the config cache
+        """
+        bp_version = bp_version if config_cache.enabled else None
+        concurrency = concurrency or self.fetch_concurrency
+        # a concurrency above the one of the login
+        grow_pool(self.apstra_server.session, concurrency + APSTRA_OFFLOAD_WORKERS)
+        await self.sse_logging(f"config_fetcher(): {bp_version=} {config_cache.enabled=} {refresh=}")
+        return ConfigFetcher(self.apstra_server, the_bp, concurrency, config_cache, bp_version, refresh)
+
+    async def save_config_cache(self, fetch_hits: int, fetch_misses: int) -> None:
+        with span('config-cache-save'):
+            await run_blocking(config_cache.save)
+        await self.sse_logging(f"config cache: this pull {fetch_hits} hits {fetch_misses} misses, total {config_cache.hits=} {config_cache.misses=} {config_cache.evictions=} {config_cache.total_bytes=}")
+
+    async def iter_config_files(self, the_bp, concurrency: Optional[int] = None, refresh: bool = False, executor: Optional[Executor] = None,
+                                delta: bool = False) -> AsyncIterator[Tuple[str, Optional[str]]]:
+        """
+        Yield (path, content) of the config archive of the blueprint as the switch configs are fetched
+        The directories come with None content: <bp_label>, <bp_label>/<system_label>, then the section files of the switch
+        The sections are recorded as the last pull of the switches in the config cache, and in the config history
+        delta: only the switches changed from the last pull, with <file_name>.diff of the changed sections, and <bp_label>/delta.txt
+        """
+        bp_label = the_bp.label
+        yield bp_label, None
+
+        bp_version = await self.blueprint_version(the_bp) if config_cache.enabled or graph_snapshots.enabled else None
+        # a graph query is cheaper than loading the dump for the switches
+        graph = await self.blueprint_graph(the_bp, bp_version, load=False)
+        # switch for reference architecture, internal for freeform
+        with span('switch-query'):
+            switch_items = graph.switches() if graph else await run_blocking(the_bp.query, SWITCH_QUERY)
+        # not held for the whole pull
+        del graph
+        switches = [x['switch'] for x in switch_items]
+        fetcher = await self.config_fetcher(the_bp, concurrency, refresh, bp_version)
+        fetcher.executor = executor
+        hits = 0
+        index = 0
+        changed = []
+        unchanged = 0
+        history = config_history.new_pull(self.apstra.server_key, the_bp.id, bp_label) if config_history.enabled else None
+
+        def swap_pull(switch_config: SwitchConfig) -> Optional[List[Tuple[str, str]]]:
+            if history:
+                with span('config-history'):
+                    history.add_sections(switch_config.label, switch_config.sections)
+            with span('config-delta'):
+                previous = config_cache.swap_pull(the_bp.id, switch_config.id, switch_config.label, switch_config.sections)
+                return section_diffs(switch_config.label, previous or [], switch_config.sections, config_cache.read_blob) if delta else None
+
+        async for switch_config in fetcher.fetch(switches):
+            index += 1
+            system_label = switch_config.label
+            hits += switch_config.cached
+            diffs = await run_blocking(swap_pull, switch_config)
+            await self.sse_logging(f"pull_config({bp_label}): {index}/{len(switches)} {system_label=} cached={switch_config.cached}{f' changed={len(diffs)}' if delta else ''}")
+            if delta and not diffs:
+                unchanged += 1
+                continue
+            if delta:
+                changed.append(f"{system_label}: {', '.join(file_name for file_name, _ in diffs)}")
+            yield f"{bp_label}/{system_label}", None
+            for file_name, content in switch_config.sections + (diffs or []):
+                yield f"{bp_label}/{system_label}/{file_name}", content
+        removed = await run_blocking(config_cache.drop_pulls, the_bp.id, {x['id'] for x in switches})
+        if history:
+            await run_blocking(history.commit)
+            await self.sse_logging(f"pull_config({bp_label}): history {history.pull_id} {history.raw_bytes=}")
+        if delta:
+            lines = [f"changed {x}" for x in changed] + [f"removed {x}" for x in removed] + [f"unchanged {unchanged} switches"]
+            await self.sse_logging(f"pull_config({bp_label}): delta {len(changed)} changed {len(removed)} removed {unchanged} unchanged")
+            yield f"{bp_label}/delta.txt", '\n'.join(lines) + '\n'
+        await self.save_config_cache(hits, len(switches) - hits)
+
+    async def pull_config(self, concurrency: Optional[int] = None, refresh: bool = False, delta: bool = False) -> None:
         await self.sse_logging(f"pull_config() begin")
 
         bp_label = self.main_blueprint
         the_bp = self.blueprints[bp_label]
-        self.tgz_name = f"/tmp/{bp_label}.tgz"        
+        self.tgz_name = f"/tmp/{bp_label}-delta.tgz" if delta else f"/tmp/{bp_label}.tgz"
 
         with tempfile.TemporaryDirectory() as tmpdirname:
             # await self.sse_logging(f"pull_config(): {tmpdirname=}")
-            top_dir = f"{tmpdirname}/{bp_label}"
-            os.mkdir(top_dir)
-
-            # switch for reference architecture, internal for freeform
-            for switch in [x['switch'] for x in the_bp.query("node('system', system_type=is_in(['switch', 'internal']), name='switch')")]:
-                system_label = switch['label']
-                system_id = switch['id']
-                system_serial = switch['system_id']
-                system_dir = f"{top_dir}/{system_label}"
-                os.mkdir(system_dir)
-                await self.sse_logging(f"pull_config(): {system_label=}")
-
-                if system_serial:
-                    pristine_config = self.apstra_server.get_items(f"systems/{system_serial}/pristine-config")['pristine_data'][0]['content']
-                    await self.write_to_file(f"{system_dir}/0_load_override_pristine.txt", pristine_config)
-
-                rendered_confg = the_bp.get_item(f"nodes/{system_id}/config-rendering")['config']
-                self.write_to_file(f"{system_dir}/rendered.txt", rendered_confg)
-
-                begin_configlet = '------BEGIN SECTION CONFIGLETS------'
-                begin_set = '------BEGIN SECTION SET AND DELETE BASED CONFIGLETS------'
-
-                config_string = rendered_confg.split(begin_configlet)
-                if the_bp.design == 'freeform':
-                    await self.write_to_file(f"{system_dir}/0_load_override_freeform.txt", config_string[0])
+            async for path, content in self.iter_config_files(the_bp, concurrency, refresh, delta=delta):
+                if content is None:
+                    os.mkdir(f"{tmpdirname}/{path}")
                 else:
-                    await self.write_to_file(f"{system_dir}/1_load_merge_intended.txt", config_string[0])
-                if len(config_string) < 2:
-                    # no configlet. skip
-                    continue
+                    await self.write_to_file(f"{tmpdirname}/{path}", content)
 
-                configlet_string = config_string[1].split(begin_set)
-                await self.write_to_file(f"{system_dir}/2_load_merge_configlet.txt", configlet_string[0])
-                if len(configlet_string) < 2:
-                    # no configlet in set type. skip
-                    continue
+            def make_tgz():
+                with span('make-tgz'), tarfile.open(self.tgz_name, "w:gz") as archive:
+                    archive.add(f"{tmpdirname}/{bp_label}", recursive=True, arcname=bp_label)
+                with open(self.tgz_name, 'rb') as f:
+                    return BytesIO(f.read())
 
-                await self.write_to_file(f"{system_dir}/3_load_set_configlet-set.txt", configlet_string[1])
+            self.tgz_data = await run_blocking(make_tgz)
 
-            with tarfile.open(self.tgz_name, "w:gz") as archive:
-                archive.add(top_dir, recursive=True, arcname=bp_label)
+        return
 
-            with open(self.tgz_name, 'rb') as f:
-                self.tgz_data = BytesIO(f.read())
 
-        return
+    async def pull_config_stream(self, concurrency: Optional[int] = None, refresh: bool = False, bp_label: Optional[str] = None,
+                                 delta: bool = False) -> AsyncIterator[bytes]:
+        """
+        Yield the tar.gz of the device configurations in chunks as the switch configs are fetched
+        The same layout as pull_config without the temporary directory and the full copy in memory
+        bp_label: the logged in blueprint to pull. the main blueprint when None
+        delta: only the switches changed from the last pull, with the diffs
+        """
+        await self.sse_logging(f"pull_config_stream() begin")
+
+        the_bp = self.blueprints[bp_label or self.main_blueprint]
+        tgz_stream = TgzStream()
+        async for path, content in self.iter_config_files(the_bp, concurrency, refresh, delta=delta):
+            if content is None:
+                tgz_stream.add_dir(path)
+            else:
+                # zlib compresses without the GIL
+                with span('tar-stream'):
+                    await run_blocking(tgz_stream.add_file, path, content)
+                await self.sse_logging(f"pull_config_stream(): {os.path.basename(path)}")
+            chunk = tgz_stream.read()
+            if chunk:
+                yield chunk
+
+        yield tgz_stream.close()
+        await self.sse_logging(f"pull_config_stream() end")
+
+
+    async def pull_config_bulk(self, bp_labels: List[str], concurrency: Optional[int] = None, per_blueprint: bool = False, refresh: bool = False) -> AsyncIterator[bytes]:
+        """
+        Yield the archive of the device configurations of many blueprints, pulled at the same time
+        The switch fetches of all the blueprints share the concurrency budget
+            per_blueprint False: one tar.gz with a directory per blueprint
+            per_blueprint True: a tar of <bp_label>.tgz, one per blueprint
+        bp_labels ['all'] for every blueprint of the server
+        """
+        if bp_labels == ['all']:
+            bp_labels = list(await self.apstra.bp_catalog.get())
+        concurrency = concurrency or self.fetch_concurrency
+        await self.sse_logging(f"pull_config_bulk() begin {bp_labels=} {concurrency=} {per_blueprint=}")
+
+        # one writer takes the entries from the blueprint pulls: (path, content), or (None, label) when the pull ends
+        queue = asyncio.Queue(maxsize=concurrency * 4)
+        archive = TarStream() if per_blueprint else TgzStream()
+
+        async def pull_blueprint(bp_label: str, executor: Executor):
+            try:
+                the_bp = await self.blueprint_handle(bp_label)
+                if per_blueprint:
+                    # the writer closes the file after adding it
+                    bp_file = tempfile.TemporaryFile()
+                    try:
+                        bp_stream = TgzStream()
+                        async for path, content in self.iter_config_files(the_bp, concurrency, refresh, executor):
+                            if content is None:
+                                bp_stream.add_dir(path)
+                            else:
+                                await run_blocking(bp_stream.add_file, path, content)
+                            bp_file.write(bp_stream.read())
+                        bp_file.write(bp_stream.close())
+                        bp_file.seek(0)
+                    except BaseException:
+                        bp_file.close()
+                        raise
+                    await queue.put((f"{bp_label}.tgz", bp_file))
+                else:
+                    async for entry in self.iter_config_files(the_bp, concurrency, refresh, executor):
+                        await queue.put(entry)
+                await self.sse_logging(f"pull_config_bulk(): {bp_label} done")
+            except Exception as e:
+                await self.sse_logging(f"pull_config_bulk(): {bp_label} failed {e=}")
+            finally:
+                await queue.put((None, bp_label))
+
+        executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='config-fetch-bulk')
+        tasks = [asyncio.create_task(pull_blueprint(bp_label, executor)) for bp_label in bp_labels]
+        try:
+            running = len(tasks)
+            while running:
+                path, content = await queue.get()
+                if path is None:
+                    running -= 1
+                    await self.sse_logging(f"pull_config_bulk(): {content} ended, {len(tasks) - running}/{len(tasks)}")
+                elif content is None:
+                    archive.add_dir(path)
+                elif per_blueprint:
+                    with content:
+                        await run_blocking(archive.add_fileobj, path, content)
+                else:
+                    await run_blocking(archive.add_file, path, content)
+                chunk = archive.read()
+                if chunk:
+                    yield chunk
+        finally:
+            for task in tasks:
+                task.cancel()
+            executor.shutdown(wait=False, cancel_futures=True)
 
+        yield archive.close()
+        await self.sse_logging(f"pull_config_bulk() end")
 
-    async def pull_bp_json(self) -> str:
+
+    async def pull_bp_json(self, compress: bool = False, bp_label: Optional[str] = None) -> Tuple[str, AsyncIterator[bytes]]:
         """
-        pull the main blueprint json and store at self.json_data, return the file name
+        Return the file name and the chunks of the main blueprint json, optionally gzip compressed
+        The blueprint is streamed from Apstra one node or relationship at a time, and not kept on the store
+        bp_label: the logged in blueprint to pull. the main blueprint when None
         """
-        await self.sse_logging(f"pull_bp_json() begin")
+        await self.sse_logging(f"pull_bp_json() begin {compress=}")
 
-        bp_label = self.main_blueprint
-        # self.logger.warning(f"pull_bp_json(): {self.blueprints=}")
+        bp_label = bp_label or self.main_blueprint
         the_bp = self.blueprints[bp_label]
-        bp_json = the_bp.dump()
-        # self.logger.warning(f"pull_bp_json(): {len(bp_json)=} {type(bp_json)=}")
-        self.json_data = BytesIO(json.dumps(bp_json).encode('utf-8'))
+        apstra_server = self.apstra_server
+
+        def open_dump():
+            # the same url as the_bp.dump()
+            return apstra_server.session.get(f"{apstra_server.url_prefix}/blueprints/{the_bp.id}", stream=True)
+
+        async def json_chunks() -> AsyncIterator[bytes]:
+            size = 0
+            with span('bp-json-export'):
+                async for chunk in export_bp_dump(open_dump, compress):
+                    size += len(chunk)
+                    yield chunk
+            await self.sse_logging(f"pull_bp_json() end {size=}")
+
+        return f"{bp_label}.json.gz" if compress else f"{bp_label}.json", json_chunks()
+
+
+    async def pull_config_job(self, concurrency: Optional[int] = None, refresh: bool = False, delta: bool = False) -> Job:
+        """
+        Submit the job to pull the device configurations of the main blueprint into its <bp_label>.tgz (<bp_label>-delta.tgz) artifact
+        """
+        bp_label = self.main_blueprint
+
+        async def work(job: Job):
+            await job_manager.write_artifact(job, self.pull_config_stream(concurrency, refresh, bp_label, delta))
+
+        return job_manager.submit('pull-config', work, f"{bp_label}-delta.tgz" if delta else f"{bp_label}.tgz", owner=self)
 
-        return f"{bp_label}.json"
+
+    async def pull_bp_json_job(self, compress: bool = False) -> Job:
+        """
+        Submit the job to download the main blueprint json into its artifact
+        """
+        json_name, json_chunks = await self.pull_bp_json(compress)
+
+        async def work(job: Job):
+            await job_manager.write_artifact(job, json_chunks)
+
+        return job_manager.submit('pull-bp-json', work, json_name, owner=self)
+
+
+    async def bp_json_entries(self, source: str, uploads: Dict[str, BinaryIO], stack: ExitStack) -> Callable[[], Entries]:
+        """
+        Return the entries of a blueprint json source of diff_bp_json. The opened files are closed by the stack
+            file, base-file  the uploaded files
+            live             the main blueprint, from the graph snapshot already loaded, or streamed to a temporary file
+            live:<label>     another blueprint of the server, the same way
+            <job id>         the artifact of a done pull-bp-json job of the web session
+        Raise ValueError for an unknown source
+        """
+        if source in uploads:
+            return file_entries(uploads[source])
+        if source == 'live' or source.startswith('live:'):
+            bp_label = source[len('live:'):] or self.main_blueprint
+            the_bp = self.blueprints.get(bp_label) or await self.blueprint_handle(bp_label)
+            # only a snapshot already loaded. the dump is not loaded for the diff
+            graph = await self.blueprint_graph(the_bp, await self.blueprint_version(the_bp), load=False)
+            if graph:
+                return graph_entries(graph)
+            apstra_server = self.apstra_server
+
+            def download_dump() -> BinaryIO:
+                fp = stack.enter_context(tempfile.TemporaryFile())
+                # the same url as the_bp.dump()
+                with span('bp-json-spool'), apstra_server.session.get(f"{apstra_server.url_prefix}/blueprints/{the_bp.id}", stream=True) as response:
+                    response.raw.decode_content = True
+                    shutil.copyfileobj(response.raw, fp)
+                return fp
+
+            return file_entries(await run_blocking(download_dump))
+        job = await job_manager.find(source, self)
+        if job is None or job.kind != 'pull-bp-json' or job.status != JobStatusEnum.DONE or not job.artifact_path:
+            raise ValueError(f"{source} is not a file, live, or a done pull-bp-json job")
+        opener = gzip.open if job.artifact_name.endswith('.gz') else open
+        return file_entries(stack.enter_context(opener(job.artifact_path, 'rb')))
+
+
+    async def diff_bp_json(self, base: str, target: str, uploads: Dict[str, BinaryIO], ignore: Collection[str] = ()) -> AsyncIterator[bytes]:
+        """
+        Yield the differences from the base to the target blueprint json as ndjson chunks, see iter_bp_diff
+        The sources are checked before the first chunk, raising ValueError
+        """
+        await self.sse_logging(f"diff_bp_json() begin {base=} {target=} {ignore=}")
+        stack = ExitStack()
+        try:
+            base_entries = await self.bp_json_entries(base, uploads, stack)
+            target_entries = await self.bp_json_entries(target, uploads, stack)
+        except BaseException:
+            stack.close()
+            raise
+
+        async def diff_chunks() -> AsyncIterator[bytes]:
+            with stack, span('bp-json-diff'):
+                async for chunk in iterate_blocking(iter_bp_diff(base_entries, target_entries, ignore)):
+                    yield chunk
+            await self.sse_logging(f"diff_bp_json() end")
+
+        return diff_chunks()
 
 
     async def pull_env_json(self) -> str:
@@ -309,11 +798,8 @@ class GlobalStore:
     
 
     async def bp_selections(self):
-        blueprints = self.apstra_server.get_items('blueprints')
-        await SseEvent(data=SseEventData(id='main_bp_select', element='option', value='--select blueprint--')).send()
-        for bp in blueprints['items']:
-            label = bp['label']
-            await SseEvent(data=SseEventData(id='main_bp_select', element='option', value=label)).send()
+        labels = list(await self.apstra.bp_catalog.get())
+        await SseEvent(data=SseEventData(id='main_bp_select', options=['--select blueprint--', *labels])).send()
         await SseEvent(data=SseEventData(id='main_bp_div').done()).send()
         return
 
@@ -324,22 +810,7 @@ class GlobalStore:
         """
         await self.sse_logging(f"push_bp_json() begin")
 
-        node_list = []
-        for node_dict in file_dict['nodes'].values():
-            if node_dict['type'] == 'system' and node_dict['system_type'] == 'switch' and node_dict['role'] != 'external_router':
-                node_dict['system_id'] = None
-                # node_dict['deploy_mode'] = 'undeploy'
-            if node_dict['type'] == 'metadata':
-                node_dict['label'] = new_bp_name      
-            for k, v in node_dict.items():
-                if k == 'tags':
-                    if v is None or v == "['null']":
-                        node_dict[k] = []
-                elif k == 'property_set' and v is None:
-                    node_dict.update({
-                        k: {}
-                    })
-            node_list.append(node_dict)
+        node_list = [rewrite_node(node_dict, new_bp_name) for node_dict in file_dict['nodes'].values()]
 
         file_dict['label'] = new_bp_name
 
@@ -352,11 +823,53 @@ class GlobalStore:
             'nodes': node_list,
             'relationships': relationship_list
         }
-        bp_created = self.apstra.apstra_server.post('blueprints', data=bp_spec)
-        return_text = bp_created.content
+        bp_created = await run_blocking(self.apstra.apstra_server.post, 'blueprints', data=bp_spec)
+        return_text = bp_created.content.decode('utf-8', 'replace')
         await self.sse_logging(f"push_bp_json() BP bp_created = {return_text}")
         return return_text
 
 
+    async def push_bp_json_stream(self, fp: BinaryIO, new_bp_name: str, batched: bool = False) -> str:
+        """
+        Create a new blueprint from the json file object without loading it. Return the response text
+        The file is validated first. Then it is sent in one streamed call, or applied in batches to the new blueprint
+        Raise BpPushError when the json is not valid or Apstra refuses it
+        """
+        await self.sse_logging(f"push_bp_json_stream() begin {batched=}")
+        pusher = BlueprintPusher(self.apstra_server, new_bp_name, progress=self.sse_logging)
+        return_text = await pusher.push(fp, batched)
+        await self.sse_logging(f"push_bp_json_stream() BP bp_created = {return_text}")
+        return return_text
+
+
+    async def push_bp_json_job(self, fp: BinaryIO, new_bp_name: str, batched: bool = False) -> Job:
+        """
+        Submit the job to create a new blueprint from the json file object. The job closes the file
+        The response text is the message of the job
+        """
+        async def work(job: Job):
+            with fp:
+                job.message = await self.push_bp_json_stream(fp, new_bp_name, batched)
+
+        return job_manager.submit('push-bp-json', work, owner=self)
+
+
+def new_global_store(hub: Optional[SseHub] = None, session_id: Optional[str] = None) -> GlobalStore:
+    hub = hub or SseHub(session_id=session_id, relay=event_relay if session_id else None)
+    return GlobalStore(None, None, {}, logging.getLogger("GlobalStore"), None, None, None, DEFAULT_FETCH_CONCURRENCY, hub, session_id)
+
+
+global_store: GlobalStore = new_global_store(sse_hub)  # the store outside of the web sessions
+session_registry = SessionRegistry(new_global_store, backend=state_backend, busy=job_manager.has_jobs)  # the store of each web session, used by main.py
+
+
+def sse_subscribers() -> List[Any]:
+    hubs = [sse_hub] + [x.store.sse_hub for x in session_registry.sessions.values()]
+    return [subscriber for hub in hubs for subscriber in hub.subscribers]
+
 
-global_store: GlobalStore = GlobalStore(None, None, {}, logging.getLogger("GlobalStore"), None, None, None)  # initialized by main.py
+Gauge('apstra_web_sse_queue_depth', 'The events queued for the /sse connections', lambda: sum(len(x.buffer) for x in sse_subscribers()))
+Gauge('apstra_web_sse_queue_lag_seconds', 'The longest wait of a queued event for the /sse connections', lambda: max((x.lag() for x in sse_subscribers()), default=0.0))
+Gauge('apstra_web_sse_connections', 'The open /sse connections', lambda: len(sse_subscribers()))
+Gauge('apstra_web_sessions', 'The web sessions', lambda: len(session_registry.sessions))
+Gauge('apstra_web_jobs_running', 'The running background jobs', lambda: sum(x.status == JobStatusEnum.RUNNING for x in job_manager.jobs.values()))
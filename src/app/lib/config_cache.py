@@ -0,0 +1,273 @@
+from dataclasses import dataclass, field
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Collection, Dict, List, Optional, Set, Tuple
+
+from app.lib.file_lock import file_lock
+
+# the directory of the cached config sections. override by APSTRA_CONFIG_CACHE_DIR
+CONFIG_CACHE_DIR = os.getenv('APSTRA_CONFIG_CACHE_DIR', os.path.expanduser('~/.cache/ck-apstra-web-tool/configs'))
+# the total size of the cached sections. 0 to disable the cache
+CONFIG_CACHE_MAX_BYTES = int(os.getenv('APSTRA_CONFIG_CACHE_MAX_BYTES', str(512 * 1024 * 1024)))
+
+
+def content_hash(content: str) -> str:
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+@dataclass
+class ConfigCache:
+    """
+    On-disk content addressed cache of the config sections of the switches
+        blobs/<hash[:2]>/<hash>: the section content
+        index.json: { '<bp_id>/<node_id>': { version: , label: , sections: [ [file_name, hash] ], last_used: } }
+        pulls.json: { '<bp_id>/<node_id>': { label: , sections: [ [file_name, hash] ], pulled: } } of the last pull, for the delta pulls
+    An entry is valid while the version (blueprint version and the switch node) is the same
+    The least recently used entries are evicted when the blobs exceed max_bytes. The blobs of the last pulls are kept,
+    and not counted in max_bytes: they are bounded by the switches of the blueprints, not by the cache
+    The web workers share the directory. Each merges the index written by the others, the latest entry and pull of a
+    switch win, and a blob removed by another worker is a miss
+    """
+    cache_dir: str = CONFIG_CACHE_DIR
+    max_bytes: int = CONFIG_CACHE_MAX_BYTES
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    entries: Optional[Dict[str, dict]] = None  # loaded from index.json on the first use
+    pulls: Dict[str, dict] = field(default_factory=dict)  # loaded from pulls.json with the entries
+    blob_sizes: Dict[str, int] = field(default_factory=dict)
+    dropped: Set[str] = field(default_factory=set)  # the entries evicted since the save, not merged back
+    dropped_pulls: Set[str] = field(default_factory=set)  # the pulls dropped since the save, not merged back
+    disk_seen: Any = None  # the index files as of the last merge
+    lock: Any = field(default_factory=threading.RLock, repr=False)
+    logger: Any = logging.getLogger('ConfigCache')
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    @property
+    def index_file(self) -> str:
+        return os.path.join(self.cache_dir, 'index.json')
+
+    @property
+    def pulls_file(self) -> str:
+        return os.path.join(self.cache_dir, 'pulls.json')
+
+    @property
+    def lock_file(self) -> str:
+        return os.path.join(self.cache_dir, '.lock')
+
+    def blob_file(self, digest: str) -> str:
+        return os.path.join(self.cache_dir, 'blobs', digest[:2], digest)
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(self.blob_sizes.values())
+
+    def read_json(self, file_name: str) -> Dict[str, dict]:
+        try:
+            with open(file_name) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            self.logger.warning(f"read_json() ignore the broken {file_name} {e=}")
+            return {}
+
+    def disk_state(self) -> Tuple[Any, ...]:
+        state = []
+        for file_name in (self.index_file, self.pulls_file):
+            try:
+                stat = os.stat(file_name)
+                state.append((stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                state.append(None)
+        return tuple(state)
+
+    def merge(self, entries: Dict[str, dict], pulls: Dict[str, dict]) -> None:
+        """
+        Take the entries and the last pulls of the index files newer than the ones of this worker. Under the lock
+        """
+        for key, entry in entries.items():
+            mine = self.entries.get(key)
+            if key not in self.dropped and (mine is None or entry['last_used'] > mine['last_used']):
+                self.entries[key] = entry
+        for key, pull in pulls.items():
+            mine = self.pulls.get(key)
+            if key not in self.dropped_pulls and (mine is None or pull.get('pulled', 0) > mine.get('pulled', 0)):
+                self.pulls[key] = pull
+        for entry in list(self.entries.values()) + list(self.pulls.values()):
+            for _, digest in entry['sections']:
+                if digest not in self.blob_sizes and os.path.isfile(self.blob_file(digest)):
+                    self.blob_sizes[digest] = os.path.getsize(self.blob_file(digest))
+
+    def load(self) -> None:
+        """
+        Load the index on the first use, then merge it again when another worker saved it. Under the lock
+        """
+        state = self.disk_state()
+        if self.entries is not None and state == self.disk_seen:
+            return
+        if self.entries is None:
+            self.entries = {}
+        self.merge(self.read_json(self.index_file), self.read_json(self.pulls_file))
+        self.disk_seen = state
+
+    def save(self) -> None:
+        """
+        Merge the index of the other workers and write it. Called at the end of a pull
+        """
+        if not self.enabled or self.entries is None:
+            return
+        with self.lock, file_lock(self.lock_file):
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self.merge(self.read_json(self.index_file), self.read_json(self.pulls_file))
+            for file_name, data in ((self.index_file, self.entries), (self.pulls_file, self.pulls)):
+                temp_file = f"{file_name}.{os.getpid()}.tmp"
+                with open(temp_file, 'w') as f:
+                    json.dump(data, f)
+                os.replace(temp_file, file_name)
+            self.dropped.clear()
+            self.dropped_pulls.clear()
+            self.disk_seen = self.disk_state()
+
+    def lookup(self, bp_id: str, node_id: str, version: str) -> Optional[List[Tuple[str, str]]]:
+        """
+        Return the sections [ (file_name, content) ] of the switch, or None if not cached for the version
+        """
+        if not self.enabled:
+            return None
+        with self.lock:
+            self.load()
+            entry = self.entries.get(f"{bp_id}/{node_id}")
+            if entry is None or entry['version'] != version or any(digest not in self.blob_sizes for _, digest in entry['sections']):
+                self.misses += 1
+                return None
+            sections = list(entry['sections'])
+        result = []
+        for file_name, digest in sections:
+            content = self.read_blob(digest)
+            if content is None:
+                # evicted by another worker
+                with self.lock:
+                    self.blob_sizes.pop(digest, None)
+                    self.misses += 1
+                return None
+            result.append((file_name, content))
+        with self.lock:
+            entry['last_used'] = time.time()
+            self.hits += 1
+        return result
+
+    def write_blob(self, content: str) -> str:
+        """
+        Write the content once by its hash. Return the hash
+        """
+        digest = content_hash(content)
+        blob_file = self.blob_file(digest)
+        if not os.path.isfile(blob_file):
+            os.makedirs(os.path.dirname(blob_file), exist_ok=True)
+            temp_file = f"{blob_file}.{os.getpid()}-{threading.get_ident()}.tmp"
+            with open(temp_file, 'w') as f:
+                f.write(content)
+            os.replace(temp_file, blob_file)
+        with self.lock:
+            self.blob_sizes[digest] = os.path.getsize(blob_file)
+        return digest
+
+    def read_blob(self, digest: str) -> Optional[str]:
+        try:
+            with open(self.blob_file(digest)) as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def rewrite_blobs(self, section_hashes: List[List[str]], sections: List[Tuple[str, str]]) -> None:
+        """
+        Write again the blobs of the sections evicted by another thread since write_blob(). Under the lock
+        """
+        for (_, digest), (_, content) in zip(section_hashes, sections):
+            if digest not in self.blob_sizes:
+                self.write_blob(content)
+
+    def store(self, bp_id: str, node_id: str, version: str, label: str, sections: List[Tuple[str, str]]) -> None:
+        if not self.enabled:
+            return
+        section_hashes = [[file_name, self.write_blob(content)] for file_name, content in sections]
+        with self.lock:
+            self.load()
+            self.rewrite_blobs(section_hashes, sections)
+            self.dropped.discard(f"{bp_id}/{node_id}")
+            self.entries[f"{bp_id}/{node_id}"] = {'version': version, 'label': label, 'sections': section_hashes, 'last_used': time.time()}
+            self.evict(keep=f"{bp_id}/{node_id}")
+
+    def swap_pull(self, bp_id: str, node_id: str, label: str, sections: List[Tuple[str, str]]) -> Optional[List[Tuple[str, str]]]:
+        """
+        Record the sections as the last pull of the switch. Return the [ (file_name, hash) ] of the previous pull, None for the first
+        """
+        if not self.enabled:
+            return None
+        section_hashes = [[file_name, self.write_blob(content)] for file_name, content in sections]
+        with self.lock:
+            self.load()
+            self.rewrite_blobs(section_hashes, sections)
+            previous = self.pulls.get(f"{bp_id}/{node_id}")
+            self.dropped_pulls.discard(f"{bp_id}/{node_id}")
+            self.pulls[f"{bp_id}/{node_id}"] = {'label': label, 'sections': section_hashes, 'pulled': time.time()}
+        return [tuple(x) for x in previous['sections']] if previous else None
+
+    def drop_pulls(self, bp_id: str, node_ids: Collection[str]) -> List[str]:
+        """
+        Forget the last pulls of the switches of the blueprint not in node_ids. Return their labels
+        """
+        if not self.enabled:
+            return []
+        with self.lock:
+            self.load()
+            gone = [key for key in self.pulls if key.startswith(f"{bp_id}/") and key[len(bp_id) + 1:] not in node_ids]
+            self.dropped_pulls.update(gone)
+            return [self.pulls.pop(key)['label'] for key in gone]
+
+    def remove_blob(self, digest: str) -> None:
+        self.blob_sizes.pop(digest, None)
+        try:
+            os.remove(self.blob_file(digest))
+        except OSError:
+            pass
+
+    def evict(self, keep: Optional[str] = None) -> None:
+        """
+        Drop the unreferenced blobs, then the least recently used entries but keep and their unreferenced blobs,
+        until the blobs not pinned by the last pulls fit in max_bytes. Under the lock
+        """
+        if self.total_bytes <= self.max_bytes:
+            return
+        referenced = {}
+        for entry in list(self.entries.values()) + list(self.pulls.values()):
+            for _, digest in entry['sections']:
+                referenced[digest] = referenced.get(digest, 0) + 1
+        # the blobs of the replaced and the dropped last pulls
+        for digest in [x for x in self.blob_sizes if x not in referenced]:
+            self.remove_blob(digest)
+        pinned = {digest for entry in self.pulls.values() for _, digest in entry['sections']}
+        unpinned_bytes = sum(size for digest, size in self.blob_sizes.items() if digest not in pinned)
+        for key in sorted(self.entries, key=lambda k: self.entries[k]['last_used']):
+            if unpinned_bytes <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            self.dropped.add(key)
+            for _, digest in self.entries.pop(key)['sections']:
+                referenced[digest] -= 1
+                if referenced[digest] == 0 and digest in self.blob_sizes:
+                    unpinned_bytes -= self.blob_sizes[digest]
+                    self.remove_blob(digest)
+            self.evictions += 1
+
+
+config_cache = ConfigCache()
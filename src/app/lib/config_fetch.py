@@ -0,0 +1,167 @@
+from collections import deque
+from concurrent.futures import Executor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+import asyncio
+import contextvars
+import difflib
+import hashlib
+import json
+import logging
+import os
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+from app.lib.config_cache import ConfigCache, content_hash
+from app.lib.metrics import span
+
+# the number of switches fetched at the same time. override by APSTRA_FETCH_CONCURRENCY or 'fetch_concurrency' of env json
+DEFAULT_FETCH_CONCURRENCY = int(os.getenv('APSTRA_FETCH_CONCURRENCY', '8'))
+
+BEGIN_CONFIGLET = '------BEGIN SECTION CONFIGLETS------'
+BEGIN_SET = '------BEGIN SECTION SET AND DELETE BASED CONFIGLETS------'
+
+# the section files shorter than this are not written. might have one \n
+MIN_SECTION_SIZE = 2
+
+# the section of the pristine config. it is on the device, not rendered from the blueprint: not cached nor compared
+PRISTINE_SECTION = '0_load_override_pristine.txt'
+# the sections not compared by the delta pulls
+DELTA_SKIP_SECTIONS = (PRISTINE_SECTION,)
+
+# switch for reference architecture, internal for freeform
+SWITCH_QUERY = "node('system', system_type=is_in(['switch', 'internal']), name='switch')"
+
+
+@dataclass
+class SwitchConfig:
+    label: str
+    id: str
+    serial: Optional[str]
+    pristine_config: Optional[str] = None
+    rendered_config: str = ''
+    sections: List[Tuple[str, str]] = field(default_factory=list)  # [ (file_name, content) ] by config_sections
+    cached: bool = False  # the rendered sections are from the config cache
+
+
+def switch_version(switch: Dict[str, Any], bp_version: Any) -> str:
+    """
+    The cache version of a switch: the blueprint version and the fingerprint of the switch node
+    """
+    node_hash = hashlib.sha256(json.dumps(switch, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:16]
+    return f"{bp_version}:{node_hash}"
+
+
+def pristine_sections(switch_config: SwitchConfig) -> List[Tuple[str, str]]:
+    if switch_config.pristine_config is None or len(switch_config.pristine_config) <= MIN_SECTION_SIZE:
+        return []
+    return [(PRISTINE_SECTION, switch_config.pristine_config)]
+
+
+def config_sections(switch_config: SwitchConfig, design: str) -> List[Tuple[str, str]]:
+    """
+    Split the configurations of a switch into the section files of pull_config, in the order of the files
+    The sections shorter than MIN_SECTION_SIZE are skipped
+    """
+    sections = pristine_sections(switch_config)
+
+    config_string = switch_config.rendered_config.split(BEGIN_CONFIGLET)
+    if design == 'freeform':
+        sections.append(('0_load_override_freeform.txt', config_string[0]))
+    else:
+        sections.append(('1_load_merge_intended.txt', config_string[0]))
+    if len(config_string) > 1:
+        configlet_string = config_string[1].split(BEGIN_SET)
+        sections.append(('2_load_merge_configlet.txt', configlet_string[0]))
+        if len(configlet_string) > 1:
+            sections.append(('3_load_set_configlet-set.txt', configlet_string[1]))
+
+    return [(file_name, content) for file_name, content in sections if len(content) > MIN_SECTION_SIZE]
+
+
+def section_diffs(label: str, previous: List[Tuple[str, str]], sections: List[Tuple[str, str]], read_blob: Callable[[str], Optional[str]]) -> List[Tuple[str, str]]:
+    """
+    The unified diffs [ (<file_name>.diff, diff) ] of the sections changed from the previous pull [ (file_name, hash) ]
+    Empty when no section but DELTA_SKIP_SECTIONS changed. The previous content is read by the hash
+    """
+    before = {file_name: digest for file_name, digest in previous if file_name not in DELTA_SKIP_SECTIONS}
+    after = {file_name: content for file_name, content in sections if file_name not in DELTA_SKIP_SECTIONS}
+    diffs = []
+    for file_name in sorted(before.keys() | after.keys()):
+        content = after.get(file_name, '')
+        if file_name in before and file_name in after and before[file_name] == content_hash(content):
+            continue
+        old_content = (read_blob(before[file_name]) or '') if file_name in before else ''
+        diff = difflib.unified_diff(old_content.splitlines(keepends=True), content.splitlines(keepends=True), f"a/{label}/{file_name}", f"b/{label}/{file_name}")
+        diffs.append((f"{file_name}.diff", ''.join(diff)))
+    return diffs
+
+
+@dataclass
+class ConfigFetcher:
+    """
+    Fetch the pristine and rendered configurations of the switches with bounded concurrency
+    The results are yielded in the order of the switches
+    """
+    apstra_server: Any  # CkApstraSession
+    the_bp: Any  # CkApstraBlueprint
+    concurrency: int = DEFAULT_FETCH_CONCURRENCY
+    cache: Optional[ConfigCache] = None
+    bp_version: Any = None  # the blueprint version for the cache. the cache is not used when None
+    refresh: bool = False  # fetch all the switches, and update the cache
+    executor: Optional[Executor] = None  # shared by the fetchers of a bulk pull. a pool of concurrency threads when None
+    logger: Any = logging.getLogger('ConfigFetcher')
+
+    def fetch_switch(self, switch: Dict[str, Any]) -> SwitchConfig:
+        """
+        Fetch the configurations of a switch, or take the rendered sections from the cache. Blocking, run in the executor
+        The pristine config changes on the device without a new blueprint version, so it is fetched on every pull
+        """
+        switch_config = SwitchConfig(label=switch['label'], id=switch['id'], serial=switch['system_id'])
+        if switch_config.serial:
+            with span('pristine-config'):
+                switch_config.pristine_config = self.apstra_server.get_items(f"systems/{switch_config.serial}/pristine-config")['pristine_data'][0]['content']
+        use_cache = self.cache is not None and self.bp_version is not None
+        version = switch_version(switch, self.bp_version)
+        if use_cache and not self.refresh:
+            with span('config-cache-lookup'):
+                sections = self.cache.lookup(self.the_bp.id, switch_config.id, version)
+            if sections is not None:
+                # an entry of an older release may hold the pristine section
+                switch_config.sections = pristine_sections(switch_config) + [x for x in sections if x[0] != PRISTINE_SECTION]
+                switch_config.cached = True
+                return switch_config
+
+        with span('config-rendering'):
+            switch_config.rendered_config = self.the_bp.get_item(f"nodes/{switch_config.id}/config-rendering")['config']
+        with span('config-sections'):
+            switch_config.sections = config_sections(switch_config, self.the_bp.design)
+        if use_cache:
+            with span('config-cache-store'):
+                self.cache.store(self.the_bp.id, switch_config.id, version, switch_config.label, [x for x in switch_config.sections if x[0] != PRISTINE_SECTION])
+        return switch_config
+
+    async def fetch(self, switches: List[Dict[str, Any]]) -> AsyncIterator[SwitchConfig]:
+        """
+        Yield SwitchConfig for each switch in the given order
+        At most self.concurrency switches are in flight, so the memory is bounded by the window
+        """
+        loop = asyncio.get_running_loop()
+        concurrency = max(1, self.concurrency)
+        own_executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='config-fetch') if self.executor is None else None
+        executor = self.executor or own_executor
+        try:
+            pending = deque()
+            switch_iter = iter(switches)
+            try:
+                for switch in switch_iter:
+                    # the copied context carries the timings of the running job to the thread
+                    pending.append(loop.run_in_executor(executor, contextvars.copy_context().run, self.fetch_switch, switch))
+                    if len(pending) >= concurrency:
+                        yield await pending.popleft()
+                while pending:
+                    yield await pending.popleft()
+            finally:
+                for future in pending:
+                    future.cancel()
+        finally:
+            if own_executor:
+                own_executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,335 @@
+from dataclasses import dataclass, field
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from typing import Any, Collection, Dict, Iterator, List, Optional, Tuple
+
+from app.lib.file_lock import file_lock
+from app.lib.tgz_stream import TgzStream
+
+try:
+    import zstandard
+except ImportError:  # gzip without the zstandard package
+    zstandard = None
+
+# the directory of the config history. override by APSTRA_CONFIG_HISTORY_DIR
+CONFIG_HISTORY_DIR = os.getenv('APSTRA_CONFIG_HISTORY_DIR', os.path.expanduser('~/.cache/ck-apstra-web-tool/history'))
+# the days the pulls are kept. 0 to disable the history
+CONFIG_HISTORY_DAYS = float(os.getenv('APSTRA_CONFIG_HISTORY_DAYS', '90'))
+# the seconds a blob written or reused is kept without a manifest, for the pulls in progress in any web worker
+HISTORY_BLOB_GRACE = 86400
+
+# the blob file extensions by the compression
+_ZSTD, _GZIP = '.zst', '.gz'
+
+
+def compress(content: bytes) -> bytes:
+    if zstandard is not None:
+        return zstandard.ZstdCompressor(level=10).compress(content)
+    return gzip.compress(content, compresslevel=9, mtime=0)
+
+
+def decompress(data: bytes, extension: str) -> bytes:
+    if extension == _ZSTD:
+        if zstandard is None:
+            raise RuntimeError('the zstandard package is needed for the zstd blobs')
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+
+def in_scope(manifest: dict, server: str, bp_ids: Collection[str]) -> bool:
+    """
+    True if the pull is of one of the blueprints of the server. The pulls recorded without the server are not
+    """
+    return manifest.get('server') == server and manifest['bp_id'] in bp_ids
+
+
+@dataclass(eq=False)
+class HistoryPull:
+    """
+    The manifest of a pull being recorded: [ [system_label, file_name, hash] ] in the order of the pull
+    """
+    history: 'ConfigHistory'
+    server: str  # <host>:<port> of the Apstra server
+    bp_id: str
+    bp_label: str
+    pull_id: str
+    created: float
+    files: List[List[str]] = field(default_factory=list)
+    raw_bytes: int = 0
+    new_bytes: int = 0  # the bytes of the blobs this pull added to the disk
+
+    def add_sections(self, system_label: str, sections: List[Any]) -> None:
+        """
+        Store the sections [ (file_name, content) ] of a switch. Blocking
+        """
+        for file_name, content in sections:
+            encoded = content.encode('utf-8')
+            digest, temp_file = self.history.stage_blob(encoded)
+            # prune() does not remove the blob between its check and its write or touch
+            with file_lock(self.history.lock_file, shared=True):
+                self.new_bytes += self.history.commit_blob(digest, temp_file, encoded)
+                self.files.append([system_label, file_name, digest])
+            self.raw_bytes += len(encoded)
+
+    def commit(self) -> None:
+        """
+        Write the manifest at the end of the pull, and prune the expired pulls. Blocking
+        """
+        manifest = {'pull_id': self.pull_id, 'server': self.server, 'bp_id': self.bp_id, 'bp_label': self.bp_label, 'created': self.created,
+                    'raw_bytes': self.raw_bytes, 'files': self.files}
+        manifest_bytes = self.history.write_manifest(manifest)
+        self.history.add_stored_bytes(self.new_bytes + manifest_bytes)
+        self.history.prune()
+
+
+@dataclass
+class ConfigHistory:
+    """
+    On-disk history of the pulled config sections, deduplicated and compressed
+        blobs/<hash[:2]>/<hash>.zst (or .gz without zstandard): the section content, once for all the switches and the pulls
+        manifests/<pull_id>.json.gz: { pull_id:, server:, bp_id:, bp_label:, created:, raw_bytes:, files: [ [system_label, file_name, hash] ] }
+        usage.json: { stored_bytes: } the bytes of the blobs and the manifests, added by the pulls and taken by prune()
+    A pull is kept max_days. The blobs not in any manifest are removed with the expired pulls, unless written or reused
+    within HISTORY_BLOB_GRACE: those of the pulls in progress, of this or another web worker
+    """
+    history_dir: str = CONFIG_HISTORY_DIR
+    max_days: float = CONFIG_HISTORY_DAYS
+    logger: Any = logging.getLogger('ConfigHistory')
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_days > 0
+
+    @property
+    def lock_file(self) -> str:
+        return os.path.join(self.history_dir, '.lock')
+
+    @property
+    def usage_file(self) -> str:
+        return os.path.join(self.history_dir, 'usage.json')
+
+    def blob_base(self, digest: str) -> str:
+        return os.path.join(self.history_dir, 'blobs', digest[:2], digest)
+
+    def manifest_file(self, pull_id: str) -> str:
+        return os.path.join(self.history_dir, 'manifests', f"{pull_id}.json.gz")
+
+    def new_pull(self, server: str, bp_id: str, bp_label: str) -> HistoryPull:
+        created = time.time()
+        pull_id = f"{time.strftime('%Y%m%dT%H%M%S', time.gmtime(created))}-{uuid.uuid4().hex[:8]}"
+        return HistoryPull(self, server, bp_id, bp_label, pull_id, created)
+
+    def blob_exists(self, digest: str) -> bool:
+        base = self.blob_base(digest)
+        return os.path.isfile(base + _ZSTD) or os.path.isfile(base + _GZIP)
+
+    def touch_blob(self, digest: str) -> bool:
+        """
+        Renew the grace of the existing blob. False when there is none
+        """
+        base = self.blob_base(digest)
+        for extension in (_ZSTD, _GZIP):
+            try:
+                os.utime(base + extension)
+                return True
+            except FileNotFoundError:
+                pass
+        return False
+
+    def stage_blob(self, content: bytes) -> Tuple[str, Optional[str]]:
+        """
+        Compress the content to a temporary file next to its blob, unless the blob exists. Return the hash and the
+        temporary file, None when the blob exists. Without the lock, so the fetch threads compress at the same time
+        """
+        digest = hashlib.sha256(content).hexdigest()
+        if self.blob_exists(digest):
+            return digest, None
+        blob_file = self.blob_base(digest) + (_ZSTD if zstandard is not None else _GZIP)
+        os.makedirs(os.path.dirname(blob_file), exist_ok=True)
+        temp_file = f"{blob_file}.{os.getpid()}-{threading.get_ident()}.tmp"
+        with open(temp_file, 'wb') as f:
+            f.write(compress(content))
+        return digest, temp_file
+
+    def commit_blob(self, digest: str, temp_file: Optional[str], content: bytes) -> int:
+        """
+        Move the staged blob in place, or renew the grace of the existing one. Return the bytes added. Under the shared lock.
+        The content is compressed again only when the blob seen by stage_blob() was pruned since
+        """
+        if temp_file:
+            # <blob_file>.<pid>-<thread>.tmp
+            blob_file = temp_file.rsplit('.', 2)[0]
+            # placed by another pull since stage_blob()
+            size = 0 if os.path.exists(blob_file) else os.path.getsize(temp_file)
+            os.replace(temp_file, blob_file)
+            return size
+        if not self.touch_blob(digest):
+            return self.commit_blob(*self.stage_blob(content), content)
+        return 0
+
+    def read_blob(self, digest: str) -> bytes:
+        base = self.blob_base(digest)
+        for extension in (_ZSTD, _GZIP):
+            if os.path.isfile(base + extension):
+                with open(base + extension, 'rb') as f:
+                    return decompress(f.read(), extension)
+        raise FileNotFoundError(f"the blob {digest} of the history is missing")
+
+    def write_manifest(self, manifest: dict) -> int:
+        """
+        Write the manifest of the pull. Return its size
+        """
+        manifest_file = self.manifest_file(manifest['pull_id'])
+        os.makedirs(os.path.dirname(manifest_file), exist_ok=True)
+        temp_file = f"{manifest_file}.tmp"
+        with gzip.open(temp_file, 'wt', encoding='utf-8') as f:
+            json.dump(manifest, f, separators=(',', ':'))
+        os.replace(temp_file, manifest_file)
+        return os.path.getsize(manifest_file)
+
+    def read_manifest(self, pull_id: str) -> Optional[dict]:
+        if os.path.basename(pull_id) != pull_id:
+            return None
+        try:
+            with gzip.open(self.manifest_file(pull_id), 'rt', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def iter_manifests(self) -> Iterator[dict]:
+        manifest_dir = os.path.join(self.history_dir, 'manifests')
+        if not os.path.isdir(manifest_dir):
+            return
+        for file_name in sorted(os.listdir(manifest_dir)):
+            if file_name.endswith('.json.gz'):
+                manifest = self.read_manifest(file_name[:-len('.json.gz')])
+                if manifest:
+                    yield manifest
+
+    def pulls(self, server: str, bp_ids: Collection[str], bp_label: Optional[str] = None) -> Dict[str, Any]:
+        """
+        The pulls of the blueprints of the server, the oldest first, with the bytes of the pulled sections and the bytes on the disk
+        """
+        pulls = []
+        raw_bytes = 0
+        for manifest in self.iter_manifests():
+            if not in_scope(manifest, server, bp_ids) or (bp_label and manifest['bp_label'] != bp_label):
+                continue
+            raw_bytes += manifest['raw_bytes']
+            pulls.append({
+                'pull_id': manifest['pull_id'],
+                'bp_label': manifest['bp_label'],
+                'created': manifest['created'],
+                'switches': len({x[0] for x in manifest['files']}),
+                'files': len(manifest['files']),
+                'raw_bytes': manifest['raw_bytes'],
+            })
+        return {'pulls': pulls, 'raw_bytes': raw_bytes, 'stored_bytes': self.stored_bytes()}
+
+    def iter_tgz(self, manifest: dict) -> Iterator[bytes]:
+        """
+        Yield the tar.gz of the pull in the layout of pull_config, from the blobs. Blocking
+        """
+        tgz_stream = TgzStream()
+        tgz_stream.mtime = int(manifest['created'])
+        bp_label = manifest['bp_label']
+        tgz_stream.add_dir(bp_label)
+        system_label = None
+        for file_system_label, file_name, digest in manifest['files']:
+            if file_system_label != system_label:
+                system_label = file_system_label
+                tgz_stream.add_dir(f"{bp_label}/{system_label}")
+            tgz_stream.add_file(f"{bp_label}/{system_label}/{file_name}", self.read_blob(digest))
+            chunk = tgz_stream.read()
+            if chunk:
+                yield chunk
+        yield tgz_stream.close()
+
+    def read_stored_bytes(self) -> Optional[int]:
+        try:
+            with open(self.usage_file) as f:
+                return json.load(f)['stored_bytes']
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def measure_stored_bytes(self) -> int:
+        """
+        Walk the blobs and the manifests, for a history without usage.json
+        """
+        total = 0
+        for sub_dir in ('blobs', 'manifests'):
+            for root, _, files in os.walk(os.path.join(self.history_dir, sub_dir)):
+                total += sum(os.path.getsize(os.path.join(root, x)) for x in files if not x.endswith('.tmp'))
+        return total
+
+    def update_stored_bytes(self, delta: int) -> None:
+        """
+        Add delta to usage.json. Under the lock
+        """
+        stored_bytes = self.read_stored_bytes()
+        if stored_bytes is None:
+            stored_bytes = self.measure_stored_bytes()
+        else:
+            stored_bytes = max(0, stored_bytes + delta)
+        os.makedirs(self.history_dir, exist_ok=True)
+        temp_file = f"{self.usage_file}.{os.getpid()}.tmp"
+        with open(temp_file, 'w') as f:
+            json.dump({'stored_bytes': stored_bytes}, f)
+        os.replace(temp_file, self.usage_file)
+
+    def add_stored_bytes(self, delta: int) -> None:
+        with file_lock(self.lock_file):
+            self.update_stored_bytes(delta)
+
+    def stored_bytes(self) -> int:
+        stored_bytes = self.read_stored_bytes()
+        if stored_bytes is None:
+            self.add_stored_bytes(0)
+            stored_bytes = self.read_stored_bytes() or 0
+        return stored_bytes
+
+    def prune(self) -> None:
+        """
+        Remove the pulls older than max_days, then the blobs no pull refers to and out of their grace
+        The bytes of the removed manifests and of the removed blobs of the expired pulls are taken from usage.json.
+        The blobs of a pull which did not finish were not counted
+        """
+        now = time.time()
+        expiry = now - self.max_days * 86400
+        with file_lock(self.lock_file):
+            referenced = set()
+            expired_files = set()
+            expired = 0
+            freed = 0
+            for manifest in list(self.iter_manifests()):
+                if manifest['created'] < expiry:
+                    freed += os.path.getsize(self.manifest_file(manifest['pull_id']))
+                    os.remove(self.manifest_file(manifest['pull_id']))
+                    expired_files.update(x[2] for x in manifest['files'])
+                    expired += 1
+                else:
+                    referenced.update(x[2] for x in manifest['files'])
+            if not expired:
+                return
+            blob_dir = os.path.join(self.history_dir, 'blobs')
+            removed = 0
+            for root, _, files in os.walk(blob_dir):
+                for file_name in files:
+                    blob_file = os.path.join(root, file_name)
+                    digest = file_name.split('.')[0]
+                    if (digest not in referenced and not file_name.endswith('.tmp')
+                            and os.path.getmtime(blob_file) < now - HISTORY_BLOB_GRACE):
+                        if digest in expired_files:
+                            freed += os.path.getsize(blob_file)
+                        os.remove(blob_file)
+                        removed += 1
+            self.update_stored_bytes(-freed)
+            self.logger.info(f"prune() {expired=} {removed=} {freed=}")
+
+config_history = ConfigHistory()
@@ -0,0 +1,191 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import asyncio
+import io
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from typing import Any, AsyncIterator, Callable, Iterator, Optional
+
+from app.lib.bp_json import gzip_chunks, iter_bp_dump
+from app.lib.offload import iterate_blocking, run_blocking
+
+# the processes of the CPU bound work, like the json of the blueprint export. 0 to run it in the apstra threads
+APSTRA_CPU_WORKERS = int(os.getenv('APSTRA_CPU_WORKERS', str(min(4, os.cpu_count() or 1))))
+# the directory of the files passed to and from the processes. the system temporary directory by default
+APSTRA_CPU_SPOOL_DIR = os.getenv('APSTRA_CPU_SPOOL_DIR') or None
+# the seconds to wait for more bytes of a file being written
+SPOOL_POLL = 0.01
+# the bytes moved at a time
+SPOOL_CHUNK_SIZE = 256 * 1024
+
+_cpu_executor: Optional[ProcessPoolExecutor] = None
+_cpu_executor_lock = threading.Lock()
+
+# the threads following the files written by the processes, not to hold the apstra threads while they poll
+follow_executor = ThreadPoolExecutor(max_workers=max(1, APSTRA_CPU_WORKERS), thread_name_prefix='cpu-follow')
+
+
+def cpu_executor() -> Optional[ProcessPoolExecutor]:
+    """
+    The process pool of APSTRA_CPU_WORKERS, started on the first use. None when disabled
+    The processes are spawned, not forked from the threads of the app
+    """
+    global _cpu_executor
+    if APSTRA_CPU_WORKERS <= 0:
+        return None
+    with _cpu_executor_lock:
+        if _cpu_executor is None:
+            _cpu_executor = ProcessPoolExecutor(APSTRA_CPU_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+    return _cpu_executor
+
+
+def end_marker(path: str) -> str:
+    """
+    The file written when the file of the path is complete: empty, or the error which stopped the writer
+    """
+    return f"{path}.end"
+
+
+def stop_marker(path: str) -> str:
+    """
+    The file written when the reader of the path is gone, to stop the process writing it
+    """
+    return f"{path}.stop"
+
+
+class SpoolReader(io.RawIOBase):
+    """
+    Read a file while another process writes it, until its end marker
+    Raise IOError when the stop file appears, the output of the reading process is not wanted any more
+    """
+    def __init__(self, path: str, stop_path: Optional[str] = None, poll: float = SPOOL_POLL):
+        self.path = path
+        self.stop_path = stop_path
+        self.poll = poll
+        self.fp = open(path, 'rb')
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while True:
+            if self.stop_path and os.path.exists(self.stop_path):
+                raise IOError(f"the reader of {self.path} stopped")
+            size = self.fp.readinto(buffer)
+            if size:
+                return size
+            if os.path.exists(end_marker(self.path)):
+                # the last bytes before the marker
+                size = self.fp.readinto(buffer)
+                if size:
+                    return size
+                with open(end_marker(self.path)) as f:
+                    error = f.read()
+                if error:
+                    raise IOError(f"the writer of {self.path} failed: {error}")
+                return 0
+            if not os.path.exists(self.path):
+                raise IOError(f"{self.path} is abandoned")
+            time.sleep(self.poll)
+
+    def close(self) -> None:
+        self.fp.close()
+        super().close()
+
+
+def convert_bp_dump(dump_path: str, output_path: str, compress: bool) -> int:
+    """
+    Re-serialize the blueprint dump being spooled at dump_path with iter_bp_dump, optionally gzip compressed,
+    appending to output_path as it goes. Return the size. Run in a CPU worker process
+    Stop when the stop marker of output_path appears
+    """
+    size = 0
+    with SpoolReader(dump_path, stop_marker(output_path)) as fp, open(output_path, 'ab', buffering=0) as output:
+        chunks = iter_bp_dump(fp)
+        for chunk in gzip_chunks(chunks) if compress else chunks:
+            output.write(chunk)
+            size += len(chunk)
+    return size
+
+
+def spool_response(open_response: Callable[[], Any], path: str, stop: threading.Event) -> None:
+    """
+    Write the body of the streamed requests response to the path, then its end marker. Blocking
+    """
+    error = ''
+    try:
+        with open_response() as response, open(path, 'wb', buffering=0) as fp:
+            response.raw.decode_content = True
+            while not stop.is_set():
+                chunk = response.raw.read(SPOOL_CHUNK_SIZE)
+                if not chunk:
+                    break
+                fp.write(chunk)
+        if stop.is_set():
+            error = 'cancelled'
+    except Exception as e:
+        error = f"{e!r}"
+        raise
+    finally:
+        if os.path.isdir(os.path.dirname(path)):
+            with open(end_marker(path), 'w') as f:
+                f.write(error)
+
+
+def follow_file(path: str, done: Callable[[], bool], chunk_size: int = SPOOL_CHUNK_SIZE, poll: float = SPOOL_POLL) -> Iterator[bytes]:
+    """
+    Yield the bytes of the file as another process appends them, until done() and the end of the file
+    """
+    with open(path, 'rb') as fp:
+        while True:
+            finished = done()
+            chunk = fp.read(chunk_size)
+            if chunk:
+                yield chunk
+            elif finished:
+                return
+            else:
+                time.sleep(poll)
+
+
+async def export_bp_dump(open_response: Callable[[], Any], compress: bool = False) -> AsyncIterator[bytes]:
+    """
+    Yield the chunks of iter_bp_dump (gzip_chunks when compress) of the blueprint dump response
+    The dump is spooled to a temporary file by an apstra thread while a CPU worker process converts what has arrived
+    into another file, which is streamed from here. So the json parsing and dumping don't hold the GIL of the app
+    When the caller stops early, the process is told to stop and waited for before the files are removed
+    Without the CPU workers, the conversion runs in the apstra threads as the response is read
+    """
+    executor = cpu_executor()
+    if executor is None:
+        def dump_chunks() -> Iterator[bytes]:
+            with open_response() as response:
+                response.raw.decode_content = True
+                chunks = iter_bp_dump(response.raw)
+                yield from gzip_chunks(chunks) if compress else chunks
+
+        async for chunk in iterate_blocking(dump_chunks()):
+            yield chunk
+        return
+
+    with tempfile.TemporaryDirectory(prefix='bp-export-', dir=APSTRA_CPU_SPOOL_DIR) as work_dir:
+        dump_path = os.path.join(work_dir, 'dump.json')
+        output_path = os.path.join(work_dir, 'output')
+        open(dump_path, 'wb').close()
+        open(output_path, 'wb').close()
+        stop = threading.Event()
+        spool = asyncio.ensure_future(run_blocking(spool_response, open_response, dump_path, stop))
+        convert = executor.submit(convert_bp_dump, dump_path, output_path, compress)
+        try:
+            async for chunk in iterate_blocking(follow_file(output_path, convert.done), follow_executor):
+                yield chunk
+            convert.result()
+            await spool
+        finally:
+            stop.set()
+            if not convert.cancel() and not convert.done():
+                open(stop_marker(output_path), 'w').close()
+            # a running process can not be cancelled: the files stay until it stopped
+            await asyncio.gather(spool, asyncio.wrap_future(convert), return_exceptions=True)
@@ -0,0 +1,30 @@
+from contextlib import contextmanager
+import os
+import threading
+from typing import Dict, Iterator
+
+try:
+    import fcntl
+except ImportError:  # a lock of the process without fcntl, enough for one worker
+    fcntl = None
+
+_process_locks: Dict[str, threading.Lock] = {}
+
+
+@contextmanager
+def file_lock(path: str, shared: bool = False) -> Iterator[None]:
+    """
+    Hold the lock file of the path, shared or exclusive, across the threads and the web workers
+    """
+    if fcntl is None:
+        with _process_locks.setdefault(path, threading.Lock()):
+            yield
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # each open is its own flock, so the threads of a worker lock each other too
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
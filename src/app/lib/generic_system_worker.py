@@ -1,7 +1,148 @@
 from dataclasses import dataclass
-from typing import Any
+from html import escape
+from typing import Any, Dict, Iterable, List, Optional
 import logging
+import os
 
+from ck_apstra_api.apstra_blueprint import CkEnum
+
+from app.lib.bp_graph import BlueprintGraph
+from app.lib.common import SseEvent, SseEventData
+from app.lib.metrics import span
+from app.lib.offload import run_blocking
+
+# the generic systems rendered in one tbody-gs event
+GS_TBODY_SIZE = int(os.getenv('APSTRA_GS_TBODY_SIZE', '200'))
+
+GS_TABLE_ID = 'generic-systems-table'
+GS_TABLE_HEAD = ('<thead><tr><th>#</th><th>Generic System</th><th>AE</th><th>Speed</th><th>Switch</th><th>Switch Interface</th>'
+                 '<th>Server Interface</th><th>Tags</th><th>Untagged VLAN</th><th>Tagged VLANs</th></tr></thead>')
+
+
+class MemberLink:
+    """
+    A physical link of a generic system: the switch interface, the server interface and the tags of the link
+    """
+    __slots__ = ['switch', 'switch_intf', 'server_intf', 'tags']
+
+    def __init__(self, switch: str, switch_intf: str, server_intf: str):
+        self.switch = switch
+        self.switch_intf = switch_intf
+        self.server_intf = server_intf
+        self.tags: List[str] = []
+
+
+class GroupLink:
+    """
+    The AE (or the single link) of a generic system, with the VLANs and the member links
+    """
+    __slots__ = ['ae_name', 'speed', 'untagged_vlan', 'tagged_vlans', 'links']
+
+    def __init__(self, ae_name: str, speed: Optional[str]):
+        self.ae_name = ae_name
+        self.speed = speed
+        self.untagged_vlan: Optional[int] = None
+        self.tagged_vlans: List[int] = []
+        self.links: Dict[str, MemberLink] = {}  # by the switch interface id
+
+
+class GenericSystemRecord:
+    __slots__ = ['label', 'group_links']
+
+    def __init__(self, label: str):
+        self.label = label
+        self.group_links: Dict[str, GroupLink] = {}  # by the evpn, AE or switch interface id
+
+
+def _first(nodes: List[dict]) -> Optional[dict]:
+    return nodes[0] if nodes else None
+
+
+def switch_vlan(graph: BlueprintGraph, virtual_network: dict, switch_id: str) -> Any:
+    """
+    The VLAN of the virtual network on the switch, from its vn_instance. The VN label when not found
+    """
+    for vn_instance in graph.out_nodes(virtual_network['id'], 'instantiated_by', 'vn_instance'):
+        if any(x['id'] == switch_id for x in graph.in_nodes(vn_instance['id'], 'hosted_vn_instances', 'system')):
+            return vn_instance.get('vlan_id')
+    return virtual_network.get('label')
+
+
+def inventory_from_graph(graph: BlueprintGraph) -> Dict[str, GenericSystemRecord]:
+    """
+    generic system -> AE -> member link -> tags and VLANs of all the generic systems, in one pass over the graph snapshot
+    """
+    generic_systems = {}
+    for server in graph.find(type='system', system_type='server'):
+        record = None
+        for server_intf in graph.out_nodes(server['id'], 'hosted_interfaces', 'interface'):
+            for link in graph.out_nodes(server_intf['id'], 'link', 'link'):
+                for member_intf in graph.in_nodes(link['id'], 'link', 'interface'):
+                    if member_intf['id'] == server_intf['id'] or member_intf.get('if_type') != 'ethernet':
+                        continue
+                    switch = _first([x for x in graph.in_nodes(member_intf['id'], 'hosted_interfaces', 'system') if x.get('system_type') == 'switch'])
+                    if switch is None:
+                        continue
+                    ae_intf = _first(graph.in_nodes(member_intf['id'], 'composed_of', 'interface'))
+                    evpn_intf = ae_intf and _first([x for x in graph.in_nodes(ae_intf['id'], 'composed_of', 'interface') if x.get('po_control_protocol') == 'evpn'])
+                    # the VLANs are on the outermost interface
+                    group_intf = evpn_intf or ae_intf or member_intf
+                    if record is None:
+                        record = generic_systems[server['id']] = GenericSystemRecord(server.get('label') or server['id'])
+                    group_link = record.group_links.get(group_intf['id'])
+                    if group_link is None:
+                        group_link = record.group_links[group_intf['id']] = GroupLink(ae_intf['if_name'] if ae_intf else '', link.get('speed'))
+                        for endpoint in graph.out_nodes(group_intf['id'], 'hosted_vn_endpoints', 'vn_endpoint'):
+                            for virtual_network in graph.in_nodes(endpoint['id'], 'member_endpoints', 'virtual_network'):
+                                vlan = switch_vlan(graph, virtual_network, switch['id'])
+                                if endpoint.get('tag_type') == 'vlan_tagged':
+                                    group_link.tagged_vlans.append(vlan)
+                                else:
+                                    group_link.untagged_vlan = vlan
+                    member_link = group_link.links.setdefault(member_intf['id'], MemberLink(switch.get('label'), member_intf.get('if_name'), server_intf.get('if_name') or ''))
+                    member_link.tags.extend(x.get('label') for x in graph.in_nodes(link['id'], 'tag', 'tag'))
+    return generic_systems
+
+
+def inventory_from_query(server_links: Iterable[dict]) -> Dict[str, GenericSystemRecord]:
+    """
+    The same inventory from the rows of CkApstraBlueprint.get_switch_interface_nodes(), without the VLANs
+    """
+    generic_systems = {}
+    for server_link in server_links:
+        server = server_link[CkEnum.GENERIC_SYSTEM]
+        member_intf = server_link[CkEnum.MEMBER_INTERFACE]
+        ae_intf = server_link.get(CkEnum.AE_INTERFACE)
+        evpn_intf = server_link.get(CkEnum.EVPN_INTERFACE)
+        record = generic_systems.setdefault(server['id'], GenericSystemRecord(server['label']))
+        group_intf = evpn_intf or ae_intf or member_intf
+        group_link = record.group_links.get(group_intf['id'])
+        if group_link is None:
+            group_link = record.group_links[group_intf['id']] = GroupLink(ae_intf['if_name'] if ae_intf else '', server_link[CkEnum.LINK].get('speed'))
+        server_intf = server_link[CkEnum.GENERIC_SYSTEM_INTERFACE]
+        member_link = group_link.links.setdefault(member_intf['id'], MemberLink(server_link[CkEnum.MEMBER_SWITCH]['label'], member_intf['if_name'], server_intf.get('if_name') or ''))
+        tag = server_link.get(CkEnum.TAG)
+        if tag and tag['label'] not in member_link.tags:
+            member_link.tags.append(tag['label'])
+    return generic_systems
+
+
+def render_rows(index: int, record: GenericSystemRecord) -> str:
+    """
+    The table rows of a generic system, one per member link
+    """
+    rows = []
+    for group_link in record.group_links.values():
+        vlans = escape(', '.join(str(x) for x in sorted(group_link.tagged_vlans, key=str)))
+        untagged = escape(str(group_link.untagged_vlan)) if group_link.untagged_vlan is not None else ''
+        for member_link in group_link.links.values():
+            first = not rows
+            rows.append(
+                f"<tr><td>{index if first else ''}</td><td>{escape(record.label) if first else ''}</td>"
+                f"<td>{escape(group_link.ae_name)}</td><td>{escape(str(group_link.speed or ''))}</td>"
+                f"<td>{escape(member_link.switch or '')}</td><td>{escape(member_link.switch_intf or '')}</td><td>{escape(member_link.server_intf)}</td>"
+                f"<td>{escape(', '.join(member_link.tags))}</td><td>{untagged}</td><td>{vlans}</td></tr>")
+    return ''.join(rows)
 
 
 @dataclass
@@ -9,56 +150,30 @@ class GenericSystemWorker:
     global_store: Any
     logger: Any = logging.getLogger('GenericSystemWorker')
 
-    generic_systems: Any = None  # Dict[str, GenericSystem]
-
-
-    async def pull_generic_systems(self):
-        return
-        for server_link in self.tor_bp.get_switch_interface_nodes():
-            switch_label = server_link[CkEnum.MEMBER_SWITCH]['label']  # tor switch which will be access switch
-            switch_intf = server_link[CkEnum.MEMBER_INTERFACE]['if_name']
-            switch_id = server_link[CkEnum.MEMBER_SWITCH]['id']
-            if tor_gs is None:
-
-                tor_gs = global_store.tor_gs = await make_tor_gs_data(switch_label)
-                # tor_gs.label = cls.guess_tor_gs_label(switch_label)
-                if tor_gs.label is None:
-                    self.logger.error(f"sync_tor_generic_systems() irregular label: {switch_label=}")
-                    return
-            access_switches.setdefault(switch_label, AccessSwitch(label=switch_label, tor_id=switch_id))
-            old_server_label = server_link[CkEnum.GENERIC_SYSTEM]['label']
-            new_label = self.make_new_label(old_server_label)
-            tbody_id = f"gs-{new_label}"
-            # link_id = server_link[CkEnum.LINK]['id']
-            old_switch_intf_id = server_link[CkEnum.MEMBER_INTERFACE]['id']
-            old_ae_name = server_link[CkEnum.AE_INTERFACE]['if_name'] if server_link[CkEnum.AE_INTERFACE] else ''
-            old_ae_id = server_link[CkEnum.EVPN_INTERFACE]['id'] if server_link[CkEnum.EVPN_INTERFACE] else old_switch_intf_id
-            speed = server_link[CkEnum.LINK]['speed']
-            old_server_intf = server_link[CkEnum.GENERIC_SYSTEM_INTERFACE]['if_name'] or ''
-            tag = server_link[CkEnum.TAG]['label'] if server_link[CkEnum.TAG] != None else None
-
-            server_data = generic_systems.setdefault(tbody_id, _GenericSystem(old_label=old_server_label, new_label=new_label, group_links={}))
-            # check if leaf_gs
-            if switch_intf in ['et-0/0/48', 'et-0/0/49']:
-                server_data.is_leaf_gs = True
-                leaf_gs_label = old_server_label
-            ae_data = server_data.group_links.setdefault(old_ae_id, _GroupLink(old_ae_name=old_ae_name, old_ae_id=old_ae_id, speed=speed, old_tagged_vlans={}, old_untagged_vlan={}, links={}))
-            link_data = ae_data.links.setdefault(old_switch_intf_id, _Memberlink(switch=switch_label, switch_intf=switch_intf, old_server_intf=old_server_intf, old_tags=[], new_tags=[]))
-            if tag:
-                link_data.add_old_tag(tag)
-                # await self.sse_logging(f"sync_tor_generic_systems {tag=} {server_label=} {tbody_id=}")            
-        # set index number for each generic system
-        for index, v in enumerate(generic_systems.values()):
-            v.index = index + 1
-
-        # render leaf_gs
-        await SseEvent(data=SseEventData(id='leaf-gs-label', value=leaf_gs_label)).send()
-
-        await SseEvent(data=SseEventData(id='tor1-label', value=global_store.access_switch_pair[0])).send()
-        await SseEvent(data=SseEventData(id='tor2-label', value=global_store.access_switch_pair[1])).send()
-        await SseEvent(data=SseEventData(id='tor1-box').done()).send()
-        await SseEvent(data=SseEventData(id='tor2-box').done()).send()
-
-        await self.sse_logging(f"sync_tor_generic_systems end {len(generic_systems)=}")
-    
-        return
+    generic_systems: Any = None  # Dict[str, GenericSystemRecord] by the generic system node id
+
+    async def pull_generic_systems(self) -> int:
+        """
+        Build the inventory of the generic systems of the main blueprint, and render it in batches of GS_TBODY_SIZE
+        Return the number of the generic systems
+        """
+        store = self.global_store
+        the_bp = store.blueprints[store.main_blueprint]
+        await store.sse_logging(f"pull_generic_systems() begin {the_bp.label}")
+
+        graph = await store.blueprint_graph(the_bp, await store.blueprint_version(the_bp))
+        with span('generic-system-inventory'):
+            if graph:
+                self.generic_systems = await run_blocking(inventory_from_graph, graph)
+            else:
+                server_links = await run_blocking(the_bp.get_switch_interface_nodes)
+                self.generic_systems = await run_blocking(inventory_from_query, server_links)
+
+        records = sorted(self.generic_systems.values(), key=lambda x: x.label)
+        await SseEvent(data=SseEventData(id=GS_TABLE_ID).inner_html(GS_TABLE_HEAD)).send()
+        for begin in range(0, len(records), GS_TBODY_SIZE):
+            tbody = ''.join(render_rows(begin + offset + 1, record) for offset, record in enumerate(records[begin:begin + GS_TBODY_SIZE]))
+            await SseEvent(event='tbody-gs', data=SseEventData(id=f"gs-tbody-{begin // GS_TBODY_SIZE}", value=tbody)).send()
+
+        await store.sse_logging(f"pull_generic_systems() end {len(records)=} from {'the graph snapshot' if graph else 'the graph query'}")
+        return len(records)
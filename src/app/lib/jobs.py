@@ -0,0 +1,300 @@
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from enum import StrEnum
+import asyncio
+import logging
+import os
+import re
+import tempfile
+import time
+import uuid
+from typing import Any, AsyncIterator, Awaitable, BinaryIO, Callable, Dict, Iterator, List, Optional, Tuple
+
+from app.lib.metrics import Timings, current_timings
+from app.lib.offload import run_blocking
+
+# the number of jobs running at the same time. the others wait in the queue. override by APSTRA_JOB_WORKERS
+JOB_WORKERS = int(os.getenv('APSTRA_JOB_WORKERS', '2'))
+# the directory of the job artifacts. override by APSTRA_JOB_DIR
+JOB_DIR = os.getenv('APSTRA_JOB_DIR', os.path.join(tempfile.gettempdir(), 'ck-apstra-web-tool-jobs'))
+# the finished jobs and their artifacts are dropped after this many seconds
+JOB_RETENTION = int(os.getenv('APSTRA_JOB_RETENTION', '3600'))
+# the seconds between the progress events while an artifact is written
+JOB_PROGRESS_INTERVAL = 1.0
+# the bytes read from an artifact at a time for the download
+JOB_DOWNLOAD_CHUNK_SIZE = 256 * 1024
+# the seconds between the checks of the cancel asked to another worker
+JOB_CANCEL_POLL = 1.0
+
+_BYTE_RANGE = re.compile(r'bytes=(\d*)-(\d*)$')
+
+
+class JobStatusEnum(StrEnum):
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+
+
+FINISHED_STATUS = (JobStatusEnum.DONE, JobStatusEnum.FAILED, JobStatusEnum.CANCELLED)
+
+
+@dataclass
+class Job:
+    id: str
+    kind: str  # pull-config, pull-bp-json, push-bp-json
+    owner: Any = None  # the GlobalStore of the session which submitted the job
+    session_id: Optional[str] = None  # the web session of the owner, to find the job from another worker
+    status: str = JobStatusEnum.QUEUED
+    message: str = ''
+    artifact_name: Optional[str] = None  # the download file name
+    artifact_path: Optional[str] = None
+    artifact_size: int = 0
+    created: float = field(default_factory=time.time)
+    started: Optional[float] = None
+    finished: Optional[float] = None
+    task: Optional[asyncio.Task] = field(default=None, repr=False)
+    timings: Timings = field(default_factory=Timings, repr=False)  # the spans of the job
+
+    @property
+    def is_finished(self) -> bool:
+        return self.status in FINISHED_STATUS
+
+    def summary(self) -> Dict[str, Any]:
+        """
+        The job in the /jobs responses and the 'job' SSE event
+        """
+        return {
+            'job_id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'message': self.message,
+            'artifact_name': self.artifact_name,
+            'artifact_size': self.artifact_size,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+        }
+
+    def record(self) -> Dict[str, Any]:
+        """
+        The job in the shared state backend
+        """
+        return {**self.summary(), 'session_id': self.session_id, 'artifact_path': self.artifact_path}
+
+    @classmethod
+    def from_record(cls, record: Dict[str, Any], owner: Any = None) -> 'Job':
+        """
+        The job of another worker, without its task
+        """
+        return cls(id=record['job_id'], kind=record['kind'], owner=owner, session_id=record['session_id'], status=record['status'],
+                   message=record['message'], artifact_name=record['artifact_name'], artifact_path=record['artifact_path'],
+                   artifact_size=record['artifact_size'], created=record['created'], started=record['started'], finished=record['finished'])
+
+
+# the job of the running task, to tag its log lines
+current_job: ContextVar[Optional[Job]] = ContextVar('current_job', default=None)
+
+
+@dataclass
+class JobManager:
+    """
+    Run the submitted jobs in the background, at most workers at a time
+    The work of a job is a coroutine function taking the job. It writes the artifact at job.artifact_path, if any
+    The job task runs in the context of the submitter, so its SSE events go to the session of the submitter
+    With a shared state backend, the jobs are recorded so that the other workers can list, cancel and download them
+    """
+    workers: int = JOB_WORKERS
+    job_dir: str = JOB_DIR
+    retention: int = JOB_RETENTION
+    notify: Optional[Callable[[Job], Awaitable[None]]] = None  # called on every change of the job, to send the SSE
+    backend: Any = None  # the shared StateBackend, None in one process
+    jobs: Dict[str, Job] = field(default_factory=dict)
+    semaphore: Optional[asyncio.Semaphore] = None  # created on the first submit
+    logger: Any = logging.getLogger('JobManager')
+
+    def submit(self, kind: str, work: Callable[[Job], Awaitable[None]], artifact_name: Optional[str] = None, owner: Any = None) -> Job:
+        """
+        Queue the work and return the job right away
+        """
+        self.prune()
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(max(1, self.workers))
+        job = Job(id=uuid.uuid4().hex, kind=kind, owner=owner, session_id=getattr(owner, 'session_id', None), artifact_name=artifact_name)
+        if artifact_name:
+            os.makedirs(self.job_dir, exist_ok=True)
+            job.artifact_path = os.path.join(self.job_dir, job.id)
+        self.jobs[job.id] = job
+        job.task = asyncio.create_task(self.run(job, work))
+        self.logger.info(f"submit() {job.id=} {kind=} {artifact_name=}")
+        return job
+
+    async def update(self, job: Job, status: Optional[str] = None, message: Optional[str] = None) -> None:
+        if status is not None:
+            job.status = status
+        if message is not None:
+            job.message = message
+        if self.notify:
+            await self.notify(job)
+        if self.backend:
+            await run_blocking(self.backend.save_job, job.record(), time.time() - self.retention)
+
+    async def watch_cancel(self, job: Job) -> None:
+        """
+        Cancel the job when DELETE /jobs/<job_id> came to another worker
+        """
+        while not await run_blocking(self.backend.cancel_requested, job.id):
+            await asyncio.sleep(JOB_CANCEL_POLL)
+        self.logger.info(f"watch_cancel() {job.id=}")
+        job.task.cancel()
+
+    async def run(self, job: Job, work: Callable[[Job], Awaitable[None]]) -> None:
+        current_job.set(job)
+        current_timings.set(job.timings)
+        await self.update(job)
+        watcher = asyncio.create_task(self.watch_cancel(job)) if self.backend else None
+        try:
+            async with self.semaphore:
+                job.started = time.time()
+                await self.update(job, JobStatusEnum.RUNNING)
+                await work(job)
+            status, message = JobStatusEnum.DONE, job.message
+        except asyncio.CancelledError:
+            status, message = JobStatusEnum.CANCELLED, 'cancelled'
+        except Exception as e:
+            self.logger.exception(f"run() {job.id=} failed")
+            status, message = JobStatusEnum.FAILED, f"{e!r}"
+        if watcher:
+            watcher.cancel()
+        job.finished = time.time()
+        if status != JobStatusEnum.DONE:
+            self.remove_artifact(job)
+        await self.update(job, status, message)
+
+    async def write_artifact(self, job: Job, chunks: AsyncIterator[bytes]) -> None:
+        """
+        Write the chunks to the artifact of the job, reporting the size as the progress
+        """
+        reported = time.monotonic()
+        with open(job.artifact_path, 'wb') as f:
+            async for chunk in chunks:
+                f.write(chunk)
+                job.artifact_size += len(chunk)
+                if time.monotonic() - reported >= JOB_PROGRESS_INTERVAL:
+                    reported = time.monotonic()
+                    await self.update(job, message=f"{job.artifact_size} bytes")
+        job.message = f"{job.artifact_size} bytes"
+
+    def get(self, job_id: str, owner: Any = None) -> Optional[Job]:
+        """
+        Return the job of the owner. None for the job of the other sessions
+        """
+        job = self.jobs.get(job_id)
+        if job is None or (owner is not None and job.owner is not owner):
+            return None
+        return job
+
+    def has_jobs(self, owner: Any) -> bool:
+        """
+        Whether the owner has a job queued or running, or finished with the artifact kept for the download
+        """
+        self.prune()
+        return any(x.owner is owner for x in self.jobs.values())
+
+    def list(self, owner: Any = None) -> List[Job]:
+        self.prune()
+        return [x for x in self.jobs.values() if owner is None or x.owner is owner]
+
+    async def find(self, job_id: str, owner: Any) -> Optional[Job]:
+        """
+        get() including the jobs of the owner's session run by the other workers
+        """
+        job = self.get(job_id, owner)
+        if job is not None or self.backend is None:
+            return job
+        record = await run_blocking(self.backend.load_job, job_id)
+        session_id = getattr(owner, 'session_id', None)
+        if record is None or session_id is None or record['session_id'] != session_id:
+            return None
+        return Job.from_record(record, owner)
+
+    async def find_all(self, owner: Any) -> List[Job]:
+        """
+        list() including the jobs of the owner's session run by the other workers
+        """
+        jobs = {x.id: x for x in self.list(owner)}
+        session_id = getattr(owner, 'session_id', None)
+        if self.backend is not None and session_id is not None:
+            for record in await run_blocking(self.backend.list_jobs, session_id):
+                jobs.setdefault(record['job_id'], Job.from_record(record, owner))
+        return sorted(jobs.values(), key=lambda x: x.created)
+
+    def cancel(self, job: Job) -> bool:
+        """
+        Cancel the queued or running job. False if it has finished already
+        """
+        if job.is_finished or job.task is None:
+            return False
+        return job.task.cancel()
+
+    async def cancel_anywhere(self, job: Job) -> bool:
+        """
+        cancel() the job of this worker, or ask the worker running it
+        """
+        if job.task is not None or job.is_finished or self.backend is None:
+            return self.cancel(job)
+        return await run_blocking(self.backend.request_cancel, job.id)
+
+    def remove_artifact(self, job: Job) -> None:
+        if job.artifact_path and os.path.exists(job.artifact_path):
+            os.remove(job.artifact_path)
+        job.artifact_size = 0
+
+    def prune(self) -> None:
+        """
+        Drop the jobs finished before the retention, with their artifacts
+        """
+        expire_before = time.time() - self.retention
+        for job in [x for x in self.jobs.values() if x.is_finished and x.finished < expire_before]:
+            self.remove_artifact(job)
+            self.jobs.pop(job.id)
+
+
+def parse_range(range_header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """
+    Return (start, end) inclusive of the single byte range header 'bytes=start-end', 'bytes=start-' or 'bytes=-suffix'
+    None to send the whole content: no header, or the forms not supported like multiple ranges
+    Raise ValueError when the range is not satisfiable
+    """
+    if not range_header:
+        return None
+    match = _BYTE_RANGE.match(range_header.strip())
+    if not match or match.group(1) == match.group(2) == '':
+        return None
+    first, last = match.groups()
+    if first == '':
+        suffix = int(last)
+        if suffix == 0:
+            raise ValueError(f"parse_range() empty suffix {range_header=}")
+        return max(0, size - suffix), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise ValueError(f"parse_range() not satisfiable {range_header=} {size=}")
+    return start, end
+
+
+def iter_file_range(fp: BinaryIO, start: int, end: int, chunk_size: int = JOB_DOWNLOAD_CHUNK_SIZE) -> Iterator[bytes]:
+    """
+    Yield the bytes from start to end inclusive of the file, closing it at the end
+    """
+    with fp:
+        fp.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = fp.read(min(chunk_size, remaining))
+            if not chunk:
+                return
+            remaining -= len(chunk)
+            yield chunk
@@ -0,0 +1,118 @@
+import codecs
+import json
+import re
+from typing import Any, BinaryIO, Iterator, Optional, Sequence, Tuple
+
+# the bytes read from the file at a time
+JSON_CHUNK_SIZE = 64 * 1024
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+class JsonStreamReader:
+    """
+    Incremental reader of a JSON object from a binary file
+    Only the value being decoded and one chunk are kept in memory
+    """
+    def __init__(self, fp: BinaryIO, chunk_size: int = JSON_CHUNK_SIZE):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self) -> bool:
+        """
+        Read the next chunk into the buffer, dropping the consumed part. False at the end of the file
+        """
+        if self.eof:
+            return False
+        data = self.fp.read(self.chunk_size)
+        if not data:
+            self.eof = True
+            self.buffer = self.buffer[self.pos:] + self.utf8.decode(b'', final=True)
+        else:
+            self.buffer = self.buffer[self.pos:] + self.utf8.decode(data)
+        self.pos = 0
+        return True
+
+    def _next_char(self) -> str:
+        """
+        Return the next non whitespace character without consuming it. '' at the end of the file
+        """
+        while True:
+            self.pos = _WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ''
+
+    def _expect(self, expected: str) -> None:
+        char = self._next_char()
+        if char != expected:
+            raise ValueError(f"JSON stream: expected {expected!r}, got {char!r} at {self.pos}")
+        self.pos += 1
+
+    def read_value(self) -> Any:
+        """
+        Decode the next complete value
+        """
+        self._next_char()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # a number at the end of the buffer might continue in the next chunk
+            if end == len(self.buffer) and not self.eof:
+                self._fill()
+                continue
+            self.pos = end
+            return value
+
+    def iter_object(self) -> Iterator[str]:
+        """
+        Iterate the keys of the object at the current position
+        The caller consumes the value of each key (read_value, iter_object) before the next iteration
+        """
+        self._expect('{')
+        if self._next_char() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.read_value()
+            self._expect(':')
+            yield key
+            char = self._next_char()
+            self.pos += 1
+            if char == '}':
+                return
+            if char != ',':
+                raise ValueError(f"JSON stream: expected ',' or '}}', got {char!r}")
+
+    def is_object_next(self) -> bool:
+        return self._next_char() == '{'
+
+
+def iter_json_entries(fp: BinaryIO, stream_keys: Sequence[str] = ('nodes', 'relationships'), chunk_size: int = JSON_CHUNK_SIZE) -> Iterator[Tuple[str, Optional[str], Any]]:
+    """
+    Iterate a JSON object from the file without loading it
+        (key, None, value) for a top level key
+        (key, sub_key, value) for each entry of the top level object under stream_keys, like nodes and relationships
+        (key, None, {}) for the empty object under stream_keys
+    """
+    reader = JsonStreamReader(fp, chunk_size)
+    for key in reader.iter_object():
+        if key in stream_keys and reader.is_object_next():
+            empty = True
+            for sub_key in reader.iter_object():
+                empty = False
+                yield key, sub_key, reader.read_value()
+            if empty:
+                yield key, None, {}
+        else:
+            yield key, None, reader.read_value()
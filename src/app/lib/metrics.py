@@ -0,0 +1,216 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+import threading
+import time
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+# the upper bounds of the latency histograms in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# the path segment after these is an id, replaced with {id} in the endpoint label
+_ID_PARENTS = {'blueprints', 'nodes', 'systems', 'relationships', 'tasks'}
+
+
+def _label_key(labels: Dict[str, str]) -> Tuple[Tuple[str, str], ...]:
+    return tuple(sorted(labels.items()))
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _label_text(key: Tuple[Tuple[str, str], ...], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(key) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+
+class Metric:
+    """
+    A metric in the Prometheus text format, with the values by the labels
+    """
+    kind = 'untyped'
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def samples(self) -> List[str]:
+        return []
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        return '\n'.join(lines + self.samples())
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, help_text: str):
+        super().__init__(name, help_text)
+        self.values: Dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = _label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> List[str]:
+        with self.lock:
+            return [f"{self.name}{_label_text(k)} {v}" for k, v in self.values.items()]
+
+
+class Gauge(Metric):
+    """
+    The value is set, or taken from the function at the scrape
+    """
+    kind = 'gauge'
+
+    def __init__(self, name: str, help_text: str, func: Optional[Callable[[], float]] = None):
+        super().__init__(name, help_text)
+        self.func = func
+        self.values: Dict[tuple, float] = {}
+
+    def set(self, value: float, **labels) -> None:
+        with self.lock:
+            self.values[_label_key(labels)] = value
+
+    def samples(self) -> List[str]:
+        if self.func:
+            return [f"{self.name} {self.func()}"]
+        with self.lock:
+            return [f"{self.name}{_label_text(k)} {v}" for k, v in self.values.items()]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help_text: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, help_text)
+        self.buckets = buckets
+        self.values: Dict[tuple, list] = {}  # [ bucket counts..., +Inf count, sum ]
+
+    def observe(self, value: float, **labels) -> None:
+        key = _label_key(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def samples(self) -> List[str]:
+        lines = []
+        with self.lock:
+            for key, counts in self.values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else str(bound)
+                    lines.append(f"{self.name}_bucket{_label_text(key, ('le', le))} {cumulative}")
+                lines.append(f"{self.name}_sum{_label_text(key)} {counts[-1]}")
+                lines.append(f"{self.name}_count{_label_text(key)} {cumulative}")
+        return lines
+
+
+REGISTRY: List[Metric] = []
+
+STAGE_SECONDS = Histogram('apstra_web_stage_seconds', 'The time of the stages of the pulls and the pushes')
+APSTRA_REQUEST_SECONDS = Histogram('apstra_web_apstra_request_seconds', 'The time to the response headers of the Apstra API calls')
+APSTRA_REQUESTS = Counter('apstra_web_apstra_requests_total', 'The Apstra API calls by the status code')
+BYTES_STREAMED = Counter('apstra_web_bytes_streamed_total', 'The bytes streamed by the route')
+APSTRA_CONNECTIONS = Counter('apstra_web_apstra_connections_total', 'The connections to Apstra taken for the calls, opened or reused from the pool')
+SSE_LAG_SECONDS = Histogram('apstra_web_sse_lag_seconds', 'The time from the oldest queued event to its send on /sse')
+
+
+def render_metrics() -> str:
+    return '\n'.join(metric.render() for metric in REGISTRY) + '\n'
+
+
+class Timings:
+    """
+    The count, the total and the max seconds of the spans of a job
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.spans: Dict[str, List[float]] = {}
+
+    def add(self, name: str, seconds: float) -> None:
+        with self.lock:
+            span = self.spans.setdefault(name, [0, 0.0, 0.0])
+            span[0] += 1
+            span[1] += seconds
+            span[2] = max(span[2], seconds)
+
+    def summary(self) -> str:
+        """
+        One line per span, the longest total first
+        """
+        with self.lock:
+            spans = sorted(self.spans.items(), key=lambda x: x[1][1], reverse=True)
+        return '\n'.join(f"  {name}: count={count} total={total:.3f}s max={longest:.3f}s" for name, (count, total, longest) in spans)
+
+
+# the timings of the running job. the worker threads see it through the copied context
+current_timings: ContextVar[Optional[Timings]] = ContextVar('current_timings', default=None)
+
+
+def record_span(name: str, seconds: float) -> None:
+    timings = current_timings.get()
+    if timings is not None:
+        timings.add(name, seconds)
+
+
+@contextmanager
+def span(stage: str) -> Iterator[None]:
+    """
+    Time the stage into STAGE_SECONDS and the timings of the running job
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        STAGE_SECONDS.observe(seconds, stage=stage)
+        record_span(stage, seconds)
+
+
+def apstra_endpoint(url: str) -> str:
+    """
+    The path of the Apstra API url with the ids replaced, like /api/blueprints/{id}/nodes/{id}/config-rendering
+    """
+    segments = urlsplit(url).path.split('/')
+    return '/'.join('{id}' if i > 0 and segments[i - 1] in _ID_PARENTS else x for i, x in enumerate(segments))
+
+
+def apstra_metrics_hook(response, **kwargs):
+    """
+    requests response hook. Observe the latency of the Apstra API call
+    """
+    method = response.request.method
+    endpoint = apstra_endpoint(response.request.url)
+    seconds = response.elapsed.total_seconds()
+    APSTRA_REQUEST_SECONDS.observe(seconds, method=method, endpoint=endpoint)
+    APSTRA_REQUESTS.inc(method=method, endpoint=endpoint, code=str(response.status_code))
+    record_span(f"apstra {method} {endpoint}", seconds)
+    return response
+
+
+async def count_bytes(chunks: AsyncIterator[bytes], route: str) -> AsyncIterator[bytes]:
+    """
+    Pass the chunks through, counting them into BYTES_STREAMED
+    """
+    async for chunk in chunks:
+        BYTES_STREAMED.inc(len(chunk), route=route)
+        yield chunk
+
+
+def count_bytes_blocking(chunks: Iterator[bytes], route: str) -> Iterator[bytes]:
+    for chunk in chunks:
+        BYTES_STREAMED.inc(len(chunk), route=route)
+        yield chunk
@@ -0,0 +1,44 @@
+from concurrent.futures import Executor, ThreadPoolExecutor
+import asyncio
+import contextvars
+import functools
+import os
+from typing import Any, AsyncIterator, Callable, Iterator, Optional
+
+# the threads to run the blocking Apstra API calls. override by APSTRA_OFFLOAD_WORKERS
+APSTRA_OFFLOAD_WORKERS = int(os.getenv('APSTRA_OFFLOAD_WORKERS', '16'))
+
+apstra_executor = ThreadPoolExecutor(max_workers=APSTRA_OFFLOAD_WORKERS, thread_name_prefix='apstra')
+
+
+async def run_blocking(func: Callable, *args, **kwargs) -> Any:
+    """
+    Run the blocking function (CkApstraSession, CkApstraBlueprint calls) in the apstra executor
+    so that the event loop keeps serving /sse and the other routes
+    The function runs in a copy of the context, to see the timings of the running job
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(apstra_executor, functools.partial(context.run, func, *args, **kwargs))
+
+
+async def iterate_blocking(iterator: Iterator, executor: Optional[Executor] = None) -> AsyncIterator:
+    """
+    Iterate the blocking iterator (reading from Apstra) in the apstra executor, or in the given executor
+    """
+    loop = asyncio.get_running_loop()
+    done = object()
+    try:
+        while True:
+            if executor is None:
+                item = await run_blocking(next, iterator, done)
+            else:
+                item = await loop.run_in_executor(executor, next, iterator, done)
+            if item is done:
+                return
+            yield item
+    finally:
+        # release the response of an abandoned download
+        close = getattr(iterator, 'close', None)
+        if close:
+            close()
@@ -0,0 +1,152 @@
+from dataclasses import dataclass, field
+import asyncio
+import logging
+import os
+import secrets
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from starlette.datastructures import MutableHeaders
+from starlette.requests import cookie_parser
+
+from app.lib.offload import run_blocking
+from app.lib.sse_hub import current_sse_hub
+from app.lib.state_backend import SESSION_TOUCH_INTERVAL, StateBackend
+
+SESSION_COOKIE = 'apstra_web_session'
+# the store of a session not used for this many seconds is dropped
+SESSION_IDLE_TTL = int(os.getenv('APSTRA_SESSION_IDLE_TTL', '3600'))
+# the paths served without a session store
+SESSIONLESS_PREFIXES = ('/static/', '/js/', '/css/', '/images/', '/metrics')
+
+
+@dataclass
+class SessionEntry:
+    store: Any  # GlobalStore
+    last_used: float = field(default_factory=time.monotonic)
+    # the state in the shared backend, as saved or restored by this worker
+    state: Optional[dict] = None
+    version: int = 0  # 0 until saved
+    saved: float = 0.0  # time.monotonic() of the last save or touch
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock, repr=False)
+
+
+@dataclass
+class SessionRegistry:
+    """
+    The GlobalStore of each browser session, keyed by the session cookie
+    With a shared state backend, the state of the sessions is saved after the requests, and a session of another
+    worker is restored here on its first request: login again to the server and the blueprints of the session
+    """
+    store_factory: Callable[..., Any]  # store_factory(session_id=)
+    idle_ttl: int = SESSION_IDLE_TTL
+    backend: StateBackend = field(default_factory=StateBackend)
+    sessions: Dict[str, SessionEntry] = field(default_factory=dict)
+    busy: Optional[Callable[[Any], bool]] = None  # busy(store) is True while the store owns the jobs, not evicted then
+    logger: Any = logging.getLogger('SessionRegistry')
+
+    def get(self, session_id: Optional[str]) -> Tuple[str, Any, bool]:
+        """
+        Return the session id, the store, and whether the session is new
+        """
+        self.evict_idle()
+        entry = self.sessions.get(session_id) if session_id else None
+        if entry:
+            entry.last_used = time.monotonic()
+            return session_id, entry.store, False
+        session_id = secrets.token_urlsafe(24)
+        self.sessions[session_id] = SessionEntry(self.store_factory(session_id=session_id))
+        self.logger.info(f"get() new session {len(self.sessions)=}")
+        return session_id, self.sessions[session_id].store, True
+
+    async def resolve(self, session_id: Optional[str]) -> Tuple[str, Any, bool]:
+        """
+        get() with the sessions of the other workers restored from the shared backend
+        """
+        if not self.backend.shared:
+            return self.get(session_id)
+        record = await run_blocking(self.backend.load_session, session_id) if session_id else None
+        if record is None and session_id not in self.sessions:
+            session_id, store, _ = self.get(None)
+            # known to the other workers before the cookie is sent
+            await self.save(session_id, store)
+            return session_id, store, True
+        self.evict_idle()
+        entry = self.sessions.get(session_id)
+        if entry is None:
+            entry = self.sessions[session_id] = SessionEntry(self.store_factory(session_id=session_id))
+        entry.last_used = time.monotonic()
+        store = entry.store
+        if record is None:
+            # dropped as idle by another worker
+            entry.version = 0
+        elif record['version'] != entry.version:
+            async with entry.lock:
+                if record['version'] != entry.version:
+                    self.logger.info(f"resolve() restore the session {entry.version=} {record['version']=}")
+                    await store.restore_state(record['state'])
+                    entry.state, entry.version = record['state'], record['version']
+        return session_id, store, False
+
+    async def save(self, session_id: str, store: Any) -> None:
+        """
+        Save the state of the session when it changed, or keep it alive in the shared backend
+        """
+        entry = self.sessions.get(session_id)
+        if not self.backend.shared or entry is None:
+            return
+        state = store.session_state()
+        if entry.version == 0 or state != entry.state:
+            entry.state = state
+            entry.version = await run_blocking(self.backend.save_session, session_id, state)
+            entry.saved = time.monotonic()
+        elif time.monotonic() - entry.saved > SESSION_TOUCH_INTERVAL:
+            entry.saved = time.monotonic()
+            await run_blocking(self.backend.touch_session, session_id, self.idle_ttl)
+
+    def evict_idle(self) -> None:
+        """
+        Drop and close the stores not used for idle_ttl
+        An open /sse connection keeps the session, and so do its jobs: the running ones use the store, and the
+        finished ones are found by the store of the session until the retention
+        """
+        expire_before = time.monotonic() - self.idle_ttl
+        idle = [k for k, v in self.sessions.items() if v.last_used < expire_before and not v.store.sse_hub.subscribers]
+        for session_id in [x for x in idle if self.busy is None or not self.busy(self.sessions[x].store)]:
+            self.sessions.pop(session_id).store.close()
+            self.logger.info(f"evict_idle() {len(self.sessions)=}")
+
+
+class SessionMiddleware:
+    """
+    Attach the GlobalStore of the session to request.state.store and route the SSE events to its hub
+    The changed state of the session is saved before the response starts, for the next request on another worker
+    """
+    def __init__(self, app, registry: SessionRegistry):
+        self.app = app
+        self.registry = registry
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['path'].startswith(SESSIONLESS_PREFIXES):
+            await self.app(scope, receive, send)
+            return
+
+        cookie_header = dict(scope['headers']).get(b'cookie', b'').decode('latin-1')
+        session_id, store, is_new = await self.registry.resolve(cookie_parser(cookie_header).get(SESSION_COOKIE))
+        scope.setdefault('state', {})['store'] = store
+
+        async def send_with_cookie(message):
+            if message['type'] == 'http.response.start':
+                await self.registry.save(session_id, store)
+                if is_new:
+                    headers = MutableHeaders(scope=message)
+                    headers.append('set-cookie', f"{SESSION_COOKIE}={session_id}; Path=/; HttpOnly; SameSite=Lax")
+            await send(message)
+
+        token = current_sse_hub.set(store.sse_hub)
+        try:
+            await self.app(scope, receive, send_with_cookie)
+        finally:
+            current_sse_hub.reset(token)
+            # the changes made while streaming
+            await self.registry.save(session_id, store)
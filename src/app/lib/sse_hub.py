@@ -0,0 +1,139 @@
+from collections import deque
+from contextvars import ContextVar
+import asyncio
+import logging
+import os
+import time
+from typing import Any, Deque, List, Optional, Set
+
+from app.lib.metrics import SSE_LAG_SECONDS
+
+# the last events kept for the reconnecting clients (Last-Event-ID). the only memory used when nobody listens
+SSE_REPLAY_SIZE = int(os.getenv('SSE_REPLAY_SIZE', '1000'))
+# the events kept for a connected client. the oldest events are dropped when the client is slower than this
+SSE_SUBSCRIBER_BUFFER = int(os.getenv('SSE_SUBSCRIBER_BUFFER', '5000'))
+
+
+class SseSubscriber:
+    """
+    The bounded event buffer of a /sse connection
+    """
+    __slots__ = ['buffer', 'max_size', 'wakeup', 'dropped', 'waiting_since']
+
+    def __init__(self, max_size: int):
+        self.buffer: Deque[dict] = deque()
+        self.max_size = max_size
+        self.wakeup = asyncio.Event()
+        self.dropped = 0
+        self.waiting_since: Optional[float] = None  # time.monotonic() when the oldest queued event came
+
+    def push(self, item: dict) -> None:
+        if not self.buffer:
+            self.waiting_since = time.monotonic()
+        if len(self.buffer) >= self.max_size:
+            # slow consumer: drop the oldest and let the client know on the next batch
+            self.buffer.popleft()
+            self.dropped += 1
+        self.buffer.append(item)
+        self.wakeup.set()
+
+    def take_dropped(self) -> int:
+        """
+        Return the number of the dropped events since the last call
+        """
+        dropped, self.dropped = self.dropped, 0
+        return dropped
+
+    def lag(self) -> float:
+        """
+        The seconds the oldest queued event has waited
+        """
+        return time.monotonic() - self.waiting_since if self.buffer else 0.0
+
+    async def next_batch(self, max_events: int, deadline: float) -> List[dict]:
+        """
+        Wait for an event, then collect the following events until the batch is full or the deadline passes
+        """
+        while not self.buffer:
+            self.wakeup.clear()
+            await self.wakeup.wait()
+        loop = asyncio.get_running_loop()
+        flush_at = loop.time() + deadline
+        while len(self.buffer) < max_events:
+            remaining = flush_at - loop.time()
+            if remaining <= 0:
+                break
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+        SSE_LAG_SECONDS.observe(self.lag())
+        batch = [self.buffer.popleft() for _ in range(min(max_events, len(self.buffer)))]
+        # the rest waits from now, close enough for the lag
+        self.waiting_since = time.monotonic()
+        return batch
+
+
+class SseHub:
+    """
+    Broadcast the SSE events to every /sse connection
+    Each event gets an increasing id so that the reconnecting clients get the missed events replayed
+    With the relay of a shared state backend, the events of the session go through the backend to the hubs of every worker
+    """
+    def __init__(self, replay_size: int = SSE_REPLAY_SIZE, subscriber_buffer: int = SSE_SUBSCRIBER_BUFFER,
+                 session_id: Optional[str] = None, relay: Any = None):
+        self.last_id = 0
+        self.replay: Deque[dict] = deque(maxlen=replay_size)
+        self.subscriber_buffer = subscriber_buffer
+        self.subscribers: Set[SseSubscriber] = set()
+        self.session_id = session_id
+        self.relay = relay  # EventRelay, None in one process
+        self.logger = logging.getLogger('SseHub')
+
+    def publish(self, event: str, data: str) -> Optional[dict]:
+        if self.relay is not None:
+            # the id comes from the backend
+            self.relay.publish(self, event, data)
+            return None
+        self.last_id += 1
+        item = {'id': str(self.last_id), 'event': event, 'data': data}
+        self.deliver(item)
+        return item
+
+    def deliver(self, item: dict) -> None:
+        self.replay.append(item)
+        for subscriber in self.subscribers:
+            subscriber.push(item)
+
+    def subscribe(self, last_event_id: Optional[str] = None) -> SseSubscriber:
+        """
+        Add a subscriber. When last_event_id is given, the later events still in the replay buffer are queued first
+        """
+        subscriber = SseSubscriber(self.subscriber_buffer)
+        if last_event_id and last_event_id.isdigit():
+            after = int(last_event_id)
+            for item in self.replay:
+                if int(item['id']) > after:
+                    subscriber.push(item)
+        self.subscribers.add(subscriber)
+        self.logger.info(f"subscribe() {last_event_id=} {len(subscriber.buffer)=} {len(self.subscribers)=}")
+        return subscriber
+
+    def unsubscribe(self, subscriber: SseSubscriber) -> None:
+        self.subscribers.discard(subscriber)
+        self.logger.info(f"unsubscribe() {len(self.subscribers)=}")
+
+    def close(self) -> None:
+        """
+        Drop the replay buffer and the subscribers, and leave the relay. The hub of an evicted session
+        """
+        self.replay.clear()
+        self.subscribers.clear()
+        if self.relay is not None:
+            self.relay.hubs.pop(self.session_id, None)
+
+
+# the hub of the web session handling the current request. SseEvent.send() falls back to the process wide hub
+# None for the headless runs, without the events
+current_sse_hub: ContextVar[Optional[SseHub]] = ContextVar('current_sse_hub')
@@ -0,0 +1,306 @@
+from contextlib import contextmanager
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from app.lib.offload import run_blocking
+
+# the state shared by the web workers: memory for one process, or sqlite:<path> of a database file for run-web --workers
+APSTRA_STATE_BACKEND = os.getenv('APSTRA_STATE_BACKEND', 'memory')
+# the seconds between the reads of the events published by the workers
+SSE_RELAY_INTERVAL = float(os.getenv('SSE_RELAY_INTERVAL', '0.05'))
+# the seconds the events are kept in the database for the reconnecting clients
+SSE_RELAY_RETENTION = int(os.getenv('SSE_RELAY_RETENTION', '600'))
+# the events read at a time
+SSE_RELAY_READ_SIZE = 5000
+# the seconds between the updates of the last use of a session in the database
+SESSION_TOUCH_INTERVAL = 60
+# the seconds to wait for the lock of the database
+SQLITE_TIMEOUT = 30
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (session_id TEXT PRIMARY KEY, state TEXT, version INTEGER NOT NULL, last_used REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT NOT NULL, event TEXT NOT NULL, data TEXT NOT NULL, created REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS events_session ON events (session_id, id);
+CREATE TABLE IF NOT EXISTS jobs (job_id TEXT PRIMARY KEY, session_id TEXT, record TEXT NOT NULL, finished REAL, cancel INTEGER NOT NULL DEFAULT 0);
+"""
+
+
+class StateBackend:
+    """
+    The state of the web sessions kept in the process: nothing is shared, for a single worker
+    """
+    shared = False
+
+    def load_session(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """
+        { 'state': GlobalStore.session_state(), 'version': n } of the session, None if unknown
+        """
+        return None
+
+    def save_session(self, session_id: str, state: Optional[dict]) -> int:
+        """
+        Store the state of the session. Return its new version
+        """
+        return 0
+
+    def touch_session(self, session_id: str, idle_ttl: float) -> None:
+        """
+        Keep the session alive, and drop the sessions not used for idle_ttl seconds
+        """
+
+    def append_events(self, items: List[Tuple[str, str, str]]) -> None:
+        """
+        Add the events (session_id, event, data), in order
+        """
+
+    def read_events(self, after: int, upto: Optional[int] = None, session_id: Optional[str] = None, limit: int = SSE_RELAY_READ_SIZE) -> List[dict]:
+        """
+        [ { id:, session_id:, event:, data: } ] of the events after the id, of all the sessions or of the session
+        """
+        return []
+
+    def last_event_id(self) -> int:
+        return 0
+
+    def drop_events(self, before: float) -> None:
+        """
+        Drop the events added before the time
+        """
+
+    def save_job(self, record: Dict[str, Any], expire_before: float) -> None:
+        """
+        Store the job record of Job.record(), and drop the jobs finished before expire_before
+        """
+
+    def load_job(self, job_id: str) -> Optional[Dict[str, Any]]:
+        return None
+
+    def list_jobs(self, session_id: str) -> List[Dict[str, Any]]:
+        return []
+
+    def request_cancel(self, job_id: str) -> bool:
+        """
+        Ask the worker running the job to cancel it. False if the job is unknown
+        """
+        return False
+
+    def cancel_requested(self, job_id: str) -> bool:
+        return False
+
+
+class SqliteStateBackend(StateBackend):
+    """
+    The state of the web sessions in a SQLite database file, shared by the workers on the host
+        sessions: the state of each session, to restore the GlobalStore in another worker
+        events: the SSE events of the sessions, relayed to the /sse connections of every worker
+        jobs: the job records, to list, cancel and download the jobs of any worker
+    The file keeps the Apstra credentials of the sessions. It is created readable by the owner only
+    """
+    shared = True
+
+    def __init__(self, path: str):
+        self.path = path
+        self.local = threading.local()  # a connection per thread
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        if not os.path.exists(path):
+            os.close(os.open(path, os.O_CREAT | os.O_WRONLY, 0o600))
+        self.connection().executescript(_SCHEMA)
+
+    def connection(self) -> sqlite3.Connection:
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=SQLITE_TIMEOUT, isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = connection
+        return connection
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        connection = self.connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def load_session(self, session_id: str) -> Optional[Dict[str, Any]]:
+        row = self.connection().execute('SELECT state, version FROM sessions WHERE session_id = ?', (session_id,)).fetchone()
+        if row is None:
+            return None
+        return {'state': json.loads(row['state']) if row['state'] else None, 'version': row['version']}
+
+    def save_session(self, session_id: str, state: Optional[dict]) -> int:
+        row = self.connection().execute(
+            'INSERT INTO sessions (session_id, state, version, last_used) VALUES (?, ?, 1, ?) '
+            'ON CONFLICT (session_id) DO UPDATE SET state = excluded.state, version = version + 1, last_used = excluded.last_used '
+            'RETURNING version', (session_id, json.dumps(state) if state else None, time.time())).fetchone()
+        return row['version']
+
+    def touch_session(self, session_id: str, idle_ttl: float) -> None:
+        now = time.time()
+        with self.transaction() as connection:
+            connection.execute('UPDATE sessions SET last_used = ? WHERE session_id = ?', (now, session_id))
+            connection.execute('DELETE FROM sessions WHERE last_used < ?', (now - idle_ttl,))
+
+    def append_events(self, items: List[Tuple[str, str, str]]) -> None:
+        now = time.time()
+        with self.transaction() as connection:
+            connection.executemany('INSERT INTO events (session_id, event, data, created) VALUES (?, ?, ?, ?)',
+                                   [(session_id, event, data, now) for session_id, event, data in items])
+
+    def read_events(self, after: int, upto: Optional[int] = None, session_id: Optional[str] = None, limit: int = SSE_RELAY_READ_SIZE) -> List[dict]:
+        query = 'SELECT id, session_id, event, data FROM events WHERE id > ?'
+        parameters: List[Any] = [after]
+        if upto is not None:
+            query += ' AND id <= ?'
+            parameters.append(upto)
+        if session_id is not None:
+            query += ' AND session_id = ?'
+            parameters.append(session_id)
+        query += ' ORDER BY id LIMIT ?'
+        parameters.append(limit)
+        return [dict(x) for x in self.connection().execute(query, parameters)]
+
+    def last_event_id(self) -> int:
+        return self.connection().execute('SELECT COALESCE(MAX(id), 0) FROM events').fetchone()[0]
+
+    def drop_events(self, before: float) -> None:
+        self.connection().execute('DELETE FROM events WHERE created < ?', (before,))
+
+    def save_job(self, record: Dict[str, Any], expire_before: float) -> None:
+        with self.transaction() as connection:
+            connection.execute(
+                'INSERT INTO jobs (job_id, session_id, record, finished) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (job_id) DO UPDATE SET record = excluded.record, finished = excluded.finished',
+                (record['job_id'], record['session_id'], json.dumps(record), record['finished']))
+            connection.execute('DELETE FROM jobs WHERE finished < ?', (expire_before,))
+
+    def load_job(self, job_id: str) -> Optional[Dict[str, Any]]:
+        row = self.connection().execute('SELECT record FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+        return json.loads(row['record']) if row else None
+
+    def list_jobs(self, session_id: str) -> List[Dict[str, Any]]:
+        rows = self.connection().execute('SELECT record FROM jobs WHERE session_id = ?', (session_id,))
+        return [json.loads(x['record']) for x in rows]
+
+    def request_cancel(self, job_id: str) -> bool:
+        return self.connection().execute('UPDATE jobs SET cancel = 1 WHERE job_id = ?', (job_id,)).rowcount > 0
+
+    def cancel_requested(self, job_id: str) -> bool:
+        row = self.connection().execute('SELECT cancel FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+        return bool(row and row['cancel'])
+
+
+def make_state_backend(spec: str = APSTRA_STATE_BACKEND) -> StateBackend:
+    """
+    The backend of APSTRA_STATE_BACKEND: memory, or sqlite:<path>
+    """
+    if spec in ('', 'memory'):
+        return StateBackend()
+    if spec.startswith('sqlite:'):
+        return SqliteStateBackend(os.path.expanduser(spec[len('sqlite:'):]))
+    raise ValueError(f"APSTRA_STATE_BACKEND {spec} is not memory or sqlite:<path>")
+
+
+class EventRelay:
+    """
+    Route the SSE events of the web sessions through the shared backend, so that a /sse connection on any worker
+    gets the events of its session. The events published in this worker are written in batches, and the events of
+    all the workers are read back every SSE_RELAY_INTERVAL seconds and delivered to the local hubs in the id order
+    The ids of the database are the event ids, so Last-Event-ID works across the workers
+    """
+    def __init__(self, backend: StateBackend, interval: float = SSE_RELAY_INTERVAL, retention: int = SSE_RELAY_RETENTION):
+        self.backend = backend
+        self.interval = interval
+        self.retention = retention
+        self.pending: List[Tuple[str, str, str]] = []
+        self.hubs: Dict[str, Any] = {}  # the SseHub with /sse connections in this worker, by the session id
+        self.last_id: Optional[int] = None  # the last event delivered
+        self.started = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+        self.dropped_at = 0.0
+        self.logger = logging.getLogger('EventRelay')
+
+    def start(self) -> None:
+        if self.task is None or self.task.done():
+            self.started = asyncio.Event()
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def publish(self, hub: Any, event: str, data: str) -> None:
+        self.pending.append((hub.session_id, event, data))
+        self.start()
+
+    def exchange(self, pending: List[Tuple[str, str, str]], after: Optional[int]) -> Tuple[int, List[dict]]:
+        """
+        Write the pending events and read the events after the id. Blocking
+        """
+        if after is None:
+            # the events before the start are only replayed
+            after = self.backend.last_event_id()
+        if pending:
+            self.backend.append_events(pending)
+        now = time.time()
+        if now - self.dropped_at > 60:
+            self.dropped_at = now
+            self.backend.drop_events(now - self.retention)
+        events = self.backend.read_events(after)
+        return (events[-1]['id'] if events else after), events
+
+    async def run(self) -> None:
+        while True:
+            pending, self.pending = self.pending, []
+            try:
+                last_id, events = await run_blocking(self.exchange, pending, self.last_id)
+            except Exception:
+                self.logger.exception('run() the backend failed')
+                self.pending[:0] = pending
+                await asyncio.sleep(1)
+                continue
+            for event in events:
+                hub = self.hubs.get(event['session_id'])
+                if hub is not None:
+                    hub.deliver({'id': str(event['id']), 'event': event['event'], 'data': event['data']})
+            self.last_id = last_id
+            self.started.set()
+            for session_id in [k for k, v in self.hubs.items() if not v.subscribers]:
+                self.hubs.pop(session_id)
+            if len(events) < SSE_RELAY_READ_SIZE:
+                await asyncio.sleep(self.interval)
+
+    async def subscribe(self, hub: Any, last_event_id: Optional[str] = None) -> Any:
+        """
+        Add a subscriber to the hub, with the events after last_event_id of the session from the backend first
+        """
+        self.start()
+        await self.started.wait()
+        replay = []
+        if last_event_id and last_event_id.isdigit():
+            after = int(last_event_id)
+            # up to the last delivered event. the later ones come through the hub
+            while True:
+                upto = self.last_id
+                while True:
+                    events = await run_blocking(self.backend.read_events, after, upto, hub.session_id)
+                    replay += events
+                    if len(events) < SSE_RELAY_READ_SIZE:
+                        break
+                    after = events[-1]['id']
+                after = max(after, upto)
+                if self.last_id == upto:
+                    break
+        self.hubs[hub.session_id] = hub
+        subscriber = hub.subscribe()
+        for event in replay:
+            subscriber.push({'id': str(event['id']), 'event': event['event'], 'data': event['data']})
+        return subscriber
@@ -0,0 +1,86 @@
+import io
+import tarfile
+import time
+from typing import BinaryIO, List, Optional, Union
+
+
+class _ChunkBuffer(io.RawIOBase):
+    """
+    Write only file object which keeps the written bytes until they are drained
+    """
+    def __init__(self):
+        self.chunks: List[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self.chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self) -> bytes:
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+class TarStream:
+    """
+    tar writer which hands out the bytes as the members are added
+    Only the member being added and the compressor window are kept in memory
+    """
+    mode = 'w|'
+    mtime: Optional[int] = None  # the time of the members. now when None
+
+    def __init__(self):
+        self.buffer = _ChunkBuffer()
+        self.archive = tarfile.open(fileobj=self.buffer, mode=self.mode)
+
+    def _tarinfo(self, name: str) -> tarfile.TarInfo:
+        tarinfo = tarfile.TarInfo(name)
+        tarinfo.mtime = self.mtime or int(time.time())
+        return tarinfo
+
+    def add_dir(self, name: str) -> None:
+        tarinfo = self._tarinfo(name)
+        tarinfo.type = tarfile.DIRTYPE
+        tarinfo.mode = 0o755
+        self.archive.addfile(tarinfo)
+
+    def add_file(self, name: str, content: Union[str, bytes]) -> None:
+        data = content.encode('utf-8') if isinstance(content, str) else content
+        tarinfo = self._tarinfo(name)
+        tarinfo.size = len(data)
+        tarinfo.mode = 0o644
+        self.archive.addfile(tarinfo, io.BytesIO(data))
+
+    def add_fileobj(self, name: str, fileobj: BinaryIO) -> None:
+        """
+        Add the content of the file object from its current position to the end
+        """
+        start = fileobj.tell()
+        tarinfo = self._tarinfo(name)
+        tarinfo.size = fileobj.seek(0, io.SEEK_END) - start
+        tarinfo.mode = 0o644
+        fileobj.seek(start)
+        self.archive.addfile(tarinfo, fileobj)
+
+    def read(self) -> bytes:
+        """
+        Return the compressed bytes produced since the last read
+        """
+        return self.buffer.drain()
+
+    def close(self) -> bytes:
+        """
+        Finish the archive and return the remaining bytes
+        """
+        self.archive.close()
+        return self.buffer.drain()
+
+
+class TgzStream(TarStream):
+    """
+    tar.gz writer which hands out the compressed bytes as the members are added
+    """
+    mode = 'w|gz'
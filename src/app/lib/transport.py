@@ -0,0 +1,139 @@
+import logging
+import os
+import threading
+from typing import Any, Optional, Tuple
+
+from ck_apstra_api.apstra_session import CkApstraSession
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.request import ACCEPT_ENCODING
+from urllib3.util.retry import Retry
+
+from app.lib.metrics import APSTRA_CONNECTIONS
+
+# the seconds to connect to Apstra, and to wait for each read of a response
+APSTRA_CONNECT_TIMEOUT = float(os.getenv('APSTRA_CONNECT_TIMEOUT', '10'))
+APSTRA_READ_TIMEOUT = float(os.getenv('APSTRA_READ_TIMEOUT', '120'))
+
+# the retries of an idempotent call (GET, HEAD) on a connection error, a read error or RETRY_STATUS_CODES
+# after APSTRA_RETRY_BACKOFF seconds doubled on each retry, plus up to APSTRA_RETRY_BACKOFF of jitter. 0 to disable
+APSTRA_RETRIES = int(os.getenv('APSTRA_RETRIES', '3'))
+APSTRA_RETRY_BACKOFF = float(os.getenv('APSTRA_RETRY_BACKOFF', '0.5'))
+RETRY_STATUS_CODES = (429, 502, 503, 504)
+
+# negotiate HTTP/2 by ALPN when the h2 package is installed. experimental in urllib3
+APSTRA_HTTP2 = os.getenv('APSTRA_HTTP2', '') not in ('', '0', 'false')
+
+logger = logging.getLogger('transport')
+
+
+def _count_connection(conn: Any) -> Any:
+    # a pooled connection keeps its socket. a new or dropped one connects on the request
+    APSTRA_CONNECTIONS.inc(state='reused' if getattr(conn, 'sock', None) is not None else 'opened')
+    return conn
+
+
+class CountingHTTPConnectionPool(HTTPConnectionPool):
+    def _get_conn(self, timeout: Optional[float] = None):
+        return _count_connection(super()._get_conn(timeout))
+
+
+class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _get_conn(self, timeout: Optional[float] = None):
+        return _count_connection(super()._get_conn(timeout))
+
+
+class ApstraAdapter(HTTPAdapter):
+    """
+    The transport of the Apstra session: a keep-alive pool of pool_size connections per host, the default timeouts,
+    and the retries of the idempotent calls with jittered backoff. The connections opened and reused are counted
+    The pool grows for the pulls with a larger concurrency
+    """
+    def __init__(self, pool_size: int, timeout: Tuple[float, float] = (APSTRA_CONNECT_TIMEOUT, APSTRA_READ_TIMEOUT),
+                 retries: int = APSTRA_RETRIES, backoff: float = APSTRA_RETRY_BACKOFF):
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.resize_lock = threading.Lock()
+        retry = Retry(total=retries, connect=retries, read=retries, status=retries, other=0, redirect=False,
+                      allowed_methods=frozenset({'GET', 'HEAD'}), status_forcelist=RETRY_STATUS_CODES,
+                      backoff_factor=backoff, backoff_jitter=backoff, raise_on_status=False)
+        super().__init__(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+
+    def init_poolmanager(self, *args, **kwargs) -> None:
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': CountingHTTPConnectionPool, 'https': CountingHTTPSConnectionPool}
+
+    def send(self, request, timeout=None, **kwargs):
+        return super().send(request, timeout=timeout or self.timeout, **kwargs)
+
+    def grow(self, pool_size: int) -> None:
+        """
+        Keep pool_size connections from now on. The pool size is in the pool key of urllib3, so the next requests
+        take a new pool while the requests in flight finish on the smaller one, which is dropped later
+        """
+        with self.resize_lock:
+            if pool_size <= self.pool_size:
+                return
+            logger.info(f"grow() {self.pool_size=} {pool_size=}")
+            self.pool_size = self._pool_maxsize = pool_size
+            self.poolmanager.connection_pool_kw['maxsize'] = pool_size
+
+
+_http2_enabled: Optional[bool] = None  # checked once for the process
+
+
+def enable_http2() -> bool:
+    """
+    Let urllib3 negotiate HTTP/2 when APSTRA_HTTP2 is set and h2 is installed. Once for the process
+    """
+    global _http2_enabled
+    if _http2_enabled is None:
+        _http2_enabled = False
+        if APSTRA_HTTP2:
+            try:
+                import urllib3.http2
+                urllib3.http2.inject_into_urllib3()
+                _http2_enabled = True
+                logger.info('enable_http2(): HTTP/2 by ALPN')
+            except ImportError as e:
+                logger.warning(f"enable_http2(): HTTP/1.1 without the h2 package {e=}")
+    return _http2_enabled
+
+
+class ApstraSession(CkApstraSession):
+    """
+    CkApstraSession with ApstraAdapter from its first call: the version and the login get the timeouts and the retries
+    """
+    def __init__(self, host: str, port: int, username: str, password: str, pool_size: int):
+        self.pool_size = pool_size
+        super().__init__(host, port, username, password)
+
+    def get_version(self) -> str:
+        # the first call of the constructor, right after the requests session is made
+        if not isinstance(self.session.adapters.get('https://'), ApstraAdapter):
+            configure_session(self.session, self.pool_size)
+        return super().get_version()
+
+
+def configure_session(session: Any, pool_size: int) -> None:
+    """
+    Replace the transport of the requests session of CkApstraSession with ApstraAdapter
+    The compressed responses are asked with every encoding urllib3 can decode
+    """
+    enable_http2()
+    adapter = ApstraAdapter(pool_size)
+    for prefix in ('https://', 'http://'):
+        previous = session.adapters.get(prefix)
+        session.mount(prefix, adapter)
+        if previous is not None and previous is not adapter:
+            previous.close()
+    session.headers['Accept-Encoding'] = ACCEPT_ENCODING
+
+
+def grow_pool(session: Any, pool_size: int) -> None:
+    """
+    Make the ApstraAdapter of the requests session keep at least pool_size connections
+    """
+    adapter = getattr(session, 'adapters', {}).get('https://')
+    if isinstance(adapter, ApstraAdapter):
+        adapter.grow(pool_size)
@@ -1,18 +1,29 @@
+import argparse
 import json
 import logging
 import os
+import shutil
+import tempfile
 import uvicorn
 import asyncio
-from typing import Annotated
-from fastapi import FastAPI, Request, UploadFile, Form
+from typing import Annotated, Optional
+from fastapi import Depends, FastAPI, HTTPException, Request, Response, UploadFile, Form
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, FileResponse, StreamingResponse
+from fastapi.responses import HTMLResponse, FileResponse, PlainTextResponse, StreamingResponse
 from sse_starlette.sse import EventSourceResponse
 
-from app.lib.common import SseEvent, SseEventData, sse_logging, sse_queue, global_store, GlobalStore, ButtonIdEnum
+from app.lib.bp_push import BpPushError
+from app.lib.common import SseEvent, SseEventData, sse_logging, sse_frames, session_registry, job_manager, state_backend, GlobalStore, ButtonIdEnum
+from app.lib.config_history import config_history, in_scope
+from app.lib.generic_system_worker import GenericSystemWorker
+from app.lib.jobs import JobStatusEnum, iter_file_range, parse_range
+from app.lib.metrics import count_bytes, render_metrics
+from app.lib.offload import iterate_blocking, run_blocking
+from app.lib.session_store import SessionMiddleware
 
 logger = logging.getLogger(__name__)
 app = FastAPI()
+app.add_middleware(SessionMiddleware, registry=session_registry)
 
 app.mount("/static", StaticFiles(directory="src/app/static"), name="static")
 app.mount("/js", StaticFiles(directory="src/app/static/js"), name="js")
@@ -21,17 +32,22 @@ app.mount("/images", StaticFiles(directory="src/app/static/images"), name="image
 
 
 
-@app.post("/upload-env-json")
-async def upload_env_ini(request: Request, file: UploadFile):
+def get_store(request: Request) -> GlobalStore:
     """
-    take environment yaml file to init global_store
+    The GlobalStore of the web session, attached by SessionMiddleware
     """
-    global global_store
+    return request.state.store
+
 
+@app.post("/upload-env-json")
+async def upload_env_ini(request: Request, file: UploadFile, store: GlobalStore = Depends(get_store)):
+    """
+    take environment yaml file to init the store
+    """
     await sse_logging(f"/upload-env-json begin")
     file_content = await file.read()
     file_dict = json.loads(file_content)
-    await global_store.post_init(file_dict)
+    await store.post_init(file_dict)
     
     await SseEvent(data=SseEventData(id=ButtonIdEnum.BUTTON_ENV_DIV).done()).send()
     await SseEvent(data=SseEventData(id=ButtonIdEnum.BUTTON_LOGIN).init().enable()).send()
@@ -42,18 +58,16 @@ async def upload_env_ini(request: Request, file: UploadFile):
 
 
 @app.post("/login")
-async def login(host: Annotated[str, Form()], port: Annotated[str, Form()], username: Annotated[str, Form()], password: Annotated[str, Form()]):
+async def login(host: Annotated[str, Form()], port: Annotated[str, Form()], username: Annotated[str, Form()], password: Annotated[str, Form()], store: GlobalStore = Depends(get_store)):
     """
     login to the server
     """
-    global global_store
-
     logging.warning(f"login {host=} {port=} {username=} {password=}")
 
     await sse_logging(f"/login begin")
     await SseEvent(data=SseEventData(id='login').loading()).send()
 
-    version, error = await global_store.login_server(host, port, username, password)
+    version, error = await store.login_server(host, port, username, password)
 
     if error:
         await SseEvent(data=SseEventData(id='login').error()).send()
@@ -61,7 +75,7 @@ async def login(host: Annotated[str, Form()], port: Annotated[str, Form()], user
         return
     await SseEvent(data=SseEventData(id=ButtonIdEnum.BUTTON_LOGIN).done()).send()
 
-    await global_store.bp_selections()
+    await store.bp_selections()
 
     await SseEvent(data=SseEventData(id=ButtonIdEnum.BUTTON_PUSH_JSON).init().enable()).send()
     await SseEvent(data=SseEventData(id=ButtonIdEnum.LAST_MESSAGE, value=f"connected {version}")).send()
@@ -72,60 +86,155 @@ async def login(host: Annotated[str, Form()], port: Annotated[str, Form()], user
 
 
 @app.get("/pull-config")
-async def pull_config():
+async def pull_config(concurrency: Optional[int] = None, stream: bool = False, refresh: bool = False, delta: bool = False, store: GlobalStore = Depends(get_store)):
     """
     download device configuration
+    concurrency: the number of switches to fetch at the same time. the default from the env json or APSTRA_FETCH_CONCURRENCY
+    stream: send the tar.gz while the configs are fetched, without the temporary files
+    refresh: fetch all the switches instead of taking the unchanged ones from the config cache
+    delta: only the switches changed from the last pull, with the diffs of the changed sections
     """
-    global global_store
-
     await sse_logging(f"/pull-config begin")
     await SseEvent(data=SseEventData(id=ButtonIdEnum.BUTTON_PULL_CONFIG).loading()).send()
 
-    await global_store.pull_config()
-    tgz_name = os.path.basename(global_store.tgz_name)
+    if stream:
+        tgz_name = f"{store.main_blueprint}-delta.tgz" if delta else f"{store.main_blueprint}.tgz"
+
+        async def tgz_chunks():
+            async for chunk in store.pull_config_stream(concurrency, refresh, delta=delta):
+                yield chunk
+            await SseEvent(data=SseEventData(id=ButtonIdEnum.BUTTON_PULL_CONFIG).done()).send()
+            await sse_logging(f"/pull-config end")
+            await SseEvent(data=SseEventData(id=ButtonIdEnum.LAST_MESSAGE, value=f"{tgz_name} downloaded")).send()
+
+        headers = {'Content-Disposition': f'attachment; filename="{tgz_name}"'}
+        return StreamingResponse(count_bytes(tgz_chunks(), 'pull-config'), media_type='application/octet-stream', headers=headers)
+
+    await store.pull_config(concurrency, refresh, delta)
+    tgz_name = os.path.basename(store.tgz_name)
 
     await SseEvent(data=SseEventData(id=ButtonIdEnum.BUTTON_PULL_CONFIG).done()).send()
     await sse_logging(f"/pull-config end")
     await SseEvent(data=SseEventData(id=ButtonIdEnum.LAST_MESSAGE, value=f"{tgz_name} downloaded")).send()
     headers = {'Content-Disposition': f'attachment; filename="{tgz_name}"'}
-    return StreamingResponse(global_store.tgz_data, media_type='application/octet-stream', headers=headers)
+    return StreamingResponse(store.tgz_data, media_type='application/octet-stream', headers=headers)
+
+
+@app.get("/pull-config-bulk")
+async def pull_config_bulk(labels: str = 'all', concurrency: Optional[int] = None, per_blueprint: bool = False, refresh: bool = False, store: GlobalStore = Depends(get_store)):
+    """
+    download device configuration of many blueprints in one archive
+    labels: comma separated blueprint labels, or all
+    concurrency: the number of switches to fetch at the same time, shared by all the blueprints
+    per_blueprint: a tar of <bp_label>.tgz instead of one tar.gz with a directory per blueprint
+    refresh: fetch all the switches instead of taking the unchanged ones from the config cache
+    """
+    await sse_logging(f"/pull-config-bulk begin")
+
+    bp_labels = [x.strip() for x in labels.split(',') if x.strip()]
+    archive_name = f"{'all' if bp_labels == ['all'] else 'bulk'}.{'tar' if per_blueprint else 'tgz'}"
+
+    async def archive_chunks():
+        async for chunk in store.pull_config_bulk(bp_labels, concurrency, per_blueprint, refresh):
+            yield chunk
+        await sse_logging(f"/pull-config-bulk end")
+        await SseEvent(data=SseEventData(id=ButtonIdEnum.LAST_MESSAGE, value=f"{archive_name} downloaded")).send()
+
+    headers = {'Content-Disposition': f'attachment; filename="{archive_name}"'}
+    return StreamingResponse(count_bytes(archive_chunks(), 'pull-config-bulk'), media_type='application/octet-stream', headers=headers)
 
 
 @app.get("/pull-bp-json")
-async def pull_bp_json():
+async def pull_bp_json(gzip: bool = False, store: GlobalStore = Depends(get_store)):
     """
     download blueprint in json
+    gzip: compress the json
     """
-    global global_store
-
     await sse_logging(f"/pull-bp-json begin")
     await SseEvent(data=SseEventData(id=ButtonIdEnum.BUTTON_PULL_JSON).loading()).send()
 
-    json_name = await global_store.pull_bp_json()
+    json_name, json_chunks = await store.pull_bp_json(gzip)
+
+    async def download_chunks():
+        async for chunk in json_chunks:
+            yield chunk
+        await SseEvent(data=SseEventData(id=ButtonIdEnum.BUTTON_PULL_JSON).done()).send()
+        await sse_logging(f"/pull-bp-json end")
+        await SseEvent(data=SseEventData(id=ButtonIdEnum.LAST_MESSAGE, value=f"{json_name} downloaded")).send()
 
-    await SseEvent(data=SseEventData(id=ButtonIdEnum.BUTTON_PULL_JSON).done()).send()
-    await sse_logging(f"/pull-bp-json end")
-    await SseEvent(data=SseEventData(id=ButtonIdEnum.LAST_MESSAGE, value=f"{json_name} downloaded")).send()
     headers = {'Content-Disposition': f'attachment; filename="{json_name}"'}
-    return StreamingResponse(global_store.json_data, media_type='application/octet-stream', headers=headers)
+    return StreamingResponse(count_bytes(download_chunks(), 'pull-bp-json'), media_type='application/octet-stream', headers=headers)
+
+
+@app.post("/diff-bp-json")
+async def diff_bp_json(file: Optional[UploadFile] = None, base_file: Optional[UploadFile] = None, base: str = 'live', target: str = 'file',
+                       ignore: str = '', store: GlobalStore = Depends(get_store)):
+    """
+    compare two blueprint jsons, streamed as ndjson lines of the added, removed and changed nodes and relationships
+    base, target: file or base-file for the uploads, live or live:<label> for the blueprint on the server, or a pull-bp-json job id
+    ignore: the comma separated properties not compared, like system_id,tags
+    """
+    await sse_logging(f"/diff-bp-json begin")
+    if not store.logged_in and any(x == 'live' or x.startswith('live:') for x in (base, target)):
+        raise HTTPException(status_code=409, detail="not logged in")
+    uploads = {name: upload.file for name, upload in (('file', file), ('base-file', base_file)) if upload is not None}
+    try:
+        diff_chunks = await store.diff_bp_json(base, target, uploads, [x for x in ignore.split(',') if x])
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return StreamingResponse(count_bytes(diff_chunks, 'diff-bp-json'), media_type='application/x-ndjson')
+
+
+@app.get("/history")
+async def history(bp_label: Optional[str] = None, store: GlobalStore = Depends(get_store)):
+    """
+    the pulls in the config history of the blueprints of the session, the oldest first, with the bytes pulled and the bytes on the disk
+    """
+    scope = await store.history_scope()
+    if scope is None:
+        raise HTTPException(status_code=409, detail="not logged in")
+    return await run_blocking(config_history.pulls, *scope, bp_label)
+
+
+@app.get("/history/{pull_id}")
+async def history_pull(pull_id: str, store: GlobalStore = Depends(get_store)):
+    """
+    download the tar.gz of a pull of the blueprints of the session, rebuilt from the config history
+    """
+    scope = await store.history_scope()
+    manifest = await run_blocking(config_history.read_manifest, pull_id)
+    if scope is None or manifest is None or not in_scope(manifest, *scope):
+        raise HTTPException(status_code=404, detail=f"pull {pull_id} not found")
+    headers = {'Content-Disposition': f'attachment; filename="{manifest["bp_label"]}-{pull_id}.tgz"'}
+    chunks = count_bytes(iterate_blocking(config_history.iter_tgz(manifest)), 'history')
+    return StreamingResponse(chunks, media_type='application/octet-stream', headers=headers)
+
+
+@app.get("/blueprints")
+async def blueprints(store: GlobalStore = Depends(get_store)):
+    """
+    the blueprints of the server from the blueprint catalog of the login, with their design and switch count
+    """
+    if store.apstra is None or store.apstra.bp_catalog is None:
+        raise HTTPException(status_code=409, detail="not logged in")
+    return [x.summary() for x in (await store.apstra.bp_catalog.get()).values()]
 
 
 @app.get("/login-main-bp", response_class=HTMLResponse)
-async def login_main_bp(request: Request):
+async def login_main_bp(request: Request, store: GlobalStore = Depends(get_store)):
     """
     login to the server and blueprints
     then sync the data
     """
-    global global_store
-
     logging.warning(f"login-main-bp {request=} {request.query_params=} {request.headers=}")
     # logging.warning(f"login-main-bp {request=} {request.query_params=}")
 
     new_bp = request.query_params.get("main-bp")
-    await global_store.login_blueprint(new_bp)
+    await store.login_blueprint(new_bp)
 
     await SseEvent(data=SseEventData(id=ButtonIdEnum.BUTTON_PULL_CONFIG).enable()).send()
     await SseEvent(data=SseEventData(id=ButtonIdEnum.BUTTON_PULL_JSON).enable()).send()
+    await SseEvent(data=SseEventData(id=ButtonIdEnum.BUTTON_PULL_GS).enable()).send()
     await sse_logging(f"/login-main-bp end")
 
     return f"login bp {new_bp}"
@@ -133,37 +242,53 @@ async def login_main_bp(request: Request):
 
 
 
+@app.get("/pull-generic-systems", response_class=HTMLResponse)
+async def pull_generic_systems(store: GlobalStore = Depends(get_store)):
+    """
+    render the generic systems of the main blueprint with their AE, links, tags and VLANs
+    """
+    await sse_logging(f"/pull-generic-systems begin")
+    await SseEvent(data=SseEventData(id=ButtonIdEnum.BUTTON_PULL_GS).loading()).send()
+
+    count = await GenericSystemWorker(store).pull_generic_systems()
+
+    await SseEvent(data=SseEventData(id=ButtonIdEnum.BUTTON_PULL_GS).done()).send()
+    await sse_logging(f"/pull-generic-systems end")
+    return f"{count} generic systems"
+
+
 @app.get("/get-env-example")
-async def get_env_example():
+async def get_env_example(store: GlobalStore = Depends(get_store)):
     """
     download sample env file in json
     """
-    global global_store
-
     await sse_logging(f"/get_env_example begin")
 
-    json_name = await global_store.pull_env_json()
+    json_name = await store.pull_env_json()
 
     await sse_logging(f"/get_env_example end")
     await SseEvent(data=SseEventData(id=ButtonIdEnum.LAST_MESSAGE, value=f"{json_name} downloaded")).send()
     headers = {'Content-Disposition': f'attachment; filename="{json_name}"'}
-    return StreamingResponse(global_store.json_data, media_type='application/octet-stream', headers=headers)
+    return StreamingResponse(store.json_data, media_type='application/octet-stream', headers=headers)
 
 
 
 
 @app.post("/push-bp-json")
-async def push_bp_json(request: Request, file: UploadFile):
+async def push_bp_json(request: Request, file: UploadFile, batched: bool = False, store: GlobalStore = Depends(get_store)):
     """
-    take environment yaml file to init global_store
+    create the blueprint from the json file. batched to apply the nodes and the relationships in batches
     """
-    global global_store
-
     await sse_logging(f"/push-bp-json begin")
-    file_content = await file.read()
-    file_dict = json.loads(file_content)
     bp_name = file.filename.split(".json")[0]
-    return_text = await global_store.push_bp_json(file_dict, bp_name)
+    # parse and send the spooled upload in chunks instead of loading it
+    try:
+        return_text = await store.push_bp_json_stream(file.file, bp_name, batched)
+    except BpPushError as e:
+        await sse_logging(f"/push-bp-json failed: {e}")
+        await SseEvent(data=SseEventData(id=ButtonIdEnum.BUTTON_PUSH_JSON).error()).send()
+        await SseEvent(data=SseEventData(id=ButtonIdEnum.LAST_MESSAGE, value=str(e).split('\n')[0])).send()
+        return
     # logging.warning(f"push_bp_json {request=} {request.query_params=} {request.headers=} {file.filename=} {file.content_type=} {file.file=}")
 
     await sse_logging(f"/push-bp-json end")
@@ -173,30 +298,117 @@ async def push_bp_json(request: Request, file: UploadFile):
     return
 
 
+@app.post("/jobs/pull-config")
+async def submit_pull_config(concurrency: Optional[int] = None, refresh: bool = False, delta: bool = False, store: GlobalStore = Depends(get_store)):
+    """
+    pull the device configuration of the main blueprint in the background. the tgz is the artifact of the job
+    """
+    job = await store.pull_config_job(concurrency, refresh, delta)
+    return job.summary()
+
+
+@app.post("/jobs/pull-bp-json")
+async def submit_pull_bp_json(gzip: bool = False, store: GlobalStore = Depends(get_store)):
+    """
+    download the main blueprint json in the background. the json is the artifact of the job
+    """
+    job = await store.pull_bp_json_job(gzip)
+    return job.summary()
+
+
+@app.post("/jobs/push-bp-json")
+async def submit_push_bp_json(file: UploadFile, batched: bool = False, store: GlobalStore = Depends(get_store)):
+    """
+    create the blueprint from the json file in the background. the blueprint name comes from the file name
+    """
+    bp_name = file.filename.split(".json")[0]
+    # the upload is closed at the end of the request
+    fp = tempfile.TemporaryFile()
+    await run_blocking(shutil.copyfileobj, file.file, fp)
+    job = await store.push_bp_json_job(fp, bp_name, batched)
+    return job.summary()
+
+
+@app.get("/jobs")
+async def list_jobs(store: GlobalStore = Depends(get_store)):
+    return [x.summary() for x in await job_manager.find_all(store)]
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, store: GlobalStore = Depends(get_store)):
+    job = await job_manager.find(job_id, store)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"job {job_id} not found")
+    return job.summary()
+
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str, store: GlobalStore = Depends(get_store)):
+    job = await job_manager.find(job_id, store)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"job {job_id} not found")
+    if not await job_manager.cancel_anywhere(job):
+        raise HTTPException(status_code=409, detail=f"job {job_id} {job.status}")
+    return job.summary()
+
+
+@app.get("/jobs/{job_id}/artifact")
+async def get_job_artifact(job_id: str, request: Request, store: GlobalStore = Depends(get_store)):
+    """
+    download the artifact of the finished job. a single byte range is served with 206 to resume the download
+    """
+    job = await job_manager.find(job_id, store)
+    if job is None or job.artifact_path is None:
+        raise HTTPException(status_code=404, detail=f"artifact of job {job_id} not found")
+    if job.status != JobStatusEnum.DONE:
+        raise HTTPException(status_code=409, detail=f"job {job_id} {job.status}")
+
+    size = job.artifact_size
+    try:
+        byte_range = parse_range(request.headers.get('range'), size)
+    except ValueError:
+        return Response(status_code=416, headers={'Content-Range': f"bytes */{size}"})
+    start, end = byte_range or (0, size - 1)
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'Content-Length': str(end - start + 1),
+        'Content-Disposition': f'attachment; filename="{job.artifact_name}"',
+        'ETag': f'"{job.id}"',
+    }
+    if byte_range:
+        headers['Content-Range'] = f"bytes {start}-{end}/{size}"
+    chunks = count_bytes(iterate_blocking(iter_file_range(open(job.artifact_path, 'rb'), start, end)), 'job-artifact')
+    return StreamingResponse(chunks, status_code=206 if byte_range else 200, media_type='application/octet-stream', headers=headers)
+
+
 @app.get("/", response_class=HTMLResponse)
 async def get_index_html(request: Request):
     return FileResponse("src/app/static/index.html")
 
 
+@app.get('/metrics', response_class=PlainTextResponse)
+async def metrics():
+    """
+    the metrics in the Prometheus text format
+    """
+    return PlainTextResponse(render_metrics(), media_type='text/plain; version=0.0.4')
+
+
 @app.get('/sse')
 async def sse(request: Request):
-    async def event_generator():
-        while True:
-            if await request.is_disconnected():
-                break
-            item = await sse_queue.get()
-            # logging.info(f"######## event_generator get {sse_queue.qsize()=} {item=}")          
-            yield item
-            sse_queue.task_done()
-            # set 0.05 to produce progressing
-            await asyncio.sleep(0.05)
-    return EventSourceResponse(event_generator())
+    return EventSourceResponse(sse_frames(request.is_disconnected, request.headers.get('last-event-id')))
 
 
 def main():
-    app_host = "127.0.0.1"
-    app_port = 8001
-    uvicorn.run(app, host=app_host, port=app_port, log_level="debug")
+    parser = argparse.ArgumentParser(prog='run-web')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--workers', type=int, default=1, help='the worker processes. more than 1 needs APSTRA_STATE_BACKEND=sqlite:<path>')
+    args = parser.parse_args()
+    if args.workers > 1 and not state_backend.shared:
+        parser.error('--workers needs APSTRA_STATE_BACKEND=sqlite:<path> to share the sessions, the events and the jobs')
+    # the workers import the app by its name
+    uvicorn.run(app if args.workers == 1 else 'app.main:app', host=args.host, port=args.port, workers=args.workers, log_level="debug")
 
 if __name__ == "__main__":
     main()
@@ -3,14 +3,126 @@
 const eventSource = new EventSource("/sse");
 console.log('eventSource', eventSource);
 
+// the lines kept in the event box, the oldest are dropped
+const EVENT_LOG_MAX_LINES = 10000;
+// the rows rendered above and below the visible ones of the event box
+const EVENT_LOG_OVERSCAN = 20;
 
-eventSource.addEventListener('data-state', (event) => {
-    const data = JSON.parse(event.data);
+
+class EventLog {
+    // a ring of the log lines of the <pre>, of which only the visible rows are in the DOM as text nodes
+    // the lines are added as they come, and rendered once per animation frame
+    constructor(pre) {
+        this.pre = pre;
+        this.box = pre.parentElement;  // the scrolling element
+        this.lines = new Array(EVENT_LOG_MAX_LINES);
+        this.start = 0;
+        this.count = 0;
+        this.partial = '';  // the text after the last newline
+        this.rowHeight = 0;
+        this.follow = true;  // keep the last line in view unless scrolled up
+        this.scheduled = false;
+        // spacers for the rows not rendered, around the rendered rows
+        this.before = document.createElement('span');
+        this.rows = document.createElement('span');
+        this.after = document.createElement('span');
+        for (const element of [this.before, this.rows, this.after]) element.style.display = 'block';
+        pre.replaceChildren(this.before, this.rows, this.after);
+        this.box.addEventListener('scroll', () => {
+            this.follow = this.box.scrollTop + this.box.clientHeight >= this.box.scrollHeight - this.rowHeight;
+            this.schedule();
+        });
+    }
+
+    line(index) {
+        return index < this.count ? this.lines[(this.start + index) % EVENT_LOG_MAX_LINES] : this.partial;
+    }
+
+    push(line) {
+        if (this.count < EVENT_LOG_MAX_LINES) {
+            this.lines[(this.start + this.count) % EVENT_LOG_MAX_LINES] = line;
+            this.count++;
+        } else {
+            this.lines[this.start] = line;
+            this.start = (this.start + 1) % EVENT_LOG_MAX_LINES;
+        }
+    }
+
+    add(text) {
+        const parts = (this.partial + text).split('\n');
+        this.partial = parts.pop();
+        for (const line of parts) this.push(line);
+        this.schedule();
+    }
+
+    schedule() {
+        if (this.scheduled) return;
+        this.scheduled = true;
+        requestAnimationFrame(() => {
+            this.scheduled = false;
+            this.render();
+        });
+    }
+
+    render() {
+        if (!this.rowHeight) {
+            this.rows.textContent = ' ';
+            this.rowHeight = this.rows.getBoundingClientRect().height || 16;
+        }
+        const total = this.count + (this.partial ? 1 : 0);
+        const viewHeight = this.box.clientHeight;
+        const scrollTop = this.follow ? Math.max(0, total * this.rowHeight - viewHeight) : this.box.scrollTop;
+        const first = Math.max(0, Math.floor(scrollTop / this.rowHeight) - EVENT_LOG_OVERSCAN);
+        const last = Math.min(total, Math.ceil((scrollTop + viewHeight) / this.rowHeight) + EVENT_LOG_OVERSCAN);
+        const fragment = document.createDocumentFragment();
+        for (let index = first; index < last; index++) {
+            fragment.appendChild(document.createTextNode(this.line(index) + '\n'));
+        }
+        this.before.style.height = `${first * this.rowHeight}px`;
+        this.after.style.height = `${(total - last) * this.rowHeight}px`;
+        this.rows.replaceChildren(fragment);
+        if (this.follow) this.box.scrollTop = this.box.scrollHeight;
+    }
+}
+
+const eventLogs = new Map();  // the EventLog of the <pre> by the id
+
+function eventLog(target) {
+    let log = eventLogs.get(target.id);
+    if (log === undefined) {
+        log = new EventLog(target);
+        eventLogs.set(target.id, log);
+    }
+    return log;
+}
+
+
+function optionsFragment(values) {
+    // the <option> of each value, to be added at once
+    const fragment = document.createDocumentFragment();
+    for (const value of values) {
+        const option = document.createElement('option');
+        option.value = value;
+        option.textContent = value;
+        fragment.appendChild(option);
+    }
+    return fragment;
+}
+
+
+function rowsFragment(html) {
+    // the parsed <tr> of the html, to be added at once
+    const template = document.createElement('template');
+    template.innerHTML = html;
+    return template.content;
+}
+
+
+function handleDataState(data) {
     // const date = new Date();
     // const timestamp = `${date.getHours()}:${date.getMinutes()}:${date.getSeconds()}`;
     // console.log(`sse data-state at ${timestamp} data=${data}`)
     let target = document.getElementById(data.id);
-    console.log('sse data-state', target)
     try {
         if (data.do_remove !== null) {
             target.remove();
@@ -19,9 +131,9 @@ eventSource.addEventListener('data-state', (event) => {
         } else if (data.innerHTML !== null) {
             target.innerHTML = data.innerHTML;
         } else if (data.add_text !== null && data.add_text !== '') {
-            target.innerHTML += data.add_text;
-            const p = target.parentElement;
-            p.scrollTop = p.scrollHeight;
+            eventLog(target).add(data.add_text);
+        } else if (data.options !== null) {
+            target.replaceChildren(optionsFragment(data.options));
         } else if (data.element !== null) {
             const newElement = document.createElement(data.element);
             target.appendChild(newElement);
@@ -41,10 +153,9 @@ eventSource.addEventListener('data-state', (event) => {
     } catch (error) {
         console.log('sse data-state error', error, 'for data', data)
     }
-});
+}
 
-eventSource.addEventListener('tbody-gs', (event) => {
-    const data = JSON.parse(event.data);
+function handleTbodyGs(data) {
     // console.log('sse tbody-gs', data)
     const the_table = document.getElementById('generic-systems-table');
     let tbody = document.getElementById(data.id);
@@ -52,12 +163,11 @@ eventSource.addEventListener('tbody-gs', (event) => {
         tbody = the_table.createTBody();
         tbody.setAttribute('id', data.id);
     }
-    if (data.value !== null) tbody.innerHTML = data.value;
-});
+    if (data.value !== null) tbody.replaceChildren(rowsFragment(data.value));
+}
 
 
-eventSource.addEventListener('update-vn', (event) => {
-    const data = JSON.parse(event.data);
+function handleUpdateVn(data) {
     // id: id of the button
     // attrs: [ { attr: , value: } ]
     // value: button text
@@ -74,6 +184,52 @@ eventSource.addEventListener('update-vn', (event) => {
 
     vn_button.innerHTML = data.value;
     // window.scrollTo(0, document.body.scrollHeight);
-});        
+}
+
+
+function handleJob(data) {
+    // job_id, kind, status, message, artifact_name, artifact_size
+    const jobs_list = document.getElementById('jobs');
+    let job_item = document.getElementById(`job-${data.job_id}`);
+    if ( job_item == null ) {
+        job_item = document.createElement('li');
+        job_item.setAttribute('id', `job-${data.job_id}`);
+        jobs_list.prepend(job_item);
+    }
+    job_item.dataset.state = data.status;
+    const text = `${data.kind} ${data.status} ${data.message}`;
+    if (data.status === 'done' && data.artifact_name !== null) {
+        const link = document.createElement('a');
+        link.href = `/jobs/${data.job_id}/artifact`;
+        link.textContent = data.artifact_name;
+        job_item.replaceChildren(link, document.createTextNode(` ${text}`));
+    } else {
+        job_item.textContent = text;
+    }
+}
+
+
+const sseHandlers = {
+    'data-state': handleDataState,
+    'tbody-gs': handleTbodyGs,
+    'update-vn': handleUpdateVn,
+    'job': handleJob,
+};
+
+for (const [eventName, handler] of Object.entries(sseHandlers)) {
+    eventSource.addEventListener(eventName, (event) => handler(JSON.parse(event.data)));
+}
+
+// the server coalesces the queued events into a batch: [ { event: , data: } ]
+eventSource.addEventListener('batch', (event) => {
+    for (const item of JSON.parse(event.data)) {
+        const handler = sseHandlers[item.event];
+        if (handler) {
+            handler(item.data);
+        } else {
+            console.log('sse batch unknown event', item);
+        }
+    }
+});
 
 
@@ -0,0 +1,63 @@
+import io
+import json
+
+import pytest
+
+from app.lib.bp_json import iter_bp_dump, iter_bp_spec, rewrite_node
+
+BLUEPRINT = {
+    'id': 'bp-id-0',
+    'nodes': {
+        'node-0': {'id': 'node-0', 'type': 'metadata', 'label': 'bp-0', 'tags': None},
+        'node-1': {'id': 'node-1', 'type': 'system', 'system_type': 'switch', 'role': 'leaf', 'system_id': 'SERIAL1', 'label': 'leaf "1" é', 'tags': ['a', 'b'], 'property_set': {'x': [1, 2.5, None, True]}},
+    },
+    'relationships': {
+        'rel-0': {'id': 'rel-0', 'type': 'hosted_interfaces', 'source_id': 'node-1', 'target_id': 'node-0'},
+    },
+    'design': 'two_stage_l3clos',
+    'version': 42,
+    'empty': {},
+}
+
+
+def as_file(data) -> io.BytesIO:
+    return io.BytesIO(json.dumps(data).encode('utf-8'))
+
+
+def legacy_bp_spec(data: dict, new_bp_name: str) -> dict:
+    """
+    The body of push_bp_json out of the loaded blueprint json
+    """
+    return {
+        'design': data['design'],
+        'label': new_bp_name,
+        'init_type': 'explicit',
+        'nodes': [rewrite_node(node, new_bp_name) for node in data['nodes'].values()],
+        'relationships': list(data['relationships'].values()),
+    }
+
+
+@pytest.mark.parametrize('chunk_size', [1, 64 * 1024])
+def test_iter_bp_spec_same_as_loaded(chunk_size):
+    body = json.loads(b''.join(iter_bp_spec(as_file(BLUEPRINT), 'new-bp', chunk_size)))
+    assert body == legacy_bp_spec(json.loads(json.dumps(BLUEPRINT)), 'new-bp')
+    assert body['nodes'][0]['label'] == 'new-bp'
+    assert body['nodes'][0]['tags'] == []
+    assert body['nodes'][1]['system_id'] is None
+
+
+def test_iter_bp_spec_empty_maps():
+    body = json.loads(b''.join(iter_bp_spec(as_file({'nodes': {}, 'relationships': {}, 'design': 'freeform'}), 'new-bp')))
+    assert body == {'nodes': [], 'relationships': [], 'design': 'freeform', 'label': 'new-bp', 'init_type': 'explicit'}
+
+
+@pytest.mark.parametrize('data', [BLUEPRINT, {'nodes': {}, 'relationships': {}}, {'label': 'x'}])
+@pytest.mark.parametrize('chunk_size', [1, 64 * 1024])
+def test_iter_bp_dump_same_as_json_dumps(data, chunk_size):
+    assert b''.join(iter_bp_dump(as_file(data), chunk_size)).decode('utf-8') == json.dumps(data)
+
+
+def test_iter_bp_dump_chunks():
+    chunks = list(iter_bp_dump(as_file(BLUEPRINT), chunk_size=10))
+    assert len(chunks) > 1
+    assert json.loads(b''.join(chunks)) == BLUEPRINT
@@ -0,0 +1,166 @@
+import asyncio
+from dataclasses import dataclass, field
+import io
+import json
+import time
+from typing import List
+
+import pytest
+
+from app.lib.bp_push import BlueprintPusher, BpPushError, validate_bp_json
+
+BLUEPRINT = {
+    'nodes': {
+        'node-0': {'id': 'node-0', 'type': 'metadata', 'label': 'source-bp', 'tags': None, 'property_set': None},
+        'leaf-1': {'id': 'leaf-1', 'type': 'system', 'system_type': 'switch', 'role': 'leaf', 'system_id': 'SERIAL1', 'tags': "['null']"},
+        'intf-1': {'id': 'intf-1', 'type': 'interface', 'if_name': 'et-0/0/0', 'description': 'x' * 50},
+    },
+    'relationships': {
+        'rel-1': {'id': 'rel-1', 'type': 'hosted_interfaces', 'source_id': 'leaf-1', 'target_id': 'intf-1'},
+    },
+    'design': 'two_stage_l3clos',
+}
+
+
+def as_file(data) -> io.BytesIO:
+    return io.BytesIO(json.dumps(data).encode('utf-8'))
+
+
+@dataclass
+class FakeResponse:
+    status_code: int
+    content: bytes = b'{}'
+
+    @property
+    def ok(self) -> bool:
+        return self.status_code < 400
+
+    @property
+    def text(self) -> str:
+        return self.content.decode()
+
+    def json(self):
+        return json.loads(self.content)
+
+
+@dataclass
+class FakeHttpSession:
+    patch_statuses: List[int] = field(default_factory=list)  # answered before 202
+    post_statuses: List[int] = field(default_factory=list)  # answered before 201
+    posted: List[bytes] = field(default_factory=list)
+    patched: List[dict] = field(default_factory=list)
+    deleted: List[str] = field(default_factory=list)
+    patch_delay: float = 0.0  # seconds of the accepted batches
+    calls: List[str] = field(default_factory=list)  # patch and delete, in the order they returned
+
+    def post(self, url, data=None, **kwargs):
+        # the empty blueprint of the batched push comes as json=
+        self.posted.append(b''.join(data) if data is not None else json.dumps(kwargs['json']).encode())
+        return FakeResponse(self.post_statuses.pop(0) if self.post_statuses else 201, b'{"id": "new-bp-id"}')
+
+    def patch(self, url, data=None):
+        status = self.patch_statuses.pop(0) if self.patch_statuses else 202
+        if status < 400:
+            time.sleep(self.patch_delay)
+            self.patched.append(json.loads(data))
+        self.calls.append('patch')
+        return FakeResponse(status, b'{"errors": "busy"}')
+
+    def delete(self, url):
+        self.deleted.append(url.rsplit('/', 1)[-1])
+        self.calls.append('delete')
+        return FakeResponse(202)
+
+
+@dataclass
+class FakeApstraSession:
+    session: FakeHttpSession = field(default_factory=FakeHttpSession)
+    url_prefix: str = 'https://fake-apstra/api'
+
+
+def push(session, data, batched=False, **kwargs):
+    pusher = BlueprintPusher(session, 'new-bp', backoff=0, progress=None, **kwargs)
+    return asyncio.run(pusher.push(as_file(data), batched=batched))
+
+
+def test_validate_bp_json():
+    summary = validate_bp_json(as_file(BLUEPRINT))
+    assert (summary.design, summary.nodes, summary.relationships, summary.error_count) == ('two_stage_l3clos', 3, 1, 0)
+
+
+def test_validate_bp_json_errors():
+    data = json.loads(json.dumps(BLUEPRINT))
+    del data['design']
+    data['nodes']['node-0']['id'] = 'other'
+    del data['nodes']['intf-1']['type']
+    data['relationships']['rel-1']['target_id'] = 'missing'
+    summary = validate_bp_json(as_file(data))
+    assert summary.errors == ['nodes node-0: the id is other', 'node intf-1: no type', 'no design',
+                              'relationship rel-1: the target missing is not a node']
+
+
+def test_validate_bp_json_not_json():
+    summary = validate_bp_json(io.BytesIO(b'{"nodes": {"a": '))
+    assert summary.error_count == 1 and summary.errors[0].startswith('not a valid json')
+
+
+def test_push_invalid_sends_nothing():
+    session = FakeApstraSession()
+    with pytest.raises(BpPushError, match='errors in the blueprint json'):
+        push(session, {'nodes': {}})
+    assert session.session.posted == []
+
+
+def test_push_one_call():
+    session = FakeApstraSession()
+    push(session, BLUEPRINT)
+    body = json.loads(session.session.posted[0])
+    assert [x['id'] for x in body['nodes']] == ['node-0', 'leaf-1', 'intf-1']
+    assert body['nodes'][0]['label'] == 'new-bp'
+    assert body['nodes'][1]['system_id'] is None and body['nodes'][1]['tags'] == []
+    assert (body['label'], body['design'], body['init_type']) == ('new-bp', 'two_stage_l3clos', 'explicit')
+    assert session.session.patched == []
+
+
+def test_push_batched():
+    session = FakeApstraSession()
+    push(session, BLUEPRINT, batched=True, batch_bytes=1, concurrency=2)
+    created = json.loads(session.session.posted[0])
+    assert (created['nodes'], created['relationships'], created['label']) == ([], [], 'new-bp')
+    # a batch per item at batch_bytes=1, the nodes before the relationships
+    nodes = [x['nodes'] for x in session.session.patched if 'nodes' in x]
+    assert sorted(key for batch in nodes for key in batch) == ['intf-1', 'leaf-1', 'node-0']
+    assert 'relationships' in session.session.patched[-1]
+    assert len(session.session.patched) == 4
+
+
+def test_push_one_call_resent_after_401():
+    session = FakeApstraSession(FakeHttpSession(post_statuses=[401]))
+    push(session, BLUEPRINT)
+    # the whole file again, not the consumed rest of the stream
+    assert len(session.session.posted) == 2
+    assert session.session.posted[0] == session.session.posted[1]
+
+
+@pytest.mark.parametrize('status', [503, 409])
+def test_push_batched_retries(status):
+    session = FakeApstraSession(FakeHttpSession(patch_statuses=[status, status]))
+    push(session, BLUEPRINT, batched=True, concurrency=1)
+    assert [list(x) for x in session.session.patched] == [['nodes'], ['relationships']]
+    assert session.session.deleted == []
+
+
+def test_push_batched_gives_up():
+    session = FakeApstraSession(FakeHttpSession(patch_statuses=[422]))
+    with pytest.raises(BpPushError, match='the batch to new-bp-id failed: 422(.|\n)*new-bp-id is deleted'):
+        push(session, BLUEPRINT, batched=True)
+    assert session.session.deleted == ['new-bp-id']
+
+
+def test_push_batched_waits_for_batches_in_flight():
+    session = FakeApstraSession(FakeHttpSession(patch_statuses=[202, 202, 422], patch_delay=0.05))
+    with pytest.raises(BpPushError):
+        push(session, BLUEPRINT, batched=True, batch_bytes=1, concurrency=3)
+    # the batches sent with the failed one finish before the blueprint is deleted, and nothing is sent after
+    assert session.session.calls == ['patch', 'patch', 'patch', 'delete']
+    assert len(session.session.patched) == 2
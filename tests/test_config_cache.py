@@ -0,0 +1,67 @@
+import pytest
+
+from app.lib.config_cache import ConfigCache
+
+
+def sections(node: int, size: int = 40):
+    return [('1_load_merge_intended.txt', f"{node}".ljust(size, 'x'))]
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return ConfigCache(cache_dir=str(tmp_path), max_bytes=100)
+
+
+def test_lookup_by_version(cache):
+    cache.store('bp', 'n1', 'v1', 'leaf-1', sections(1))
+    assert cache.lookup('bp', 'n1', 'v1') == sections(1)
+    assert cache.lookup('bp', 'n1', 'v2') is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_evict_least_recently_used(cache):
+    for node in range(1, 4):
+        cache.store('bp', f"n{node}", 'v1', f"leaf-{node}", sections(node))
+    # 120 bytes over 100: the oldest goes
+    assert cache.evictions == 1
+    assert cache.lookup('bp', 'n1', 'v1') is None
+    assert cache.lookup('bp', 'n3', 'v1') == sections(3)
+    assert cache.total_bytes <= cache.max_bytes
+
+
+def test_evict_keeps_the_stored_entry(cache):
+    cache.store('bp', 'n1', 'v1', 'leaf-1', sections(1, 500))
+    assert cache.lookup('bp', 'n1', 'v1') == sections(1, 500)
+    assert cache.evictions == 0
+
+
+def test_pulls_pinned_not_counted(cache):
+    for node in range(1, 4):
+        cache.swap_pull('bp', f"n{node}", f"leaf-{node}", sections(node))
+        cache.store('bp', f"n{node}", 'v1', f"leaf-{node}", sections(node))
+    # the blobs of the last pulls do not push out the entries
+    assert cache.evictions == 0
+    assert all(cache.lookup('bp', f"n{node}", 'v1') == sections(node) for node in range(1, 4))
+
+
+def test_replaced_pull_blob_removed(cache):
+    assert cache.swap_pull('bp', 'n1', 'leaf-1', sections(1)) is None
+    previous = cache.swap_pull('bp', 'n1', 'leaf-1', sections(2, 120))
+    assert cache.read_blob(previous[0][1]) == sections(1)[0][1]
+    cache.store('bp', 'n2', 'v1', 'leaf-2', sections(3))
+    assert cache.read_blob(previous[0][1]) is None
+
+
+def test_shared_directory(tmp_path):
+    first = ConfigCache(cache_dir=str(tmp_path), max_bytes=1000)
+    second = ConfigCache(cache_dir=str(tmp_path), max_bytes=1000)
+    first.store('bp', 'n1', 'v1', 'leaf-1', sections(1))
+    first.save()
+    second.store('bp', 'n2', 'v1', 'leaf-2', sections(2))
+    second.save()
+    # each keeps the entries of the other
+    assert first.lookup('bp', 'n2', 'v1') == sections(2)
+    assert ConfigCache(cache_dir=str(tmp_path)).lookup('bp', 'n1', 'v1') == sections(1)
+    # a blob removed by the other is a miss
+    second.remove_blob(second.entries['bp/n1']['sections'][0][1])
+    assert first.lookup('bp', 'n1', 'v1') is None
@@ -0,0 +1,165 @@
+import asyncio
+from dataclasses import dataclass, field
+import gzip
+import io
+import tarfile
+import threading
+import time
+
+import pytest
+
+from app.lib.config_cache import ConfigCache, content_hash
+from app.lib.config_fetch import BEGIN_CONFIGLET, BEGIN_SET, ConfigFetcher, section_diffs
+from app.lib.tgz_stream import TgzStream
+
+
+@dataclass
+class InFlight:
+    """
+    The number of the blocking calls running at the same time, and its peak
+    """
+    current: int = 0
+    peak: int = 0
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def call(self, delay: float) -> None:
+        with self.lock:
+            self.current += 1
+            self.peak = max(self.peak, self.current)
+        time.sleep(delay)
+        with self.lock:
+            self.current -= 1
+
+
+@dataclass
+class FakeApstraSession:
+    in_flight: InFlight
+    pristine: str = 'system host-name'  # changed on the devices without a new blueprint version
+
+    def get_items(self, url: str) -> dict:
+        return {'pristine_data': [{'content': f"{self.pristine} {url.split('/')[1]}\n" * 5}]}
+
+
+@dataclass
+class FakeBlueprint:
+    in_flight: InFlight
+    switch_count: int
+    id: str = 'bp-id-0'
+    label: str = 'bp-0'
+    design: str = 'two_stage_l3clos'
+
+    def get_item(self, item: str) -> dict:
+        node_id = item.split('/')[1]
+        # the later switches answer sooner, to finish out of order
+        self.in_flight.call(0.002 * (self.switch_count - int(node_id.split('-')[1])))
+        return {'config': f"intended {node_id}\n" * 5 + BEGIN_CONFIGLET + f"configlet {node_id}\n" * 3 + BEGIN_SET + f"set {node_id}\n" * 3}
+
+
+def switches(count: int) -> list:
+    return [{'label': f"leaf-{i:02}", 'id': f"node-{i}", 'system_id': f"SERIAL{i}" if i % 4 else None} for i in range(count)]
+
+
+def fetch_all(concurrency: int, count: int = 20) -> tuple:
+    in_flight = InFlight()
+    fetcher = ConfigFetcher(FakeApstraSession(in_flight), FakeBlueprint(in_flight, count), concurrency)
+
+    async def run():
+        return [x async for x in fetcher.fetch(switches(count))]
+
+    return asyncio.run(run()), in_flight.peak
+
+
+@pytest.mark.parametrize('concurrency', [1, 4])
+def test_fetch_in_order_and_bounded(concurrency):
+    configs, peak = fetch_all(concurrency)
+    assert [x.label for x in configs] == [x['label'] for x in switches(20)]
+    assert peak == concurrency
+    assert [x.pristine_config is not None for x in configs] == [i % 4 != 0 for i in range(20)]
+    assert [file_name for file_name, _ in configs[1].sections] == [
+        '0_load_override_pristine.txt', '1_load_merge_intended.txt', '2_load_merge_configlet.txt', '3_load_set_configlet-set.txt']
+
+
+def tar_bytes(configs) -> bytes:
+    """
+    The uncompressed tar of the configs in the layout of pull_config. The gzip header has the time of now
+    """
+    tgz_stream = TgzStream()
+    tgz_stream.mtime = 1
+    chunks = []
+    tgz_stream.add_dir('bp-0')
+    for switch_config in configs:
+        tgz_stream.add_dir(f"bp-0/{switch_config.label}")
+        for file_name, content in switch_config.sections:
+            tgz_stream.add_file(f"bp-0/{switch_config.label}/{file_name}", content)
+        chunks.append(tgz_stream.read())
+    chunks.append(tgz_stream.close())
+    return gzip.decompress(b''.join(chunks))
+
+
+def test_concurrent_archive_same_as_serial():
+    serial, _ = fetch_all(1)
+    concurrent, _ = fetch_all(8)
+    archive = tar_bytes(concurrent)
+    assert archive == tar_bytes(serial)
+    assert len(tarfile.open(fileobj=io.BytesIO(archive)).getnames()) == 1 + 20 + sum(len(x.sections) for x in serial)
+
+
+def test_cached_with_fresh_pristine(tmp_path):
+    in_flight = InFlight()
+    apstra_server = FakeApstraSession(in_flight)
+    fetcher = ConfigFetcher(apstra_server, FakeBlueprint(in_flight, 4), 2, cache=ConfigCache(cache_dir=str(tmp_path)), bp_version=1)
+
+    async def run():
+        return [x async for x in fetcher.fetch(switches(4))]
+
+    first = asyncio.run(run())
+    apstra_server.pristine = 'system host-name changed'
+    second = asyncio.run(run())
+    assert [x.cached for x in first] == [False] * 4 and [x.cached for x in second] == [True] * 4
+    assert [file_name for file_name, _ in second[1].sections] == [file_name for file_name, _ in first[1].sections]
+    assert second[1].sections[0][1].startswith('system host-name changed SERIAL1\n')
+    assert second[1].sections[1:] == first[1].sections[1:]
+    assert [file_name for file_name, _ in second[0].sections][0] == '1_load_merge_intended.txt'
+
+
+INTENDED = 'set system host-name leaf-1\nset interfaces et-0/0/0 mtu 9216\n'
+CONFIGLET = 'set snmp community public\n'
+
+
+def previous_pull(sections):
+    blobs = {content_hash(content): content for _, content in sections}
+    return [(file_name, content_hash(content)) for file_name, content in sections], blobs.get
+
+
+def test_section_diffs_unchanged():
+    sections = [('1_load_merge_intended.txt', INTENDED), ('2_load_merge_configlet.txt', CONFIGLET)]
+    previous, read_blob = previous_pull(sections)
+    assert section_diffs('leaf-1', previous, sections, read_blob) == []
+
+
+def test_section_diffs_changed_added_removed():
+    previous, read_blob = previous_pull([('1_load_merge_intended.txt', INTENDED), ('2_load_merge_configlet.txt', CONFIGLET)])
+    intended = INTENDED.replace('9216', '1500')
+    sections = [('1_load_merge_intended.txt', intended), ('3_load_set_configlet-set.txt', 'set system ntp\n')]
+    diffs = dict(section_diffs('leaf-1', previous, sections, read_blob))
+    assert sorted(diffs) == ['1_load_merge_intended.txt.diff', '2_load_merge_configlet.txt.diff', '3_load_set_configlet-set.txt.diff']
+    intended_diff = diffs['1_load_merge_intended.txt.diff']
+    assert intended_diff.startswith('--- a/leaf-1/1_load_merge_intended.txt\n+++ b/leaf-1/1_load_merge_intended.txt\n')
+    assert '-set interfaces et-0/0/0 mtu 9216\n' in intended_diff
+    assert '+set interfaces et-0/0/0 mtu 1500\n' in intended_diff
+    assert f"-{CONFIGLET}" in diffs['2_load_merge_configlet.txt.diff']
+    assert '+set system ntp\n' in diffs['3_load_set_configlet-set.txt.diff']
+
+
+def test_section_diffs_skip_pristine():
+    previous, read_blob = previous_pull([('0_load_override_pristine.txt', 'old pristine\n'), ('1_load_merge_intended.txt', INTENDED)])
+    sections = [('0_load_override_pristine.txt', 'new pristine\n'), ('1_load_merge_intended.txt', INTENDED)]
+    assert section_diffs('leaf-1', previous, sections, read_blob) == []
+
+
+def test_section_diffs_missing_blob():
+    # the previous content is gone from the cache: the whole section is the diff
+    previous = [('1_load_merge_intended.txt', content_hash('gone\n'))]
+    diffs = section_diffs('leaf-1', previous, [('1_load_merge_intended.txt', INTENDED)], lambda digest: None)
+    assert len(diffs) == 1
+    assert all(f"+{line}" in diffs[0][1] for line in INTENDED.splitlines(keepends=True))
@@ -0,0 +1,56 @@
+import os
+
+import pytest
+
+from app.lib import config_history as config_history_module
+from app.lib.config_history import ConfigHistory
+
+
+def sections(switch: int, version: int):
+    return [('1_load_merge_intended.txt', f"set system host-name leaf-{switch}\n" * 50),
+            ('2_load_merge_configlet.txt', f"set snmp location rack-{switch} v{version}\n" * 20)]
+
+
+def record_pull(history: ConfigHistory, version: int, created: float = None) -> str:
+    pull = history.new_pull('apstra:443', 'bp-id-0', 'bp-0')
+    if created is not None:
+        pull.created = created
+    for switch in range(3):
+        pull.add_sections(f"leaf-{switch}", sections(switch, version))
+    pull.commit()
+    return pull.pull_id
+
+
+def test_stored_bytes_kept_without_walking(tmp_path, monkeypatch):
+    history = ConfigHistory(history_dir=str(tmp_path))
+    record_pull(history, 1)
+    record_pull(history, 2)
+    measured = history.measure_stored_bytes()
+
+    def no_walk(*args, **kwargs):
+        raise AssertionError('os.walk on /history')
+
+    monkeypatch.setattr(os, 'walk', no_walk)
+    listed = history.pulls('apstra:443', {'bp-id-0'})
+    assert len(listed['pulls']) == 2
+    assert listed['stored_bytes'] == measured
+    # the intended sections are the same in both pulls
+    assert listed['raw_bytes'] > measured
+
+
+def test_stored_bytes_after_prune(tmp_path, monkeypatch):
+    monkeypatch.setattr(config_history_module, 'HISTORY_BLOB_GRACE', -1)
+    history = ConfigHistory(history_dir=str(tmp_path), max_days=1)
+    record_pull(history, 1, created=0)
+    record_pull(history, 2)
+    # the first pull expired on the commit of the second, with its configlet blobs
+    assert len(history.pulls('apstra:443', {'bp-id-0'})['pulls']) == 1
+    assert history.stored_bytes() == history.measure_stored_bytes()
+
+
+def test_stored_bytes_of_an_existing_history(tmp_path):
+    history = ConfigHistory(history_dir=str(tmp_path))
+    record_pull(history, 1)
+    os.remove(history.usage_file)
+    assert history.stored_bytes() == history.measure_stored_bytes()
+    assert os.path.exists(history.usage_file)
@@ -0,0 +1,71 @@
+import asyncio
+import io
+import json
+import time
+
+import pytest
+
+from app.lib import cpu_pool
+from app.lib.bp_json import iter_bp_dump
+
+BLUEPRINT = {
+    'nodes': {f"node-{i}": {'id': f"node-{i}", 'type': 'interface', 'description': 'x' * 200} for i in range(5000)},
+    'relationships': {},
+    'design': 'two_stage_l3clos',
+    'label': 'bp-0',
+}
+
+
+class FakeRaw(io.BytesIO):
+    decode_content = False
+    delay = 0.0  # seconds per read, a slow Apstra
+
+    def read(self, size=-1):
+        time.sleep(self.delay)
+        return super().read(size)
+
+
+class FakeDumpResponse:
+    def __init__(self, body: bytes, delay: float):
+        self.raw = FakeRaw(body)
+        self.raw.delay = delay
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.raw.close()
+
+
+@pytest.fixture
+def spool_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(cpu_pool, 'APSTRA_CPU_SPOOL_DIR', str(tmp_path))
+    return tmp_path
+
+
+def export(body: bytes, delay: float = 0.0, max_chunks: int = 0) -> bytes:
+    async def run():
+        chunks = []
+        exported = cpu_pool.export_bp_dump(lambda: FakeDumpResponse(body, delay))
+        async for chunk in exported:
+            chunks.append(chunk)
+            if len(chunks) == max_chunks:
+                await exported.aclose()
+                break
+        return b''.join(chunks)
+
+    return asyncio.run(run())
+
+
+def test_export_same_as_iter_bp_dump(spool_dir):
+    body = json.dumps(BLUEPRINT).encode()
+    assert export(body) == b''.join(iter_bp_dump(io.BytesIO(body)))
+    assert list(spool_dir.iterdir()) == []
+
+
+def test_export_stopped_early(spool_dir):
+    body = json.dumps(BLUEPRINT).encode()
+    # the files are removed once the worker process stopped, which leaves the pool free for the next export
+    export(body, delay=0.05, max_chunks=1)
+    assert list(spool_dir.iterdir()) == []
+    assert export(body) == b''.join(iter_bp_dump(io.BytesIO(body)))
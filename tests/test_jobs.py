@@ -0,0 +1,39 @@
+import io
+
+import pytest
+
+from app.lib.jobs import iter_file_range, parse_range
+
+
+@pytest.mark.parametrize('header, expected', [
+    (None, None),
+    ('', None),
+    ('bytes=0-99', (0, 99)),
+    ('bytes=10-', (10, 99)),
+    ('bytes=90-500', (90, 99)),
+    ('bytes=-10', (90, 99)),
+    ('bytes=-500', (0, 99)),
+    ('bytes=0-9,20-29', None),  # multiple ranges, the whole content
+    ('items=0-9', None),
+])
+def test_parse_range(header, expected):
+    assert parse_range(header, 100) == expected
+
+
+@pytest.mark.parametrize('header', ['bytes=100-', 'bytes=50-10', 'bytes=-0'])
+def test_parse_range_not_satisfiable(header):
+    with pytest.raises(ValueError):
+        parse_range(header, 100)
+
+
+def test_iter_file_range():
+    fp = io.BytesIO(bytes(range(100)))
+    chunks = list(iter_file_range(fp, 10, 34, chunk_size=10))
+    assert [len(x) for x in chunks] == [10, 10, 5]
+    assert b''.join(chunks) == bytes(range(10, 35))
+    assert fp.closed
+
+
+def test_iter_file_range_short_file():
+    fp = io.BytesIO(b'abc')
+    assert b''.join(iter_file_range(fp, 1, 99)) == b'bc'
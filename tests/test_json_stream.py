@@ -0,0 +1,48 @@
+import io
+import json
+
+import pytest
+
+from app.lib.json_stream import iter_json_entries
+
+BLUEPRINT = {
+    'id': 'bp-id-0',
+    'nodes': {
+        'node-0': {'id': 'node-0', 'type': 'metadata', 'label': 'bp-0', 'tags': None},
+        'node-1': {'id': 'node-1', 'type': 'system', 'label': 'leaf "1" é', 'tags': ['a', 'b'], 'property_set': {'x': [1, 2.5, None, True]}},
+    },
+    'relationships': {
+        'rel-0': {'id': 'rel-0', 'type': 'hosted_interfaces', 'source_id': 'node-1', 'target_id': 'node-0'},
+    },
+    'design': 'two_stage_l3clos',
+    'version': 42,
+    'empty': {},
+}
+
+
+def as_file(data) -> io.BytesIO:
+    return io.BytesIO(json.dumps(data).encode('utf-8'))
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 64 * 1024])
+def test_iter_json_entries(chunk_size):
+    entries = list(iter_json_entries(as_file(BLUEPRINT), chunk_size=chunk_size))
+    assert entries == [
+        ('id', None, 'bp-id-0'),
+        ('nodes', 'node-0', BLUEPRINT['nodes']['node-0']),
+        ('nodes', 'node-1', BLUEPRINT['nodes']['node-1']),
+        ('relationships', 'rel-0', BLUEPRINT['relationships']['rel-0']),
+        ('design', None, 'two_stage_l3clos'),
+        ('version', None, 42),
+        ('empty', None, {}),
+    ]
+
+
+def test_iter_json_entries_empty_stream_key():
+    assert list(iter_json_entries(as_file({'nodes': {}, 'label': 'x'}))) == [('nodes', None, {}), ('label', None, 'x')]
+
+
+@pytest.mark.parametrize('text', [b'[1, 2]', b'{"nodes": {"a": 1', b'{"a" 1}'])
+def test_iter_json_entries_invalid(text):
+    with pytest.raises(ValueError):
+        list(iter_json_entries(io.BytesIO(text)))
@@ -0,0 +1,51 @@
+import asyncio
+from dataclasses import dataclass, field
+
+from app.lib.jobs import JobManager
+from app.lib.session_store import SessionRegistry
+from app.lib.sse_hub import SseHub
+
+
+@dataclass
+class FakeStore:
+    session_id: str
+    sse_hub: SseHub = field(default_factory=SseHub)
+    closed: bool = False
+
+    def close(self) -> None:
+        self.closed = True
+
+
+def test_evict_idle(tmp_path):
+    job_manager = JobManager(job_dir=str(tmp_path), retention=3600)
+    registry = SessionRegistry(FakeStore, idle_ttl=3600, busy=job_manager.has_jobs)
+
+    async def run():
+        idle_id, idle_store, _ = registry.get(None)
+        listening_id, listening_store, _ = registry.get(None)
+        listening_store.sse_hub.subscribe()
+        working_id, working_store, _ = registry.get(None)
+        started = asyncio.Event()
+        release = asyncio.Event()
+
+        async def work(job):
+            started.set()
+            await release.wait()
+
+        job = job_manager.submit('pull-config', work, owner=working_store)
+        await started.wait()
+        registry.idle_ttl = -1
+        registry.evict_idle()
+        assert set(registry.sessions) == {listening_id, working_id}
+        assert idle_store.closed and not working_store.closed
+        # the finished job stays for the download until the retention
+        release.set()
+        await job.task
+        registry.evict_idle()
+        assert working_id in registry.sessions
+        job_manager.retention = -1
+        registry.evict_idle()
+        assert set(registry.sessions) == {listening_id}
+        assert working_store.closed and not listening_store.closed
+
+    asyncio.run(run())
@@ -0,0 +1,47 @@
+import asyncio
+
+from app.lib.sse_hub import SseHub, SseSubscriber
+
+
+def test_subscriber_drops_oldest():
+    subscriber = SseSubscriber(max_size=3)
+    for i in range(5):
+        subscriber.push({'id': str(i)})
+    assert [x['id'] for x in subscriber.buffer] == ['2', '3', '4']
+    assert subscriber.take_dropped() == 2
+    assert subscriber.take_dropped() == 0
+
+
+def test_subscriber_next_batch():
+    async def run():
+        subscriber = SseSubscriber(max_size=10)
+        for i in range(5):
+            subscriber.push({'id': str(i)})
+        first = await subscriber.next_batch(max_events=3, deadline=0.01)
+        rest = await subscriber.next_batch(max_events=3, deadline=0.01)
+        return first, rest
+
+    first, rest = asyncio.run(run())
+    assert [x['id'] for x in first] == ['0', '1', '2']
+    assert [x['id'] for x in rest] == ['3', '4']
+
+
+def test_hub_replay_after_last_event_id():
+    hub = SseHub(replay_size=3, subscriber_buffer=10)
+    for i in range(5):
+        hub.publish('log', f"line {i}")
+    subscriber = hub.subscribe(last_event_id='3')
+    assert [x['id'] for x in subscriber.buffer] == ['4', '5']
+    # older than the replay buffer
+    assert [x['id'] for x in hub.subscribe(last_event_id='0').buffer] == ['3', '4', '5']
+
+
+def test_hub_slow_subscriber():
+    hub = SseHub(replay_size=10, subscriber_buffer=2)
+    subscriber = hub.subscribe()
+    for i in range(5):
+        hub.publish('log', f"line {i}")
+    assert [x['data'] for x in subscriber.buffer] == ['line 3', 'line 4']
+    assert subscriber.take_dropped() == 3
+    hub.unsubscribe(subscriber)
+    assert not hub.subscribers
@@ -0,0 +1,21 @@
+from app.lib.transport import ApstraAdapter
+
+URL = 'https://apstra.example:443/api'
+
+
+def pool_of(adapter: ApstraAdapter):
+    # the pool key of requests: the host and the pool settings of the adapter
+    return adapter.poolmanager.connection_from_url(URL, pool_kwargs={})
+
+
+def test_grow_keeps_the_pool_in_use():
+    adapter = ApstraAdapter(4)
+    small = pool_of(adapter)
+    adapter.grow(16)
+    adapter.grow(8)
+    large = pool_of(adapter)
+    assert large is not small
+    assert (small.pool.maxsize, large.pool.maxsize) == (4, 16)
+    # the connections of the requests in flight go back to the open smaller pool
+    assert small.pool is not None
+    assert adapter.pool_size == 16